@@ -0,0 +1,311 @@
+"""Single Atom Image Analysis
+Stefan Spence 20/05/19
+
+Timing comparisons for the image analysis functions. These can be run
+without the GUI to check that faster functions give the same results as
+the functions that they replace:
+    python benchmark.py
+"""
+import os
+import time
+import tempfile
+import numpy as np
+from scipy.signal import find_peaks
+import imageHandler as ih
+import fitCurve as fc
+
+def make_asc(file_name, im_vals):
+    """Write an array to file_name in the same ASCII format that Andor uses,
+    where the first column of each row is the row number."""
+    with open(file_name, 'w') as f:
+        for i, row in enumerate(im_vals):
+            f.write(str(i+1) + ' ' + ' '.join(map(str, row)) + '\n')
+
+def fake_im(pic_size=512, bg=700, xc=None, yc=None, signal=0, seed=None):
+    """Make an image with Poissonian background counts bg and, optionally,
+    a single atom that adds an average of signal counts spread over a
+    3x3 square centred on (xc, yc)."""
+    rng = np.random.RandomState(seed)
+    im_vals = rng.poisson(bg, (pic_size, pic_size))
+    if signal:
+        xc = pic_size//2 if xc is None else xc
+        yc = pic_size//2 if yc is None else yc
+        im_vals[xc-1:xc+2, yc-1:yc+2] += rng.poisson(signal/9., (3,3))
+    return im_vals
+
+def timeit(fn, *args, repeats=10):
+    """Return the output of fn(*args) and the mean time per call in seconds"""
+    t0 = time.time()
+    for i in range(repeats):
+        out = fn(*args)
+    return out, (time.time() - t0) / repeats
+
+def compare_loaders(pic_size=512, repeats=10):
+    """Compare the time to load an image with np.loadtxt against
+    imageHandler.load_asc and check that both give the same array."""
+    fname = os.path.join(tempfile.mkdtemp(), 'bench.asc')
+    make_asc(fname, fake_im(pic_size, signal=2000, seed=0))
+    old, t_old = timeit(lambda x: np.loadtxt(x, delimiter=' ',
+                    usecols=range(1,pic_size+1)), fname, repeats=repeats)
+    new, t_new = timeit(ih.load_asc, fname, pic_size, repeats=repeats)
+    os.remove(fname)
+    print('Load %sx%s image:  np.loadtxt %.3g ms,  load_asc %.3g ms,  identical: %s'%(
+        pic_size, pic_size, t_old*1e3, t_new*1e3,
+        old.dtype == new.dtype and np.array_equal(old, new)))
+    return t_old, t_new
+
+def add_count_slicing(im_han, full_im):
+    """The previous version of imageHandler.image_handler.add_count, which
+    copies the image and masks the ROI for each image handler. Return the
+    statistics in the same order as roi_stats.get_stats: [ROI counts, ROI
+    centre count, background mean, background std, xc max, yc max]."""
+    xc, yc, roi_size = im_han.xc, im_han.yc, im_han.roi_size
+    not_roi = full_im.copy()
+    # get the ROI
+    if roi_size % 2: # odd ROI length (+1 to upper bound)
+        im_vals = full_im[xc-roi_size//2:xc+roi_size//2+1, yc-roi_size//2:yc+roi_size//2+1]
+        not_roi[xc-roi_size//2:xc+roi_size//2+1, yc-roi_size//2:yc+roi_size//2+1] = np.zeros(np.shape(im_vals))
+    else:            # even ROI length
+        im_vals = full_im[xc-roi_size//2:xc+roi_size//2, yc-roi_size//2:yc+roi_size//2]
+        not_roi[xc-roi_size//2:xc+roi_size//2, yc-roi_size//2:yc+roi_size//2] = np.zeros(np.shape(im_vals))
+    # background statistics: mean count and standard deviation across image
+    N = np.size(full_im) - np.size(im_vals)
+    mean_count = np.sum(not_roi) / N
+    std_count = np.sqrt(np.sum((not_roi[not_roi>0]-mean_count)**2) / (N - 1))
+    xc_max, yc_max = np.unravel_index(np.argmax(full_im), full_im.shape)
+    return [np.sum(im_vals), full_im[xc, yc], mean_count, std_count, xc_max, yc_max]
+
+def compare_roi_stats(num_rois=100, pic_size=512, roi_size=5, repeats=10):
+    """Compare the time to get statistics for num_rois ROIs using a separate
+    image_handler for each ROI, the way add_count used to slice and mask 
+    the image for each handler, against a single imageHandler.roi_stats."""
+    im_vals = fake_im(pic_size, seed=0).astype(float)
+    rois = [[roi_size + (2*roi_size*i) % (pic_size - 2*roi_size),
+             roi_size + (2*roi_size*(i*2*roi_size//pic_size)) % (pic_size - 2*roi_size),
+             roi_size] for i in range(num_rois)]
+    handlers = [ih.image_handler() for roi in rois]
+    for im_han, roi in zip(handlers, rois):
+        im_han.set_roi(dimensions=roi)
+    def each_handler(im_vals):
+        return np.array([add_count_slicing(im_han, im_vals) for im_han in handlers])
+    old, t_old = timeit(each_handler, im_vals, repeats=repeats)
+    new, t_new = timeit(ih.roi_stats().get_stats, im_vals, rois, repeats=repeats)
+    print('Stats for %s ROIs:  separate handlers %.3g ms,  roi_stats %.3g ms,  identical: %s'%(
+        num_rois, t_old*1e3, t_new*1e3, np.allclose(old, new)))
+    return t_old, t_new
+
+def est_param_find_peaks(h):
+    """The previous version of imageHandler.est_param, which calls 
+    find_peaks repeatedly while increasing the separation of the peaks."""
+    d   = 1    # required minimal horizontal distance between neighbouring peaks
+    inc = np.size(h)//500 * 5 + 1 # increment to increase distance by
+    num_peaks = 10
+    while num_peaks > 2:
+        peak_inds, properties = find_peaks(h, width=0, distance=d) # properties is a dict
+        num_peaks = np.size(peak_inds)
+        d += inc   # increase the width of the peaks we're searching for
+    return peak_inds, properties['prominences'], properties['widths']
+
+def fake_hists(num=200, seed=0):
+    """Make a list of histograms of counts with a background peak and a
+    signal peak, with different numbers of images and bins."""
+    rng = np.random.RandomState(seed)
+    hists = []
+    for i in range(num):
+        n = rng.randint(10, 20000)   # number of images
+        bg = rng.normal(rng.uniform(500, 2000), rng.uniform(5, 100), n)
+        signal = rng.normal(rng.uniform(2000, 5000), rng.uniform(10, 400), n)
+        counts = np.where(rng.rand(n) < rng.uniform(0.05, 0.95), signal, bg)
+        bins = rng.choice([10, 20 + n//20, rng.randint(10, 1500)])
+        hists.append(np.histogram(counts, bins)[0])
+    return hists
+
+def compare_est_param(num=200):
+    """Compare the time for est_param against the previous version using
+    find_peaks on several histograms and check that they give the same peaks."""
+    hists = fake_hists(num)
+    t_old, t_new, same = 0, 0, True
+    for h in hists:
+        old, t = timeit(est_param_find_peaks, h, repeats=1)
+        t_old += t
+        new, t = timeit(ih.est_param, h, repeats=1)
+        t_new += t
+        same = same and all(np.array_equal(a, b) for a, b in zip(old, new))
+    print('Peaks for %s histograms:  find_peaks loop %.3g ms,  est_param %.3g ms,  identical: %s'%(
+        num, t_old*1e3, t_new*1e3, same))
+    return t_old, t_new
+
+def compare_frame_stack(num_ims=20000, pic_size=64, repeats=1):
+    """Compare the time to re-analyse num_ims images from a binary archive
+    with a new ROI using roi_stats on each image against imageHandler.frame_stack
+    and check that both give the same statistics."""
+    name = os.path.join(tempfile.mkdtemp(), 'bench')
+    archive = ih.frame_archive(name)
+    rng = np.random.RandomState(0)
+    for i in range(num_ims):
+        archive.append(i, rng.poisson(700, (pic_size, pic_size)))
+    files, frames = archive.load()
+    rois = [[pic_size//4, pic_size//4, 5], [pic_size//2, pic_size//2, 5]]
+    def each_image(frames):
+        engine = ih.roi_stats()
+        return np.array([engine.get_stats(im.astype(float), rois) for im in frames]).transpose(1,0,2)
+    old, t_old = timeit(each_image, frames, repeats=repeats)
+    stack = ih.frame_stack(files, frames)
+    _, t_first = timeit(stack.get_stats, rois, repeats=1) # includes full image sums
+    new, t_new = timeit(stack.get_stats, rois, repeats=repeats)
+    for f in [archive.frames_file, archive.files_file]:
+        os.remove(f)
+    print('Re-analyse %s images:  roi_stats loop %.3g ms,  frame_stack first %.3g ms, then %.3g ms,  identical: %s'%(
+        num_ims, t_old*1e3, t_first*1e3, t_new*1e3, np.array_equal(old, new)))
+    return t_old, t_new
+
+def compare_batch(num_ims=200, pic_size=512, processes=None):
+    """Compare the time to load num_ims image files and get their ROI
+    statistics one at a time against imageHandler.batch_stats, which uses
+    a process pool, and check that both give the same statistics."""
+    dirname = tempfile.mkdtemp()
+    file_list = [os.path.join(dirname, 'bench_%s.asc'%i) for i in range(num_ims)]
+    for i, fname in enumerate(file_list):
+        make_asc(fname, fake_im(pic_size, signal=2000*(i%2), seed=i))
+    rois = [[pic_size//2, pic_size//2, 5]]
+    def each_file(file_list):
+        return np.array([ih.file_stats((f, pic_size, rois, ' '))[1]
+                for f in file_list]).transpose(1,0,2)
+    old, t_old = timeit(each_file, file_list, repeats=1)
+    (files, new, failures), t_new = timeit(ih.batch_stats, file_list, pic_size,
+        rois, ' ', processes, repeats=1)
+    for fname in file_list:
+        os.remove(fname)
+    os.rmdir(dirname)
+    print('Process %s files:  one at a time %.3g s,  batch_stats on %s CPUs %.3g s,  identical: %s'%(
+        num_ims, t_old, processes or ih.cpu_count(), t_new,
+        not failures and np.array_equal(old, new)))
+    return t_old, t_new
+
+def compare_fits(num=200):
+    """Compare the time to fit two Gaussians to several histograms by 
+    splitting each histogram in half and using curve_fit on each half,
+    against fitting the sum of two Gaussians to all of the histograms at 
+    once with fitCurve.multi_gauss. Count how often each method fails and
+    how often the joint fit has a smaller sum of squared residuals."""
+    hists = fake_hists(num)
+    xs = [np.arange(np.size(h)) + 0.5 for h in hists]
+    def split_fits(xs, hists):
+        ps = []
+        for x, h in zip(xs, hists):
+            best_fits = [fc.fit(x[:np.size(h)//2], h[:np.size(h)//2]),
+                        fc.fit(x[np.size(h)//2:], h[np.size(h)//2:])]
+            try:
+                for bf in best_fits:
+                    bf.estGaussParam()
+                    bf.getBestFit(bf.gauss)
+                ps.append(np.concatenate([bf.ps for bf in best_fits]))
+            except Exception:
+                ps.append(np.full(6, np.nan))
+        return np.array(ps)
+    old, t_old = timeit(split_fits, xs, hists, repeats=1)
+    engine = fc.multi_gauss(2, max_t=1)
+    (new, _, success), t_new = timeit(engine.fit, xs, hists, [[np.size(h)/2.] for h in hists], repeats=1)
+    _, t_warm = timeit(engine.fit, xs, hists, [[np.size(h)/2.] for h in hists], repeats=1)
+    old_ok = np.all(np.isfinite(old), axis=1)
+    w = [np.ones(np.size(h)) for h in hists]
+    better = sum(engine.cost(x[None], h[None], wk[None], p[None])[0] <= 
+                engine.cost(x[None], h[None], wk[None], q[None])[0]*1.001
+                for x, h, wk, p, q, ok in zip(xs, hists, w, new, old, old_ok) if ok)
+    print('Fit %s histograms:  curve_fit on halves %.3g ms (%s failed),  multi_gauss %.3g ms (%s failed), '%(
+        num, t_old*1e3, num - np.count_nonzero(old_ok), t_new*1e3, num - np.count_nonzero(success))
+        + 'warm start %.3g ms,  joint fit as good: %s / %s'%(t_warm*1e3, better, np.count_nonzero(old_ok)))
+    return t_old, t_new
+
+def compare_class_stats(num_ims=20000, repeats=1000):
+    """Compare the time to get the number, mean, and standard deviation of
+    the counts below and above threshold by splitting all of the counts 
+    against the running statistics in imageHandler.class_stats, after 
+    adding one more image, and check that both give the same values."""
+    rng = np.random.RandomState(0)
+    counts = np.where(rng.rand(num_ims) < 0.5, rng.normal(1200, 40, num_ims), 
+                    rng.normal(1900, 90, num_ims)).round()
+    thresh = 1500
+    def split_counts(counts):
+        atom = counts // thresh
+        below, above = counts[np.where(atom == 0)[0]], counts[np.where(atom > 0)[0]]
+        return [np.size(below), np.size(above), np.mean(below), np.mean(above),
+                np.std(below, ddof=1), np.std(above, ddof=1)]
+    old, t_old = timeit(split_counts, counts, repeats=repeats)
+    stats = ih.class_stats()
+    stats.reset(thresh)
+    stats.add(counts[:-repeats])
+    def add_one(i):
+        stats.add(counts[i])
+        return list(stats.n) + list(stats.means()) + list(stats.std())
+    t0 = time.time()
+    for i in range(num_ims - repeats, num_ims):
+        new = add_one(i)
+    t_new = (time.time() - t0) / repeats
+    print('Class statistics for %s images:  split all counts %.3g ms,  class_stats %.3g ms,  same: %s'%(
+        num_ims, t_old*1e3, t_new*1e3, np.allclose(old, new)))
+    return t_old, t_new
+
+def compare_threshold(num_ims=1000000, steps=100, cycles=1000):
+    """Compare the time to move the threshold in small steps and find the
+    number of images above it by comparing all of the counts against 
+    image_handler.classify, which uses the sorted index of the counts, and
+    check that both give the same atom detected arrays. Then compare them
+    when a new image is added before each step, like in live mode, where 
+    the new count has to be merged into the sorted index."""
+    rng = np.random.RandomState(0)
+    counts = np.where(rng.rand(num_ims) < 0.5, rng.normal(1200, 40, num_ims), 
+                    rng.normal(1900, 90, num_ims)).round()
+    threshes = np.linspace(1400, 1600, steps)
+    def compare_all(threshes):
+        for thresh in threshes:
+            atom = counts >= thresh
+            atom_count = np.count_nonzero(atom)
+        return atom, atom_count
+    (old, old_count), t_old = timeit(compare_all, threshes, repeats=1)
+    im_han = ih.image_handler()
+    im_han.add_stats(np.arange(num_ims), np.column_stack([counts] + [np.zeros(num_ims)]*5))
+    im_han.thresh = threshes[0]
+    im_han.classify() # sort the counts before timing
+    def move_thresh(threshes):
+        for thresh in threshes:
+            im_han.thresh = thresh
+            im_han.classify()
+            atom_count = im_han.class_stats.n[1]
+        return im_han.atom[:num_ims], atom_count
+    (new, new_count), t_new = timeit(move_thresh, threshes, repeats=1)
+    print('Move threshold for %s images:  compare all counts %.3g ms,  sorted index %.3g ms per step,  identical: %s'%(
+        num_ims, t_old*1e3/steps, t_new*1e3/steps, np.array_equal(old, new) and old_count == new_count))
+    # add a new image, then move the threshold
+    new_counts = rng.normal(1500, 300, cycles).round()
+    cycle_threshes = threshes[np.arange(cycles) % steps]
+    old_han = ih.image_handler() # compare the counts where they're stored
+    old_han.add_stats(np.arange(num_ims), np.column_stack([counts] + [np.zeros(num_ims)]*5))
+    def add_compare_all(new_counts, threshes):
+        for k in range(cycles):
+            old_han.add_stats([num_ims + k], [[new_counts[k], 0, 0, 0, 0, 0]])
+            atom = old_han.counts[:old_han.im_num] >= threshes[k]
+            atom_count = np.count_nonzero(atom)
+        return atom, atom_count
+    (old, old_count), t_old_add = timeit(add_compare_all, new_counts, cycle_threshes, repeats=1)
+    def add_move_thresh(new_counts, threshes):
+        for k in range(cycles):
+            im_han.add_stats([num_ims + k], [[new_counts[k], 0, 0, 0, 0, 0]])
+            im_han.thresh = threshes[k]
+            im_han.classify()
+            atom_count = im_han.class_stats.n[1]
+        return im_han.atom[:im_han.im_num], atom_count
+    (new, new_count), t_new_add = timeit(add_move_thresh, new_counts, cycle_threshes, repeats=1)
+    print('Add an image then move threshold for %s images:  compare all counts %.3g ms,  sorted index %.3g ms per step,  identical: %s'%(
+        num_ims, t_old_add*1e3/cycles, t_new_add*1e3/cycles, np.array_equal(old, new) and old_count == new_count))
+    return t_old, t_new, t_old_add, t_new_add
+
+if __name__ == "__main__":
+    compare_loaders()
+    compare_roi_stats()
+    compare_est_param()
+    compare_frame_stack()
+    compare_batch()
+    compare_fits()
+    compare_class_stats()
+    compare_threshold()
@@ -4,36 +4,192 @@ Stefan Spence 12/04/19
  - watch the image_read_path directory for new images
  - save the new image with label into a dated subdirectory under image_storage_path
  - delete the original file so that a new file with the same name can be created
+   (the file is hard linked if the directories are on the same file system)
  
 Assuming that image files are ASCII
 
 watchdog creates an observer that waits for file creation events
 the observer must be initiated and shut down properly to ensure that there isn't
 one running behind the scenes which might overwrite previously saved files.
+If the observer reports when a file is closed after writing (inotify on Linux
+with watchdog >= 2.1) then files are processed as soon as they're closed,
+otherwise the file size is polled until it stops changing.
+The Dexter sync file is also watched, so that its file number is read when it
+changes rather than while an image is being processed.
 """
 import numpy as np
 import os
 import time
-import shutil
+import threading
 try:
     from PyQt4.QtCore import QThread, pyqtSignal, QEvent
 except ModuleNotFoundError:
     from PyQt5.QtCore import QThread, pyqtSignal, QEvent
+from stageTimer import stage_timer
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+try: # only inotify reports when a file is closed after writing, from watchdog 2.1
+    from watchdog.events import EVENT_TYPE_CLOSED
+    from watchdog.observers.inotify import InotifyObserver
+except ImportError: # older watchdog or not Linux
+    InotifyObserver = None
 
 ####    ####    ####    ####
+
+def retry(func, *args, dt=1e-3, max_t=0.5):
+    """Return func(*args), trying again if there's a PermissionError because
+    another program hasn't let go of the file yet. The pause between tries
+    starts at dt and doubles each time. The error is raised if the total
+    pause would be longer than max_t."""
+    waited = 0
+    while True:
+        try:
+            return func(*args)
+        except PermissionError:
+            if waited + dt > max_t:
+                raise
+            print("WARNING: added a pause because python tried to access the file before the other program had let go")
+            time.sleep(dt)
+            waited += dt
+            dt *= 2
+
+def creation_time(file_name):
+    """Return the time that the file was created, or None if the file 
+    system doesn't record it. st_ctime is only the creation time on Windows:
+    on Linux it's the last time the file's inode changed, which is later
+    than the creation time while the file is being written."""
+    st = os.stat(file_name)
+    if hasattr(st, 'st_birthtime'): # e.g. macOS, or Windows with python >= 3.12
+        return st.st_birthtime
+    elif os.name == 'nt':
+        return st.st_ctime
+    return None
+
+def read_bytes(file_name):
+    """Return the contents of the file"""
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+def write_bytes(file_name, data, mode='wb'):
+    """Write data to a new file. Use mode='xb' to raise FileExistsError
+    instead of overwriting a file that already exists."""
+    with open(file_name, mode) as f:
+        f.write(data)
+
+class dexter_sync(FileSystemEventHandler):
+    """Keep track of the Dexter file number without reading the sync file
+    for every image, since it's usually on a network drive.
+    
+    The observer reports when the sync file changes, and then the new
+    number is read and cached. When an image arrives, the cached number is
+    used if it has changed since the last image. Otherwise the prediction 
+    is that Dexter hasn't updated the file yet, so the number is one more 
+    than the last one. Unverified predictions are checked by reading the 
+    file, which is the only time that it's read while processing an image.
+    If the first change to the file after a prediction doesn't match it,
+    then the prediction was wrong and it's counted in mismatches.
+    Keyword arguments:
+    file_name -- absolute path to Dexter's currentfile.txt"""
+    def __init__(self, file_name):
+        super().__init__()
+        self.file_name = file_name
+        self.path = os.path.normcase(os.path.abspath(file_name))
+        self.value = None       # last file number read from the sync file
+        self.changed = False    # whether the value has changed since the last image
+        self.dfn = None         # last file number given to an image
+        self.predicted = False  # whether dfn was a prediction
+        self.reads = 0          # number of times the file was read while processing an image
+        self.predictions = 0    # number of file numbers that were predicted
+        self.mismatches = 0     # number of predictions that turned out to be wrong
+        self.close_events = False # whether the observer reports files closed after writing
+        self.lock = threading.Lock() # the file number can be requested from other threads
+
+    def read(self, dt=1e-3):
+        """Return the number in the sync file. If the file is empty then 
+        Dexter is probably writing to it, so wait until it isn't."""
+        new_dfn = '' # sometimes Dexter hasn't finished writing to file, we should wait til it has.
+        while new_dfn == '': # note: this usually takes about 10 ms.
+            new_dfn = retry(read_bytes, self.file_name).decode().strip()
+            if new_dfn == '':
+                time.sleep(dt) # deliberately add pause so we don't loop too many times
+        return int(new_dfn)
+
+    def on_any_event(self, event):
+        """When the sync file changes, cache the new file number and check
+        it against the last prediction. If the observer reports when files
+        are closed, only read the file once it's been written, otherwise
+        read it when it's modified. Reading the file doesn't count."""
+        if self.close_events:
+            changes = ['closed']
+        else:
+            changes = ['modified', 'created', 'moved']
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        if event.is_directory or event.event_type not in changes or self.path not in [
+                os.path.normcase(os.path.abspath(p)) for p in paths if p]:
+            return
+        try:
+            new_dfn = retry(read_bytes, self.file_name).decode().strip()
+            if new_dfn == '': 
+                return # Dexter is writing the file, wait for the next event
+            value = int(new_dfn)
+        except (OSError, ValueError): 
+            return # the file is being replaced or isn't finished
+        with self.lock:
+            if value != self.value:
+                if self.predicted: # the first change since a prediction
+                    if value != self.dfn:
+                        self.mismatches += 1
+                        print("WARNING: predicted Dexter file number %s but the sync file changed to %s. "%(
+                            self.dfn, value) + "%s of %s predictions were wrong."%(
+                            self.mismatches, self.predictions))
+                    self.predicted = False
+                self.value, self.changed = value, True
+
+    def get(self, dt=1e-3):
+        """Return the file number for a new image. Use the cached value if
+        it has changed since the last image, otherwise read the sync file
+        and predict the next number if it still hasn't changed."""
+        with self.lock:
+            if self.changed and self.value != self.dfn: # verified by the sync file
+                self.dfn, self.predicted, self.changed = self.value, False, False
+                return self.dfn
+        value = self.read(dt) # no change seen, so check the file
+        with self.lock:
+            self.reads += 1
+            self.value, self.changed = value, False
+            if value != self.dfn:
+                self.dfn, self.predicted = value, False
+            else: # sometimes Dexter hasn't updated the file number yet
+                self.dfn, self.predicted = value + 1, True
+                self.predictions += 1
+            return self.dfn
+
+    def summary(self):
+        """Return a string with the number of predictions and mismatches"""
+        return 'Dexter sync file read %s times, %s file numbers predicted, %s wrong (%.3g%%)'%(
+            self.reads, self.predictions, self.mismatches, 
+            100 * self.mismatches / max(self.predictions, 1))
     
 # set up an event handler that is also a QObject through inheritance of QThread
 class system_event_handler(FileSystemEventHandler, QThread):
     """The event handler responds to file creation events and emits the path
-    to the file as a signal"""
+    to the file as a signal. If close_events is True then the observer 
+    reports when a file is closed after writing, so the file is processed
+    then. Otherwise, wait_for_file polls the file size until it stops
+    changing. As well as the event_path signal, the event_data signal 
+    sends the new file path with the contents of the file as bytes, if
+    they were read while moving it, so that the file doesn't have to be
+    read from the storage directory again to analyse it. The duration of
+    each stage is recorded in timer, which can be shared with the rest of
+    the processing (see stageTimer)."""
     event_path = pyqtSignal(str)
+    event_data = pyqtSignal(str, object) # file path, contents or None
     
     def __init__(self, image_storage_path, dexter_sync_file_name, date):
         super().__init__()
         
         self.dfn = ""    # dexter file number
+        self.dexter = dexter_sync(dexter_sync_file_name) # caches the number in the sync file
         self.last_event_path = ""   # last event processed 
         self.image_storage_path = image_storage_path  # directory where we copy images to
         self.dexter_sync_file_name = dexter_sync_file_name # path to file where dexter syncs its file #
@@ -45,67 +201,145 @@ class system_event_handler(FileSystemEventHandler, QThread):
         self.write_t = 0           # time taken to watch a file being written
         self.copy_t  = 0           # time taken to watch a file being copied 
         self.nfn     = 0           # number to append to file so as not to overwrite
+        self.close_events = False  # whether the observer reports files closed after writing
+        self.created = {}          # creation time of files that haven't been closed yet
+        self.last_size = -1        # size of the last file that was fully written
+        self.same_fs = True        # whether files can be hard linked into the storage dir
+        self.send_bytes = True     # whether to read the file and send it with event_data
+        self.timer = stage_timer() # records the duration of each stage for every file
         
-    def wait_for_file(self, file_name, dt=0.01):
+    def wait_for_file(self, file_name, dt_min=1e-3, dt_max=0.01):
         """Make sure that the file has finished being written by waiting until
-        the file size isn't changing anymore"""
+        the file size isn't changing anymore. The time between checking the
+        size starts at dt_min and doubles up to dt_max, so that short writes
+        are noticed quickly without looping too many times during long 
+        writes. The file is finished when the size doesn't change over dt_max,
+        or over a shorter interval if it's the same size as the last file."""
+        dt = dt_min
         last_file_size = -1
-        while last_file_size != os.path.getsize(file_name): 
-            last_file_size = os.path.getsize(file_name)
+        file_size = os.path.getsize(file_name)
+        while file_size != last_file_size or (dt < dt_max and 
+                (file_size != self.last_size or file_size == 0)):
+            if file_size == last_file_size: # check again over a longer time
+                dt = min(2*dt, dt_max)
+            last_file_size = file_size
             time.sleep(dt) # deliberately add pause so we don't loop too many times
+            file_size = os.path.getsize(file_name)
+        self.last_size = file_size
             
     def sync_dexter(self, dt=1e-3):
-        """Get the Dexter file number from the dexter_sync_file_name file
-        Check if the file is empty (usually means it's being written)
-        and wait until it's finished being written to"""
-        new_dfn = '' # sometimes Dexter hasn't finished writing to file, we should wait til it has.
-        while new_dfn == '': # note: this usually takes about 10 ms.
-            with open(self.dexter_sync_file_name, 'r') as sync_file:
-                new_dfn = sync_file.read()
-            if new_dfn != '':
-                if self.dfn != str(int(new_dfn)):
-                    self.dfn = str(int(new_dfn))
-                else: # sometimes Dexter hasn't updated the file number yet
-                    self.dfn = str(int(new_dfn)+1)
-                break
-            time.sleep(dt) # deliberately add pause so we don't loop too many times
+        """Get the Dexter file number from the dexter_sync_file_name file.
+        The number is cached when the file changes, so the file is only 
+        read if it hasn't changed since the last image (see dexter_sync)."""
+        self.dfn = str(self.dexter.get(dt))
     
     
     def on_created(self, event):
-        """On a new image being written, save the file with a synced label into the 
-        image storage dir"""
+        """When a new file is created, wait until it has been written and then
+        process it. If the observer reports when files are closed then 
+        on_closed will process the file, otherwise poll the file size."""
         t0 = time.time()
         self.idle_t = t0 - self.end_t # duration between end of last event and start of current event
-        self.wait_for_file(event.src_path) # wait until file has been written        
-        self.write_t = time.time() - t0
+        try: # the creation time isn't available on Linux, so detect isn't recorded
+            t_created = creation_time(event.src_path)
+            if t_created is not None:
+                self.timer.add('detect', max(t0 - t_created, 0))
+        except OSError: pass # the file has already been removed
+        if self.close_events:
+            self.created[event.src_path] = t0
+        else:
+            self.wait_for_file(event.src_path) # wait until file has been written        
+            self.write_t = time.time() - t0
+            self.timer.add('wait for write', self.write_t)
+            self.process(event.src_path, t0)
+
+    def on_closed(self, event):
+        """A file has been closed after writing. If it's a new file then it
+        has finished being written, so process it."""
+        if event.event_type != EVENT_TYPE_CLOSED: # e.g. closed without writing
+            return
+        t0 = self.created.pop(event.src_path, None)
+        if t0 is not None: # ignore files that weren't created since the last event
+            self.write_t = time.time() - t0
+            self.timer.add('wait for write', self.write_t)
+            self.process(event.src_path, t0)
+
+    def process(self, src_path, t0):
+        """Save the new image with a synced label into the image storage dir,
+        delete the original, and emit the new file path. t0 is the time 
+        that the file was created."""
         # get Dexter file number  
+        t1 = time.time()
         self.sync_dexter()
-        # copy file with labeling: [date]_[Dexter file #]
-        new_file_name = os.path.join(self.image_storage_path,
-                self.date+'_'+self.dfn+'.'+event.src_path.split(".")[-1])
+        self.timer.add('dexter sync', time.time() - t1)
+        # move file with labeling: [date]_[Dexter file #]
         self.copy_t = time.time()
-        if os.path.isfile(new_file_name): # don't overwrite files
-            new_file_name = os.path.join(self.image_storage_path, 
-                self.date+'_'+self.dfn+'_'+str(self.nfn)+'.'+event.src_path.split(".")[-1])
-            self.nfn += 1 # always a unique number
-        try:
-            shutil.copyfile(event.src_path, new_file_name)
-        except PermissionError:
-            print("WARNING: added a pause because python tried to access the file before the other program had let go")
-            time.sleep(0.2)
-            shutil.copyfile(event.src_path, new_file_name)
-        self.wait_for_file(new_file_name) # wait until the file has been copied
+        data = retry(read_bytes, src_path) if self.send_bytes else None
+        new_file_name, data = self.move_file(src_path, data)
         self.copy_t = time.time() - self.copy_t
-        try:
-            os.remove(event.src_path)  # delete the old file so that we can see a new created file event
-        except PermissionError:
-            print("WARNING: added a pause because python tried to access the file before the other program had let go")
-            time.sleep(0.2)
-            os.remove(event.src_path)
+        self.timer.add('copy', self.copy_t)
         self.last_event_path = new_file_name  # update last event path
         self.event_path.emit(new_file_name)  # emit signal
+        self.event_data.emit(new_file_name, data)
         self.end_t = time.time()       # time at end of current event
         self.event_t = self.end_t - t0 # duration of event
+
+    def new_file_name(self, src_path):
+        """Return the name to save the file as in the image storage 
+        directory, labelled [date]_[Dexter file #]. If that file already
+        exists then append a unique number."""
+        new_file_name = os.path.join(self.image_storage_path,
+                self.date+'_'+self.dfn+'.'+src_path.split(".")[-1])
+        if os.path.isfile(new_file_name): # don't overwrite files
+            new_file_name = os.path.join(self.image_storage_path, 
+                self.date+'_'+self.dfn+'_'+str(self.nfn)+'.'+src_path.split(".")[-1])
+            self.nfn += 1 # always a unique number
+        return new_file_name
+
+    def move_file(self, src_path, data=None, max_tries=10):
+        """Move the file so that a new file with the same name can be created.
+        If the storage directory is on the same file system then make a hard
+        link to the file, which doesn't copy any data, and delete the 
+        original. Otherwise, read the file once, write the copy, and delete 
+        the original. A link is used rather than renaming the file because 
+        watchdog holds back events for a while after a file is moved out of 
+        the directory. Files in the storage directory are never overwritten:
+        if the new name is taken then try another unique name, up to 
+        max_tries times, after which the file is left where it is. data is 
+        the contents of the file if it has already been read. Return the new 
+        file name and the bytes read, or None if the file was linked 
+        without reading it."""
+        for i in range(max_tries):
+            new_file_name = self.new_file_name(src_path)
+            try:
+                data = self.link_or_copy(src_path, new_file_name, data)
+            except FileExistsError: # e.g. the nfn was used in an earlier session
+                continue
+            retry(os.remove, src_path) # delete the old file so that we can see a new created file event
+            return new_file_name, data
+        print("WARNING: could not find a unique name in " + self.image_storage_path +
+            " so " + src_path + " was not moved")
+        return src_path, data
+
+    def link_or_copy(self, src_path, new_file_name, data=None):
+        """Make a hard link to the file, or copy it if that isn't possible.
+        Raise FileExistsError if new_file_name already exists. The link 
+        is only tried once, since errors like different file systems won't
+        go away by waiting. Return the bytes read, or data if the file 
+        was linked."""
+        if self.same_fs:
+            try:
+                os.link(src_path, new_file_name)
+                return data
+            except FileExistsError:
+                raise
+            except PermissionError: pass # the other program might not have let go yet
+            except OSError: # e.g. different file systems or no hard links
+                self.same_fs = False # copy from now on
+        if data is None:
+            data = retry(read_bytes, src_path)
+        retry(write_bytes, new_file_name, data, 'xb')
+        return data
         
 ####    ####    ####    ####   
 
@@ -115,20 +349,18 @@ class silent_event_handler(system_event_handler):
     to the file as a signal. This silent event handler does not copy or delete
     files, merely emit the event path."""
     event_path = pyqtSignal(str)
+    event_data = pyqtSignal(str, object) # file path, contents or None
     
     def __init__(self, image_storage_path, dexter_sync_file_name, date):
         # same init as the base system event handler
         system_event_handler.__init__(self, image_storage_path, dexter_sync_file_name, date)   
 
-    def on_created(self, event):
-        """On a new image being written, save the file with a synced label into the 
-        image storage dir"""
-        t0 = time.time()
-        self.idle_t = t0 - self.end_t # duration between end of last event and start of current event
-        self.wait_for_file(event.src_path) # wait until file has been written        
-        self.write_t = time.time() - t0
-        self.last_event_path = event.src_path  # update last event path
-        self.event_path.emit(event.src_path)  # emit signal
+    def process(self, src_path, t0):
+        """Emit the path of the new image without moving it. t0 is the time
+        that the file was created."""
+        self.last_event_path = src_path  # update last event path
+        self.event_path.emit(src_path)  # emit signal
+        self.event_data.emit(src_path, None) # the file wasn't read
         self.end_t = time.time()       # time at end of current event
         self.event_t = self.end_t - t0 # duration of event
 
@@ -177,9 +409,18 @@ class dir_watcher(QThread):
                                 self.dexter_sync_file_name, self.date[0]+self.date[1]+self.date[3])
             # create image storage directory by date if it doesn't already exist
             os.makedirs(self.image_storage_path, exist_ok=True) # requies version > 3.2
+            # process files once they're closed if the observer reports it
+            self.event_handler.close_events = (InotifyObserver is not None 
+                                and isinstance(self.observer, InotifyObserver))
+            self.event_handler.dexter.close_events = self.event_handler.close_events
             # initiate observer, don't recursively search directories within the image_read_path
             self.observer.schedule(self.event_handler, self.image_read_path, recursive=False)
             self.observer.start()
+            try: # cache the Dexter file number when the sync file changes
+                self.observer.schedule(self.event_handler.dexter, 
+                    os.path.dirname(os.path.abspath(self.dexter_sync_file_name)), recursive=False)
+            except Exception as e: # read the sync file for every image instead
+                print("WARNING: could not watch the Dexter sync file for changes\n" + str(e))
     
     @staticmethod # static method can be accessed without making an instance of the class
     def get_dirs(config_file='./config/config.dat'):
@@ -3,9 +3,10 @@ Stefan Spence 15/04/19
 
 class to fit a Poissonian or Gaussian to a given set of data
 """
+import time
 import numpy as np
 from scipy.optimize import curve_fit
-from scipy.special import factorial
+from scipy.special import factorial, gammaln
 
 class fit:
     """Collection of common functions for theoretical fits.
@@ -65,4 +66,305 @@ class fit:
                                 maxfev=80000)
         self.ps = popt
         self.perrs = np.sqrt(np.diag(pcov))
-    
\ No newline at end of file
+    
+
+####    ####    ####    ####
+
+class multi_gauss:
+    """Fit the sum of n Gaussians to several histograms at once.
+
+    The parameters for each histogram are [A1, x1, sig1, A2, x2, sig2, ...]
+    as in fit.gauss. The histograms are padded to the same length so that a 
+    Levenberg-Marquardt least squares fit with the analytic Jacobian can
+    take a step for all of them together with numpy. The fit starts from
+    the best of an estimate from the moments of each peak and, if the 
+    same number of histograms was fitted last time, the previous best fit
+    parameters (the amplitudes are refitted since the number of counts 
+    and bins change between histograms). Iterations stop when the sum of
+    squared residuals stops improving, after max_iter steps, or after
+    max_t seconds, so that a bad histogram can't stall the GUI.
+    Keyword arguments:
+    n        -- number of Gaussian peaks in each histogram.
+    max_iter -- maximum number of iterations.
+    max_t    -- maximum time in seconds to spend iterating.
+    tol      -- stop when the fractional improvement is smaller than this."""
+    def __init__(self, n=2, max_iter=200, max_t=0.05, tol=1e-6):
+        self.n = n
+        self.max_iter = max_iter
+        self.max_t = max_t
+        self.tol = tol
+        self.ps = None      # best fit parameters from the last fit, shape (histograms, 3n)
+        self.perrs = None   # errors in the best fit parameters
+        self.success = None # whether each fit succeeded
+        self.iterations = 0 # number of iterations taken in the last fit
+
+    def model(self, x, ps):
+        """Return the sum of Gaussians with parameters ps (shape (K, 3n))
+        evaluated at x (shape (K, N))."""
+        A, x0, sig = ps[:,0::3,None], ps[:,1::3,None], ps[:,2::3,None]
+        return np.sum(A * np.exp(-(x[:,None,:] - x0)**2 / sig**2 / 2), axis=1)
+
+    def jacobian(self, x, ps):
+        """Return the model and its derivatives with respect to each of the
+        parameters, with shapes (K, N) and (K, 3n, N)."""
+        A, x0, sig = ps[:,0::3,None], ps[:,1::3,None], ps[:,2::3,None]
+        dx = (x[:,None,:] - x0) / sig
+        g = np.exp(-dx**2 / 2)
+        J = np.empty((np.size(x,0), 3*self.n, np.size(x,1)))
+        J[:,0::3] = g               # d/dA
+        J[:,1::3] = A * g * dx / sig # d/dx0
+        J[:,2::3] = J[:,1::3] * dx   # d/dsig
+        return np.sum(A * g, axis=1), J
+
+    def cost(self, x, y, w, ps):
+        """Return the sum of squared residuals for each histogram"""
+        return np.sum(w * (y - self.model(x, ps))**2, axis=1)
+
+    def estimate(self, x, y, split=None):
+        """Estimate the parameters for one histogram by splitting it into n
+        parts and taking the moments of each part. split is a list of the
+        n-1 values of x to split at (e.g. the threshold), otherwise split
+        into equal ranges of x."""
+        if split is None:
+            split = np.linspace(x[0], x[-1], self.n + 1)[1:-1]
+        edges = np.concatenate(([-np.inf], np.sort(np.atleast_1d(split)), [np.inf]))
+        p0 = []
+        for i in range(self.n):
+            part = (x >= edges[i]) & (x < edges[i+1])
+            xp, yp = x[part], np.clip(y[part], 0, None)
+            if np.sum(yp) > 0:
+                mu = np.sum(xp*yp) / np.sum(yp)
+                sig = np.sqrt(np.sum(yp*(xp - mu)**2) / np.sum(yp))
+                p0 += [np.max(yp), mu, max(sig, abs(x[1] - x[0]))]
+            else: # put a small peak in the middle of this part
+                p0 += [np.max(y)*0.01 + 1e-9, np.mean(x[part]) if np.any(part) else x[0], abs(x[-1] - x[0])/4.]
+        return np.array(p0, dtype=float)
+
+    def amplitudes(self, x, y, w, ps):
+        """Return ps with the amplitudes replaced by the linear least squares
+        best fit for the given centres and widths."""
+        ps = ps.copy()
+        G = self.jacobian(x, ps)[1][:,0::3] * w[:,None,:] # each Gaussian with amplitude 1
+        GTG = np.matmul(G, G.transpose(0,2,1)) + 1e-12*np.eye(self.n)
+        GTy = np.matmul(G, (w*y)[...,None])[...,0]
+        try:
+            ps[:,0::3] = np.linalg.solve(GTG, GTy[...,None])[...,0]
+        except np.linalg.LinAlgError:
+            pass # keep the previous amplitudes
+        return ps
+
+    def fit(self, xs, ys, split=None, p0=None):
+        """Fit the sum of n Gaussians to each of the histograms with bin 
+        centres xs[k] and occupancies ys[k]. split[k] is passed to estimate,
+        and p0[k] can be given as the initial guess instead. Return the 
+        best fit parameters and their errors as arrays with shape 
+        (histograms, 3n), with the peaks in order of increasing centre, and 
+        a boolean array that is True where the fit succeeded."""
+        K, p = len(xs), 3*self.n
+        sizes = np.array([np.size(xk) for xk in xs])
+        x, y, w = np.zeros((K, max(sizes))), np.zeros((K, max(sizes))), np.zeros((K, max(sizes)))
+        for k in range(K): # pad with zero weight so the histograms can be stacked
+            x[k], y[k,:sizes[k]], w[k,:sizes[k]] = xs[k][-1], ys[k], 1
+            x[k,:sizes[k]] = xs[k]
+        lo = np.array([np.min(xk) for xk in xs])
+        span = np.array([np.ptp(xk) for xk in xs]) + 1e-12
+        if p0 is not None:
+            ps = np.array(p0, dtype=float).reshape(K, p)
+            cost = self.cost(x, y, w, ps)
+        else: # multi-start: try several ways of splitting up the peaks
+            splits = [None if split is None else [split[k] for k in range(K)]] + [
+                [lo[k] + span[k]*np.arange(1, self.n)*f for k in range(K)]
+                for f in np.linspace(0, 1, self.n + 3)[1:-1]/(self.n - 1 or 1)]
+            ps, cost = None, None
+            for sp in splits:
+                trial = np.array([self.estimate(np.asarray(xs[k], dtype=float), 
+                    np.asarray(ys[k], dtype=float), None if sp is None else sp[k]) for k in range(K)])
+                trial_cost = self.cost(x, y, w, trial)
+                if ps is None:
+                    ps, cost = trial, trial_cost
+                else:
+                    better = trial_cost < cost
+                    ps[better], cost[better] = trial[better], trial_cost[better]
+                if self.n == 1:
+                    break # there's only one way to split
+            if self.ps is not None and np.shape(self.ps) == ps.shape:
+                warm = self.amplitudes(x, y, w, self.ps) # start from the last fit
+                warm_cost = self.cost(x, y, w, warm)
+                better = self.success & (warm_cost < cost)
+                ps[better], cost[better] = warm[better], warm_cost[better]
+        lam = np.full(K, 1e-3)        # damping for each histogram
+        done = ~np.isfinite(cost)     # histograms that have finished
+        t0 = time.time()
+        it = 0 # number of iterations taken
+        for it in range(self.max_iter):
+            if done.all() or time.time() - t0 > self.max_t:
+                break
+            act = np.flatnonzero(~done)
+            f, J = self.jacobian(x[act], ps[act])
+            J *= w[act][:,None,:]
+            JTJ = np.matmul(J, J.transpose(0,2,1))
+            g = np.matmul(J, ((y[act] - f) * w[act])[...,None])[...,0]
+            D = np.maximum(np.diagonal(JTJ, axis1=1, axis2=2), 1e-12)
+            try:
+                step = np.linalg.solve(JTJ + lam[act,None,None]*D[:,:,None]*np.eye(p),
+                                        g[...,None])[...,0]
+            except np.linalg.LinAlgError: # singular for at least one histogram
+                step = np.array([np.linalg.lstsq(JTJ[i] + lam[k]*np.diag(D[i]), g[i], rcond=None)[0]
+                                for i, k in enumerate(act)])
+            new = ps[act] + step
+            new_cost = self.cost(x[act], y[act], w[act], new)
+            # keep the peaks close to the range of the histogram
+            inside = np.all((np.abs(new[:,1::3] - lo[act,None] - span[act,None]/2) < span[act,None]) 
+                & (np.abs(new[:,2::3]) < span[act,None]) & (new[:,2::3] != 0), axis=1)
+            better = inside & (new_cost < cost[act])
+            converged = better & (cost[act] - new_cost <= self.tol * cost[act])
+            ps[act[better]] = new[better]
+            lam[act[better]] /= 10
+            lam[act[~better]] *= 10
+            cost[act[better]] = new_cost[better]
+            done[act[converged | (lam[act] > 1e10) | (cost[act] == 0)]] = True
+        else: # used every iteration
+            it = self.max_iter
+        self.iterations = it
+        ps[:,2::3] = np.abs(ps[:,2::3]) # the width only appears squared
+        # errors from the covariance matrix, like curve_fit with no sigma
+        J = self.jacobian(x, ps)[1] * w[:,None,:]
+        JTJ = np.matmul(J, J.transpose(0,2,1))
+        perrs = np.full((K, p), np.inf)
+        for k in range(K):
+            if sizes[k] > p:
+                try:
+                    perrs[k] = np.sqrt(np.abs(np.diag(np.linalg.inv(JTJ[k]))) * cost[k] / (sizes[k] - p))
+                except np.linalg.LinAlgError:
+                    pass # singular, so the errors are infinite
+        # put the peaks in order of their centres
+        order = np.argsort(ps[:,1::3], axis=1)
+        idx = (3*order[:,:,None] + np.arange(3)).reshape(K, p)
+        ps, perrs = np.take_along_axis(ps, idx, 1), np.take_along_axis(perrs, idx, 1)
+        self.success = (np.all(np.isfinite(ps), axis=1) & np.isfinite(cost) & (sizes > p)
+                    & np.all(ps[:,2::3] > 0, axis=1))
+        self.ps, self.perrs = ps, perrs
+        return ps, perrs, self.success
+
+####    ####    ####    ####
+
+class mixture_em:
+    """Maximum likelihood fit of a background and a signal peak to the 
+    counts themselves, without binning them into a histogram.
+
+    The peaks are either Gaussian or Poissonian (like fit.poisson, but the
+    log of the probability is used so that large counts don't overflow).
+    The fit uses expectation maximisation: the responsibility of each peak
+    for each count is calculated from the current parameters, then the
+    parameters are updated from the sufficient statistics: the sums of
+    the responsibilities r, r*x, and r*x^2 for each peak. Since the sums
+    are kept, a new count can be added in constant time by adding its
+    responsibilities to the sums (incremental EM). The responsibilities
+    of the old counts aren't updated, so call fit() again now and then 
+    to get the exact maximum likelihood.
+    Keyword arguments:
+    dist     -- 'gauss' or 'poisson' for the shape of the peaks.
+    offset   -- for 'poisson', the counts are offset + a Poissonian number,
+                e.g. the bias from the EMCCD.
+    max_iter -- maximum number of iterations for fit().
+    tol      -- stop when the log likelihood per count improves by less 
+                than this."""
+    def __init__(self, dist='gauss', offset=0, max_iter=200, tol=1e-9):
+        self.dist = dist
+        self.offset = offset
+        self.max_iter = max_iter
+        self.tol = tol
+        self.reset()
+
+    def reset(self):
+        """Forget the parameters and the sufficient statistics"""
+        self.ps = None              # [weight, mean, standard deviation] for each peak
+        self.sums = np.zeros((3,2)) # sums of r, r*x, r*x^2 for each peak
+        self.loglike = -np.inf      # log likelihood from the last full fit
+        self.iterations = 0         # number of iterations in the last full fit
+
+    def log_density(self, x):
+        """Return the log of the probability density of each peak at x, 
+        with shape (size of x, 2)."""
+        x = np.asarray(x, dtype=float).reshape(-1,1)
+        mu, sig = self.ps[:,1], self.ps[:,2]
+        if self.dist == 'poisson':
+            k = np.clip(x - self.offset, 0, None)
+            lam = np.clip(mu - self.offset, 1e-12, None)
+            return k*np.log(lam) - lam - gammaln(k + 1)
+        return -0.5*((x - mu)/sig)**2 - np.log(sig) - 0.5*np.log(2*np.pi)
+
+    def responsibilities(self, x):
+        """Return the probability that each count belongs to each peak with
+        shape (size of x, 2), and the log likelihood of the counts."""
+        lp = self.log_density(x) + np.log(np.clip(self.ps[:,0], 1e-300, None))
+        top = np.max(lp, axis=1, keepdims=True)
+        total = top + np.log(np.sum(np.exp(lp - top), axis=1, keepdims=True))
+        return np.exp(lp - total), np.sum(total)
+
+    def stats(self, x, r):
+        """Return the sufficient statistics of counts x with responsibilities r"""
+        x = np.asarray(x, dtype=float).ravel()
+        return np.array([np.sum(r, axis=0), x.dot(r), (x**2).dot(r)])
+
+    def m_step(self):
+        """Update the parameters from the sufficient statistics"""
+        n = np.clip(self.sums[0], 1e-12, None)
+        mu = self.sums[1] / n
+        if self.dist == 'poisson':
+            sig = np.sqrt(np.clip(mu - self.offset, 1e-12, None))
+        else: # don't let a peak collapse onto a single count
+            sig = np.sqrt(np.clip(self.sums[2]/n - mu**2, 0.25, None))
+        self.ps = np.array([n / np.sum(n), mu, sig]).T
+
+    def estimate(self, x, thresh=None):
+        """Guess the parameters by splitting the counts at thresh (or at 
+        the midpoint of the range) and taking the moments of each side."""
+        x = np.asarray(x, dtype=float).ravel()
+        if thresh is None or not x.min() < thresh <= x.max():
+            thresh = 0.5*(x.min() + x.max())
+        r = np.array([x < thresh, x >= thresh], dtype=float).T
+        r = 0.98*r + 0.01 # so that neither side is empty
+        self.sums = self.stats(x, r)
+        self.m_step()
+        return self.ps
+
+    def fit(self, counts, thresh=None, p0=None):
+        """Fit the peaks to all of the counts. Start from p0 if it's given, 
+        otherwise the current parameters, otherwise estimate them by 
+        splitting the counts at thresh. Return the parameters with shape 
+        (2,3): [weight, mean, standard deviation] for the background then
+        signal peak."""
+        x = np.asarray(counts, dtype=float).ravel()
+        if p0 is not None:
+            self.ps = np.array(p0, dtype=float).reshape(2,3)
+        elif self.ps is None:
+            self.estimate(x, thresh)
+        loglike = -np.inf
+        i = -1 # in case max_iter is 0
+        for i in range(self.max_iter):
+            r, self.loglike = self.responsibilities(x)
+            self.sums = self.stats(x, r)
+            self.m_step()
+            if self.loglike - loglike < self.tol * np.size(x):
+                break
+            loglike = self.loglike
+        self.iterations = i + 1
+        self.order()
+        return self.ps
+
+    def add(self, counts):
+        """Add new counts to the sufficient statistics and update the 
+        parameters. Each count takes constant time, regardless of how 
+        many have been added before."""
+        if self.ps is None:
+            return # need a fit to start from
+        r, _ = self.responsibilities(counts)
+        self.sums += self.stats(counts, r)
+        self.m_step()
+        self.order()
+
+    def order(self):
+        """Make sure that the background peak is first"""
+        if self.ps[0,1] > self.ps[1,1]:
+            self.ps, self.sums = self.ps[::-1], self.sums[:,::-1]
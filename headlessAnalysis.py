@@ -0,0 +1,291 @@
+"""Single Atom Image Analysis
+Stefan Spence 23/05/19
+
+ - run the directory watcher and image handlers without the GUI, so that
+   images can be analysed on a computer that doesn't have a display
+ - stream the results for each image (file #, counts and atom detected
+   for each ROI) to stdout, a csv file, or a binary .npy file
+ - periodically write the histogram statistics for each ROI
+
+Example: two ROIs in 512x512 images, saving the results to a csv file
+    python headlessAnalysis.py --roi 256,256,5 --roi 300,256,5 --out results.csv
+Use --help to see all of the options. Stop with Ctrl+C.
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import numpy as np
+from astropy.stats import binom_conf_interval
+try:
+    from PyQt4.QtCore import QCoreApplication, QTimer, Qt
+except ModuleNotFoundError:
+    from PyQt5.QtCore import QCoreApplication, QTimer, Qt
+import imageHandler as ih # process images to build up a histogram
+import directoryWatcher as dw # use watchdog to get file creation events
+import imagePipeline as ip # load and analyse new images in a worker thread
+import stageTimer as st # record the duration of each stage of processing
+
+# the columns of the periodic histogram statistics
+stats_header = ['Time', 'ROI', 'Number of images processed', 'Threshold',
+    'Loading probability', 'Error in Loading probability', 'Background peak count',
+    'Background peak width', 'Signal peak count', 'Signal peak width',
+    'Fidelity', 'Error in Fidelity']
+
+####    ####    ####    ####
+
+def hist_stats(im_han, auto_thresh=True):
+    """Return a list of the histogram statistics in stats_header (without
+    the time or ROI) for the image handler. If auto_thresh is True then
+    the threshold is set where the fidelity is max, otherwise keep it."""
+    if auto_thresh:
+        im_han.hist_and_thresh()
+    else:
+        im_han.histogram()
+    atom_count = im_han.class_stats.n[1] # images with counts above threshold
+    loading_prob = atom_count / im_han.im_num # fraction of images above threshold
+    # use the binomial distribution to get 1 sigma confidence intervals:
+    conf = binom_conf_interval(atom_count, im_han.im_num, interval='jeffreys')
+    load_err = 0.5*(conf[1] - conf[0])
+    if np.size(im_han.peak_counts) == 2:
+        peaks = [im_han.peak_counts[0], im_han.peak_widths[0],
+                im_han.peak_counts[1], im_han.peak_widths[1]]
+    else: # the peaks couldn't be found
+        peaks = [0, 0, 0, 0]
+    return [im_han.im_num, int(im_han.thresh), np.around(loading_prob, 4),
+            np.around(load_err, 4)] + list(map(int, peaks)) + [
+            im_han.fidelity, im_han.err_fidelity]
+
+class stream_analysis:
+    """Analyse new images from the directory watcher without a GUI.
+
+    The directory watcher puts new files in the image_pipeline's queue,
+    which loads them and calculates the statistics for every ROI in its
+    worker thread. When the pipeline emits the file path and its sequence
+    number, the results are added to an image_handler for each ROI and then
+    written out as a row: file #, then counts and atom detected for each 
+    ROI. Rows are written as csv text to stdout or a file, or if the output
+    file ends in .npy they're appended to a binary structured array (see
+    imageHandler.frame_archive). Every stats_every images the threshold
+    is updated from the histogram (unless fixed thresholds were given)
+    and the histogram statistics for each ROI are written. Atom detected
+    is 1 if counts >= threshold else 0, or -1 while the threshold for that
+    ROI hasn't been set from the histogram peaks.
+    Keyword arguments:
+    rois        -- list of ROIs [xc, yc, size], one for each histogram.
+    pic_size    -- number of pixels along each side of the image.
+    thresh      -- list of fixed thresholds for each ROI, or None to set
+        the thresholds automatically from the histograms.
+    out         -- file to write the results for each image to, or '-'
+        for stdout.
+    stats       -- file to write the histogram statistics to, or '-' for
+        stderr.
+    stats_every -- number of images between writing the statistics.
+    delim       -- delimiter used in the image files.
+    maxsize     -- maximum number of images waiting to be processed.
+    """
+    def __init__(self, rois, pic_size=512, thresh=None, out='-', stats='-',
+            stats_every=100, delim=' ', maxsize=10):
+        self.image_handler = [ih.image_handler(i, 'ROI%s '%i) for i in range(len(rois))]
+        for i, im_han in enumerate(self.image_handler):
+            im_han.pic_size = pic_size
+            im_han.delim = delim
+            im_han.set_roi(dimensions=rois[i])
+            if thresh is not None:
+                im_han.thresh = thresh[i]
+        self.auto_thresh = thresh is None
+        self.thresh_set = [not self.auto_thresh]*len(rois) # whether atom detected can be given for each ROI
+        self.stats_every = stats_every
+        self.frames = ih.frame_cache()   # loads each image once, shared with the pipeline
+        self.roi_engine = ih.roi_stats() # calculates the ROI statistics from an image
+        self.pipeline = ip.image_pipeline(self.image_handler, self.frames, maxsize)
+        self.row_dtype = np.dtype([('files', int)] + sum([[('counts%s'%i, float),
+            ('atom%s'%i, float)] for i in range(len(rois))], []))
+        self.out_name = out
+        self.binary = out.endswith('.npy') # otherwise write csv text
+        if self.binary:
+            self.out_file = None
+            self.archive = ih.frame_archive(out[:-4]) # for appending to .npy files
+            descr = repr(np.lib.format.dtype_to_descr(self.row_dtype))
+            self.archive.header_len = 64*((len(descr) + 191)//64) # room for the dtype and shape
+        else:
+            self.out_file = sys.stdout if out == '-' else open(out, 'a')
+            self.out_file.write('# File, ' + ', '.join('Counts ROI%s, Atom Detected ROI%s'%(i,i)
+                for i in range(len(rois))) + '\n')
+        self.stats_file = sys.stderr if stats == '-' else open(stats, 'a')
+        self.stats_file.write('# ' + ', '.join(stats_header) + '\n')
+        self.timer = st.stage_timer() # shared by the directory watcher and pipeline
+        self.pipeline.timer = self.timer
+        self.dir_watcher = None
+        self.max_images = 0 # stop after this many images, 0 for no limit
+        self.im_num = 0     # number of images processed
+
+    def start(self, config_file='./config/config.dat', active=True, archive=False):
+        """Start the image pipeline and the directory watcher. In active
+        mode the new images are moved into the image storage path. If
+        archive is True then the images are also added to a binary archive
+        in the image storage path, named by the date."""
+        self.pipeline.event_path.connect(self.process)
+        self.pipeline.start()
+        self.dir_watcher = dw.dir_watcher(config_file=config_file, active=active)
+        if not self.dir_watcher.image_storage_path:
+            raise FileNotFoundError('could not load the directories from ' + config_file)
+        # put new files in the queue from the watchdog thread
+        self.dir_watcher.event_handler.event_data.connect(self.pipeline.submit,
+                                                    type=Qt.DirectConnection)
+        self.dir_watcher.event_handler.timer = self.timer
+        self.dir_watcher.event_handler.sync_dexter() # get the current Dexter file number
+        if archive:
+            self.pipeline.archive = ih.frame_archive(os.path.join(
+                self.dir_watcher.image_storage_path, ''.join(
+                    [self.dir_watcher.date[0], self.dir_watcher.date[1], self.dir_watcher.date[3]])))
+        print('Directory watcher started in %s mode with settings:\n'%(
+            'active' if active else 'passive') + self.dir_watcher.print_dirs(
+            self.dir_watcher.dirs_dict.items()), file=sys.stderr)
+
+    def process(self, event_path, seq=None):
+        """Add the results for the new image to each image handler, then
+        write them out. Write the statistics every stats_every images."""
+        rois = [im_han.get_roi() for im_han in self.image_handler]
+        pic_size = self.image_handler[0].pic_size
+        try:
+            result = self.pipeline.take(seq, rois, pic_size)
+            if result is not None:
+                full_im, stats = result
+            else: # not processed by the pipeline
+                full_im = self.frames.load(event_path, pic_size, self.image_handler[0].delim)
+                stats = self.roi_engine.get_stats(full_im, rois)
+        except Exception as e:
+            print("WARNING: failed to process " + event_path + "\n" + str(e), file=sys.stderr)
+            return
+        t0 = time.time()
+        for im_han, roi_stats in zip(self.image_handler, stats):
+            im_han.process(event_path, full_im, roi_stats)
+        self.timer.add('add counts', time.time() - t0)
+        self.write_row()
+        self.im_num += 1
+        if self.im_num % self.stats_every == 0:
+            self.write_stats()
+        if self.max_images and self.im_num >= self.max_images:
+            QCoreApplication.quit()
+
+    def write_row(self):
+        """Write file #, counts, and atom detected for each ROI from the
+        last image processed."""
+        i = self.image_handler[0].im_num - 1
+        row = [self.image_handler[0].files[i]]
+        for im_han in self.image_handler:
+            row += [im_han.counts[i], int(im_han.counts[i] >= im_han.thresh) 
+                if self.thresh_set[im_han.i] else -1]
+        if self.binary:
+            self.archive.append_array(self.out_name, np.array(tuple(row), dtype=self.row_dtype))
+        else:
+            self.out_file.write('%d,'%row[0] + ','.join(map(str, row[1:])) + '\n')
+            self.out_file.flush() # so that it can be read while streaming
+
+    def write_stats(self):
+        """Write a row of histogram statistics for each ROI. With automatic
+        thresholds, atom detected is only given for the ROIs where both 
+        peaks were found, since otherwise the threshold is a placeholder."""
+        t = time.strftime('%H:%M:%S', time.localtime())
+        for im_han in self.image_handler:
+            if im_han.im_num > 0:
+                try:
+                    row = hist_stats(im_han, self.auto_thresh)
+                except Exception as e: # e.g. not enough images to find peaks
+                    print("WARNING: could not get histogram statistics for ROI%s\n"%im_han.i
+                        + str(e), file=sys.stderr)
+                    if self.auto_thresh:
+                        self.thresh_set[im_han.i] = False
+                    continue
+                if self.auto_thresh:
+                    self.thresh_set[im_han.i] = np.size(im_han.peak_counts) == 2
+                self.stats_file.write(', '.join([t, str(im_han.i)] + list(map(str, row))) + '\n')
+        self.stats_file.flush()
+
+    def stop(self):
+        """Stop the directory watcher, finish the files in the queue, then
+        write the final statistics and close the output files."""
+        if self.dir_watcher:
+            print(self.dir_watcher.event_handler.dexter.summary(), file=sys.stderr)
+            self.dir_watcher.observer.stop()
+            self.dir_watcher.observer.join()
+            self.dir_watcher = None
+        self.pipeline.stop()
+        QCoreApplication.processEvents() # results from the last files in the queue
+        if self.im_num % self.stats_every:
+            self.write_stats()
+        for f in [self.out_file, self.stats_file]:
+            if f is not None and f not in [sys.stdout, sys.stderr]:
+                f.close()
+        print('Processed %s images, dropped %s from a full queue'%(
+            self.im_num, self.pipeline.dropped), file=sys.stderr)
+        print(self.timer.summary('ms'), file=sys.stderr)
+
+####    ####    ####    ####
+
+def parse_args(argv=None):
+    """Get the settings from the command line arguments"""
+    parser = argparse.ArgumentParser(description=
+        'Analyse single atom images as they are saved, without the GUI.')
+    parser.add_argument('-c', '--config', default='./config/config.dat',
+        help='config file with the directories to use (default ./config/config.dat)')
+    parser.add_argument('--passive', action='store_true',
+        help="don't move new images into the image storage path")
+    parser.add_argument('--roi', action='append', required=True, metavar='XC,YC,SIZE',
+        help='ROI centre and size in pixels. Give --roi once for each histogram')
+    parser.add_argument('--pic-size', type=int, default=512,
+        help='number of pixels along each side of the image (default 512)')
+    parser.add_argument('--thresh', action='append', type=float,
+        help='fixed threshold for each ROI, otherwise set from the histogram')
+    parser.add_argument('--thresh-method', choices=['fidelity', 'roc'], default='fidelity',
+        help='set the threshold where the fidelity is max, or from the receiver operating characteristic (default fidelity)')
+    parser.add_argument('--fpr-max', type=float,
+        help='for --thresh-method roc, the max false positive rate (default: max TPR - FPR)')
+    parser.add_argument('--out', default='-',
+        help='file to write the results for each image to: .csv for text, .npy for binary (default stdout)')
+    parser.add_argument('--stats', default='-',
+        help='file to write the histogram statistics to (default stderr)')
+    parser.add_argument('--stats-every', type=int, default=100,
+        help='number of images between writing the statistics (default 100)')
+    parser.add_argument('--archive', action='store_true',
+        help='add each image to a binary archive in the image storage path')
+    parser.add_argument('--queue', type=int, default=10,
+        help='maximum number of images waiting to be processed (default 10)')
+    parser.add_argument('--max-images', type=int, default=0,
+        help='stop after this many images (default 0, no limit)')
+    args = parser.parse_args(argv)
+    try:
+        args.roi = [list(map(int, roi.split(','))) for roi in args.roi]
+    except ValueError:
+        parser.error('--roi must be three integers: XC,YC,SIZE')
+    if any(len(roi) != 3 for roi in args.roi):
+        parser.error('--roi must be three integers: XC,YC,SIZE')
+    if args.thresh is not None and len(args.thresh) != len(args.roi):
+        parser.error('give --thresh once for each --roi')
+    return args
+
+def run(argv=None):
+    """Run the analysis until Ctrl+C is pressed or max_images have been
+    processed. Qt's event loop passes the results from the pipeline's
+    thread, but a display isn't needed."""
+    args = parse_args(argv)
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+    sa = stream_analysis(args.roi, args.pic_size, args.thresh, args.out,
+            args.stats, args.stats_every, maxsize=args.queue)
+    sa.max_images = args.max_images
+    for im_han in sa.image_handler:
+        im_han.thresh_method, im_han.fpr_max = args.thresh_method, args.fpr_max
+    sa.start(args.config, not args.passive, args.archive)
+    signal.signal(signal.SIGINT, lambda *args: app.quit())
+    timer = QTimer() # let python handle Ctrl+C while Qt's event loop is running
+    timer.timeout.connect(lambda: None)
+    timer.start(200)
+    try:
+        app.exec_()
+    finally:
+        sa.stop()
+
+if __name__ == "__main__":
+    run()
@@ -10,28 +10,716 @@ region of zeros.
 Assuming that image files are ASCII.
 """
 import os
+import io
 import sys
 import numpy as np
 import time
-from scipy.signal import find_peaks
+import warnings
+from multiprocessing import Pool, cpu_count
+from scipy.signal import peak_prominences, peak_widths
 from scipy.stats import norm
 from astropy.stats import binom_conf_interval
+import fitCurve as fc
+
+def local_maxima(x):
+    """Return the indexes of the local maxima in the 1D array x, defined the
+    same as in scipy.signal.find_peaks: a peak is higher than the values 
+    on either side, and the index of a flat peak is the middle (rounded
+    down). Peaks at the ends of the array don't count."""
+    starts = np.flatnonzero(np.diff(x)) + 1 # indexes where the value changes
+    if np.size(starts) < 2:
+        return np.array([], dtype=np.intp)
+    vals = x[starts]  # value of each run of equal values after the first
+    ends = np.append(starts[1:], np.size(x)) - 1 
+    # a run is a peak if it's higher than the runs either side
+    prev = np.append(x[0], vals[:-1])
+    is_max = (vals[:-1] > prev[:-1]) & (vals[:-1] > vals[1:])
+    return ((starts[:-1] + ends[:-1]) // 2)[is_max].astype(np.intp)
+
+def select_by_distance(peaks, order, distance, limit=None):
+    """Return the indexes of the peaks to keep, where peaks closer than 
+    distance to a higher peak are removed. order is the argsort of the
+    peak heights. This is the same as the distance condition in 
+    scipy.signal.find_peaks. Stop once limit peaks have been kept."""
+    pos = peaks[order[::-1]] # positions starting from the highest peak
+    removed = np.zeros(np.size(pos), dtype=bool)
+    kept = []
+    while not removed.all() and (limit is None or len(kept) < limit):
+        i = np.argmin(removed) # highest peak that hasn't been removed
+        kept.append(order[::-1][i])
+        removed |= abs(pos - pos[i]) < distance
+    return np.sort(np.array(kept, dtype=np.intp))
 
 def est_param(h):
     """Generator function to estimate the parameters for a Guassian fit. 
-    Use scipy to find search for peaks. Assume first that the peaks have arbitrary
-    separation then increase the separation until there are only two peaks or less found.
+    Search for peaks the same way as scipy.signal.find_peaks. Assume first 
+    that the peaks have arbitrary separation then increase the separation 
+    until there are only two peaks or less found.
     Return the positions, heights, and widths of peaks.
-    The positions and widths are in terms of indexes in the input array."""
+    The positions and widths are in terms of indexes in the input array.
+    For speed, the local maxima are only found once, the search for each
+    separation stops once 3 peaks are kept, and the heights and widths 
+    are only calculated for the final peaks."""
+    x = np.asarray(h, dtype=float)
+    peaks = local_maxima(x)
+    order = np.argsort(x[peaks]) # priority of peaks in find_peaks
     d   = 1    # required minimal horizontal distance between neighbouring peaks
     inc = np.size(h)//500 * 5 + 1 # increment to increase distance by
-    num_peaks = 10
-    while num_peaks > 2:
-        peak_inds, properties = find_peaks(h, width=0, distance=d) # properties is a dict
-        num_peaks = np.size(peak_inds)
+    keep = select_by_distance(peaks, order, d, limit=3)
+    while np.size(keep) > 2:
         d += inc   # increase the width of the peaks we're searching for
+        keep = select_by_distance(peaks, order, d, limit=3)
+    peak_inds = peaks[keep]
+    prominences, left_bases, right_bases = peak_prominences(x, peak_inds)
+    widths = peak_widths(x, peak_inds, rel_height=0.5, 
+                prominence_data=(prominences, left_bases, right_bases))[0]
+    return peak_inds, prominences, widths
+
+def gauss_crossing(mu1, sig1, mu2, sig2):
+    """Return the position between the centres mu1 < mu2 where two normal 
+    distributions with standard deviations sig1 and sig2 have the same 
+    probability density. Since the fidelity is the difference of their
+    cumulative distribution functions, this is where the fidelity is max.
+    Return None if there isn't a crossing between the centres."""
+    if sig1 <= 0 or sig2 <= 0 or mu2 <= mu1:
+        return None
+    # equate the exponents: (x-mu1)^2/sig1^2 + 2ln(sig1) = (x-mu2)^2/sig2^2 + 2ln(sig2)
+    a = 1/sig1**2 - 1/sig2**2
+    b = 2*(mu2/sig2**2 - mu1/sig1**2)
+    c = mu1**2/sig1**2 - mu2**2/sig2**2 + 2*np.log(sig1/sig2)
+    if abs(a) < 1e-12 * (1/sig1**2 + 1/sig2**2): # equal widths: midpoint
+        roots = [-c/b]
+    elif b**2 - 4*a*c < 0:
+        return None
+    else:
+        roots = (-b + np.array([1,-1])*np.sqrt(b**2 - 4*a*c)) / 2 / a
+    roots = [x for x in roots if mu1 < x < mu2]
+    return roots[0] if roots else None
+
+def load_asc(im_name, pic_size, delim=' ', data=None):
+    """Load an ASCII image file where the first column of each row is the
+    row number and return the next pic_size columns as a float array.
+    The file is read in one go and parsed by np.fromstring as integers, 
+    which is much faster than np.loadtxt. np.fromstring doesn't see rows,
+    so the fast path is only used if every row has ncols values separated 
+    by a single delim, with no other whitespace (see regular_rows). 
+    Otherwise, or if the file contains non-integer values, fall back to
+    np.loadtxt, so that the returned array is always the same as 
+    np.loadtxt would give, including raising an error for bad rows and
+    returning a 1D array for a single row.
+    Keyword arguments:
+    im_name  -- absolute path to the image file
+    pic_size -- the number of columns of pixels to take from each row
+    delim    -- delimiter between values in a row
+    data     -- the contents of the file as bytes if it's already been 
+        read (e.g. by the directory watcher), so the file isn't opened"""
+    if data is None:
+        with open(im_name, 'rb') as f:
+            data = f.read()
+    nl = data.find(b'\n')
+    ncols = len(data[:nl if nl >= 0 else None].split()) # includes row number
+    if ncols > pic_size:
+        nrows = regular_rows(data, delim, ncols)
+        if nrows:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore') # older numpy warns if it stops early
+                    vals = np.fromstring(data, dtype=np.int64, sep=delim)
+            except ValueError: # newer numpy raises if it can't parse to the end
+                vals = np.array([])
+            if np.size(vals) == nrows * ncols: # no empty values, and older numpy didn't stop early
+                # np.loadtxt squeezes out dimensions of length 1
+                return np.squeeze(vals.reshape(nrows, ncols)[:, 1:pic_size+1].astype(float))
+    return np.loadtxt(io.BytesIO(data), delimiter=delim, usecols=range(1,pic_size+1))
+
+def regular_rows(data, delim, ncols):
+    """Return the number of rows in data (bytes) if every row has ncols - 1
+    delims, otherwise return 0. Rows end in \\n or \\r\\n, and newlines 
+    at the end are ignored. Any other whitespace (e.g. tabs when delim is 
+    ' ') gives 0. Then each row has at most ncols values, so if there are
+    nrows*ncols values in total there are no empty values or blank lines,
+    which np.fromstring would skip but np.loadtxt wouldn't."""
+    d = delim.encode()
+    body = data.rstrip(b'\r\n')
+    if len(d) != 1 or not body:
+        return 0
+    if b'\r' in body and body.count(b'\r') != body.count(b'\r\n'):
+        return 0
+    if any(ws != d and ws in body for ws in [b' ', b'\t', b'\x0b', b'\x0c']):
+        return 0
+    rows = body.split(b'\n')
+    if any(row.count(d) != ncols - 1 for row in rows):
+        return 0
+    return len(rows)
+
+def file_number(im_name):
+    """Return the Dexter file number from the image file name, using the 
+    naming convention: [Species]_[date]_[Dexter file #].asc
+    Return -1 if the file name doesn't end in a file number."""
+    try:
+        return int(im_name.split("_")[-1].split(".")[0])
+    except ValueError:
+        return -1
+
+class frame_cache:
+    """Keep the most recently loaded image so that it is only decoded once, 
+    however many image handlers or displays use it. The image is identified 
+    by its file name, modification time, and size, so that a new image 
+    saved with the same file name (e.g. by the passive directory watcher) 
+    is still reloaded. The identifier and image are replaced together, so
+    the cache can be shared between threads."""
+    def __init__(self):
+        self.last = (None, np.array([])) # identifier and array of the last image loaded
+
+    def load(self, im_name, pic_size, delim=' ', data=None):
+        """Return the array from the image file im_name, only reading the 
+        file if it's different from the last one loaded. If data is given
+        then it's the contents of the file, so the file isn't read, and it's
+        always decoded since the file could have been replaced since."""
+        st = os.stat(im_name)
+        key = (im_name, st.st_mtime_ns, st.st_size, pic_size)
+        last_key, im_vals = self.last
+        if key != last_key or data is not None:
+            im_vals = load_asc(im_name, pic_size, delim, data)
+            self.last = (key, im_vals)
+        return im_vals
+
+class roi_stats:
+    """Calculate statistics for several ROIs in an image at once.
+
+    Each ROI is given as [xc, yc, size] and covers the square 
+    xc - size//2 : xc - size//2 + size, yc - size//2 : yc - size//2 + size.
+    The background statistics outside of each ROI come from the sums over
+    the full image minus the sums over the ROI, so the full image is never
+    copied. There are two ways to get the ROI sums:
+     - gather the pixels of all of the ROIs into one buffer using flattened 
+        indexes, then sum them for each ROI with np.bincount.
+     - fill summed-area tables (integral images) of the counts and squared 
+        counts, then the sum over each ROI only needs the 4 corner values.
+    Making the summed-area tables takes several passes over the image, so
+    they are only used when the ROIs contain more pixels than the image.
+    The buffers are reused while the ROIs and image shape stay the same."""
+    def __init__(self):
+        self.key = None             # the ROIs and image shape used for indexes
+        self.corners = np.zeros((4,0), dtype=int) # x0, x1, y0, y1 of each ROI
+        self.sizes = np.array([], dtype=int)  # number of pixels in each ROI
+        self.use_sat = False        # whether to use summed-area tables
+        self.idx = np.array([], dtype=int)    # flattened indexes of ROI pixels
+        self.labels = np.array([], dtype=int) # which ROI each index belongs to
+        self.buf  = np.array([])    # buffer for the gathered ROI pixels
+        self.sat  = np.zeros((1,1)) # summed-area table of counts
+        self.sat2 = np.zeros((1,1)) # summed-area table of squared counts
+        self.tmp  = np.zeros((0,0)) # buffer for the cumulative sum along rows
+        self.sq   = np.zeros((0,0)) # buffer for the squared counts
+
+    def set_rois(self, rois, shape):
+        """Calculate the corners and pixel indexes of each of the rois for 
+        an image with the given shape, and make the buffers to use."""
+        corners = []
+        for xc, yc, l in rois:
+            # use the same pixels that slicing the image would give
+            x0, x1, _ = slice(xc - l//2, xc - l//2 + l).indices(shape[0])
+            y0, y1, _ = slice(yc - l//2, yc - l//2 + l).indices(shape[1])
+            corners.append([x0, max(x0, x1), y0, max(y0, y1)])
+        self.corners = np.array(corners, dtype=int).reshape(-1, 4).T
+        x0, x1, y0, y1 = self.corners
+        self.sizes = (x1 - x0) * (y1 - y0)
+        # gathering pixels takes longer than integrating once there are more
+        self.use_sat = np.sum(self.sizes) > shape[0]*shape[1]
+        if self.use_sat:
+            if self.sat.shape != (shape[0]+1, shape[1]+1):
+                self.sat  = np.zeros((shape[0]+1, shape[1]+1))
+                self.sat2 = np.zeros((shape[0]+1, shape[1]+1))
+                self.tmp  = np.zeros(shape)
+                self.sq   = np.zeros(shape)
+        else:
+            self.idx = np.concatenate([np.zeros(0, dtype=int)] + [
+                (np.arange(x0[i], x1[i])[:,None]*shape[1] + np.arange(y0[i], y1[i])).ravel()
+                for i in range(len(rois))])
+            self.labels = np.repeat(np.arange(len(rois)), self.sizes)
+            self.buf = np.zeros(np.size(self.idx))
+        self.key = (tuple(map(tuple, rois)), shape)
+
+    def integrate(self, full_im):
+        """Fill the summed-area tables with the cumulative sums of full_im
+        and full_im**2. The first row and column of the tables stay 0."""
+        np.cumsum(full_im, axis=1, out=self.tmp)
+        np.cumsum(self.tmp, axis=0, out=self.sat[1:,1:])
+        np.multiply(full_im, full_im, out=self.sq)
+        np.cumsum(self.sq, axis=1, out=self.tmp)
+        np.cumsum(self.tmp, axis=0, out=self.sat2[1:,1:])
+
+    def corner_sums(self, table):
+        """Return the sum over each ROI from a summed-area table"""
+        x0, x1, y0, y1 = self.corners
+        return table[x1,y1] - table[x0,y1] - table[x1,y0] + table[x0,y0]
+
+    def roi_sums(self, full_im):
+        """Return the sums of the counts and the squared counts in each ROI"""
+        if self.use_sat:
+            self.integrate(full_im)
+            return self.corner_sums(self.sat), self.corner_sums(self.sat2)
+        n = np.size(self.sizes)
+        np.take(full_im, self.idx, out=self.buf) # pixels in all of the ROIs
+        sums = np.bincount(self.labels, self.buf, n)
+        np.multiply(self.buf, self.buf, out=self.buf)
+        return sums, np.bincount(self.labels, self.buf, n)
+
+    def get_stats(self, full_im, rois):
+        """Return an array with a row for each of the rois containing:
+        integrated counts in the ROI, the count at the ROI centre, the mean
+        and standard deviation of the counts outside of the ROI, and the 
+        x and y position of the max pixel in the image."""
+        rois = [list(map(int, roi)) for roi in rois]
+        if (tuple(map(tuple, rois)), full_im.shape) != self.key:
+            self.set_rois(rois, full_im.shape)
+        counts, squares = self.roi_sums(full_im)
+        flat = full_im.ravel()
+        N = np.size(flat) - self.sizes  # number of background pixels
+        mean = (np.sum(flat) - counts) / N
+        var = (np.dot(flat, flat) - squares - N*mean**2) / (N - 1)
+        stats = np.zeros((len(rois), 6))
+        stats[:,0] = counts  # integrated counts
+        stats[:,1] = full_im[[r[0] for r in rois], [r[1] for r in rois]] # centre
+        stats[:,2] = mean
+        stats[:,3] = np.sqrt(np.maximum(var, 0)) # rounding might make var < 0
+        stats[:,4:] = np.unravel_index(np.argmax(full_im), full_im.shape)
+        return stats
+
+class live_histogram:
+    """Keep a histogram of the integrated counts up to date as each image
+    is added, so that the cost of displaying it doesn't grow with the 
+    number of images.
+
+    The base histogram stores how many times each integer count has 
+    occurred. Rebinning takes the distinct counts weighted by their 
+    occurrences, which gives exactly the same histogram as binning all 
+    of the counts again. If fixed bin edges are used then their occupancy 
+    is also updated directly when a count is added. The base histogram 
+    only works for integer counts within a range of max_range, otherwise 
+    it's abandoned until reset and histogram() returns None."""
+    def __init__(self, max_range=1e6):
+        self.max_range = max_range # largest allowed max - min count
+        self.reset()
+
+    def reset(self):
+        """Empty the histogram"""
+        self.base = np.zeros(0, dtype=int) # occurrences of each integer count
+        self.base_min = 0               # the count corresponding to base[0]
+        self.exact = True               # False if the base can't be used
+        self.edges = None               # fixed bin edges
+        self.occ = None                 # occupancy of the fixed bins
+
+    def add(self, counts):
+        """Add a count or an array of counts to the histogram"""
+        c = np.asarray(counts, dtype=float).ravel()
+        if not self.exact or np.size(c) == 0:
+            return
+        if not np.all(c == np.round(c)): # base only stores integers
+            self.exact = False
+            self.base = np.zeros(0, dtype=int)
+            return
+        lo, hi = int(c.min()), int(c.max())
+        if np.size(self.base) == 0:
+            self.base_min = lo
+        if lo < self.base_min or hi >= self.base_min + np.size(self.base):
+            new_min = min(lo, self.base_min)
+            new_max = max(hi, self.base_min + np.size(self.base) - 1)
+            if new_max - new_min > self.max_range:
+                self.exact = False
+                self.base = np.zeros(0, dtype=int)
+                return
+            # double the length to leave space on both sides
+            pad = max(np.size(self.base), new_max - new_min + 1) // 2
+            new_base = np.zeros(new_max - new_min + 1 + 2*pad, dtype=int)
+            i0 = self.base_min - new_min + pad
+            new_base[i0:i0 + np.size(self.base)] = self.base
+            self.base, self.base_min = new_base, new_min - pad
+        np.add.at(self.base, c.astype(int) - self.base_min, 1)
+        if self.edges is not None: # bins are right-open except the last
+            idx = np.searchsorted(self.edges, c, side='right') - 1
+            idx[c == self.edges[-1]] = np.size(self.edges) - 2
+            np.add.at(self.occ, idx[(idx >= 0) & (idx < np.size(self.occ))], 1)
+
+    def histogram(self, bins=10):
+        """Return the occupancy and bin edges the same as np.histogram would
+        for all of the counts that have been added. bins is either an array 
+        of bin edges or the number of bins to use between the min and max."""
+        if not self.exact:
+            return None
+        idx = np.flatnonzero(self.base)
+        values, weights = idx + self.base_min, self.base[idx]
+        if np.size(bins) > 1: # fixed bin edges
+            if self.edges is None or not np.array_equal(bins, self.edges):
+                self.edges = np.array(bins, dtype=float)
+                self.occ = np.histogram(values, self.edges, weights=weights)[0]
+            return self.occ.copy(), self.edges.copy()
+        return np.histogram(values, bins, weights=weights)
+
+class sorted_block:
+    """Counts in ascending order, with the image index of each count and
+    the cumulative sums of x-x0 and (x-x0)^2, starting with 0."""
+    def __init__(self):
+        self.sorted = np.zeros(0)           # the counts in ascending order
+        self.order = np.zeros(0, dtype=int) # the image index of each count in sorted
+        self.sums = np.zeros((2,1))         # cumulative sums of x-x0 and (x-x0)^2
+
+    def insert(self, new, idx, x0):
+        """Merge the counts new, which are in ascending order, with image 
+        indexes idx into the block and update the sums."""
+        pos = np.searchsorted(self.sorted, new, side='right') # after equal counts
+        self.sorted = np.insert(self.sorted, pos, new)
+        self.order = np.insert(self.order, pos, idx)
+        d = self.sorted - x0
+        self.sums = np.zeros((2, np.size(d) + 1))
+        np.cumsum(d, out=self.sums[0,1:])
+        np.cumsum(d*d, out=self.sums[1,1:])
+
+class count_index:
+    """Keep the counts in ascending order so that the number of counts 
+    below a threshold, and their mean and variance, can be found with a
+    binary search instead of looking at every count.
+
+    The counts are kept in two sorted_blocks: a large block with most of 
+    the counts and a small block with the recent counts. New counts are 
+    kept in a list until the index is next used, then they are sorted and
+    merged into the small block, which takes time proportional to the 
+    size of the small block rather than all of the counts. When the small
+    block holds more than sqrt(N) counts (or min_block, if that's larger)
+    it's merged into the large block. Searches look in both blocks. The 
+    sums are taken relative to the first count to reduce rounding errors.
+    The image index of each count is kept in the same order, so the images 
+    with counts between two thresholds can be found without comparing 
+    every count."""
+    def __init__(self, min_block=1024):
+        self.min_block = min_block # smallest size of the small block before merging
+        self.reset()
+
+    def reset(self):
+        """Remove all of the counts"""
+        self.blocks = [sorted_block(), sorted_block()] # large block, small block
+        self.x0 = 0                  # offset subtracted before summing
+        self.size = 0                # number of counts added, including pending
+        self.pending = []            # new counts that haven't been merged yet
+
+    def add(self, counts, i=None):
+        """Add a count or an array of counts to the index, where i is the
+        image index of the first count. By default, continue from the 
+        number of counts already added."""
+        c = np.array(counts, dtype=float).ravel()
+        if i is None:
+            i = self.size
+        self.pending.append((c, np.arange(i, i + np.size(c))))
+        self.size += np.size(c)
+
+    def merge(self):
+        """Sort the new counts into the small block, then merge the small
+        block into the large block if it has grown too big."""
+        if self.pending:
+            new = np.concatenate([c for c, i in self.pending])
+            idx = np.concatenate([i for c, i in self.pending])
+            self.pending = []
+            ind = np.argsort(new, kind='mergesort')
+            new, idx = new[ind], idx[ind]
+            large, small = self.blocks
+            if np.size(large.sorted) + np.size(small.sorted) == 0 and np.size(new):
+                self.x0 = new[0]
+            small.insert(new, idx, self.x0)
+            if np.size(small.sorted) > max(self.min_block, np.size(large.sorted)**0.5):
+                large.insert(small.sorted, small.order, self.x0)
+                self.blocks[1] = sorted_block()
+
+    def below(self, thresh):
+        """Return the number of counts < thresh. thresh can also be an array."""
+        self.merge()
+        return sum(np.searchsorted(b.sorted, thresh, side='left') for b in self.blocks)
+
+    def between(self, t1, t2):
+        """Return the image indexes of the counts c with t1 <= c < t2 or
+        t2 <= c < t1, i.e. the images that change class when the threshold
+        moves from t1 to t2."""
+        self.merge()
+        idx = []
+        for b in self.blocks:
+            i, j = sorted(np.searchsorted(b.sorted, [t1, t2], side='left'))
+            idx.append(b.order[i:j])
+        return np.concatenate(idx)
+
+    def moments(self, n, s1, s2):
+        """Return the number, mean, and sum of squared differences from the 
+        mean of n counts, where s1 and s2 are the sums of x-x0 and (x-x0)^2."""
+        if n <= 0:
+            return 0, 0., 0.
+        return n, self.x0 + s1/n, max(s2 - s1*s1/n, 0.)
+
+    def partition(self, thresh):
+        """Return arrays of the number, mean, and sum of squared differences 
+        from the mean for the counts below thresh and the counts >= thresh."""
+        self.merge()
+        below, total = np.zeros(3), np.zeros(3) # number, sum of x-x0, sum of (x-x0)^2
+        for b in self.blocks:
+            i = np.searchsorted(b.sorted, thresh, side='left')
+            below += [i, b.sums[0,i], b.sums[1,i]]
+            total += [np.size(b.sorted), b.sums[0,-1], b.sums[1,-1]]
+        return np.array([self.moments(*below), self.moments(*(total - below))]).T
+
+class class_stats:
+    """Running statistics of the counts below the threshold (no atom) and 
+    the counts >= the threshold (atom detected).
+
+    For each class, keep the number of counts, their mean, and the sum of
+    squared differences from the mean (M2). New counts are added with
+    Welford's method, so the loading probability, means, and standard
+    deviations are updated in constant time for each image. When the
+    threshold changes, set() replaces the statistics with the new 
+    partition, e.g. from count_index.partition."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self, thresh=None):
+        """Remove all of the counts and set the threshold"""
+        self.set(thresh, np.zeros(2, dtype=int), np.zeros(2), np.zeros(2))
+
+    def set(self, thresh, n, mean, m2):
+        """Set the threshold and the statistics for [below, above]"""
+        self.thresh = thresh
+        self.n, self.mean, self.m2 = np.array(n, dtype=int), np.array(mean, dtype=float), np.array(m2, dtype=float)
+
+    def add(self, counts):
+        """Add a count or an array of counts, merging them into each class"""
+        c = np.asarray(counts, dtype=float).ravel()
+        above = c >= self.thresh
+        for k, x in enumerate([c[~above], c[above]]):
+            nb = np.size(x)
+            if nb == 1: # Welford's update
+                self.n[k] += 1
+                d = x[0] - self.mean[k]
+                self.mean[k] += d / self.n[k]
+                self.m2[k] += d * (x[0] - self.mean[k])
+            elif nb > 1: # combine with the statistics of the new counts
+                mb = np.mean(x)
+                d, n = mb - self.mean[k], self.n[k] + nb
+                self.m2[k] += np.sum((x - mb)**2) + d*d * self.n[k] * nb / n
+                self.mean[k] += d * nb / n
+                self.n[k] = n
+
+    def std(self):
+        """Return the sample standard deviation of each class, or NaN if 
+        there are fewer than 2 counts in the class."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n > 1, np.sqrt(self.m2 / (self.n - 1)), np.nan)
 
-    return peak_inds, properties['prominences'], properties['widths']
+    def means(self):
+        """Return the mean of each class, or NaN if the class is empty."""
+        return np.where(self.n > 0, self.mean, np.nan)
+
+class frame_archive:
+    """Store images in a compact binary archive that is quick to read back.
+
+    The archive is a pair of .npy files: name+'_frames.npy' holds the stack
+    of images with shape (number of images, rows, columns), and 
+    name+'_files.npy' holds the Dexter file number of each image. New 
+    images are appended to the end of the files and then the shape in the 
+    .npy header is updated. The header is padded to a fixed length so that 
+    it never has to move. The files can always be opened with 
+    np.load(file_name, mmap_mode='r'), so images are only read from disk 
+    when they're used. The counts are stored as 16 bit integers like the 
+    raw camera data, which is half the size of the .asc file or less.
+    Keyword arguments:
+    name  -- path to the archive without the '_frames.npy' ending.
+    dtype -- data type to store the counts as. Images with values that 
+        can't be stored exactly as this type aren't added to the archive."""
+    header_len = 128 # length of the .npy header in bytes, including the magic string
+
+    def __init__(self, name, dtype=np.uint16):
+        self.name = name
+        self.frames_file = name + '_frames.npy'
+        self.files_file = name + '_files.npy'
+        self.dtype = np.dtype(dtype)
+
+    def write_header(self, f, dtype, shape):
+        """Write the .npy header for an array of dtype and shape at the 
+        start of the open file f."""
+        header = "{'descr': %s, 'fortran_order': False, 'shape': %s, }"%(
+            repr(np.lib.format.dtype_to_descr(dtype)), repr(tuple(shape)))
+        if len(header) > self.header_len - 11:
+            raise ValueError('the .npy header is longer than %s bytes: '%self.header_len + header)
+        header = header.ljust(self.header_len - 11) + '\n' # pad with spaces
+        f.seek(0)
+        f.write(np.lib.format.magic(1, 0))
+        f.write(np.array(len(header), dtype='<u2').tobytes())
+        f.write(header.encode('latin1'))
+
+    def read_header(self, f):
+        """Return the shape of the array in the .npy file f"""
+        f.seek(0)
+        np.lib.format.read_magic(f)
+        return np.lib.format.read_array_header_1_0(f)[0]
+
+    def append_array(self, file_name, vals):
+        """Add vals as the next element of the array stored in the .npy 
+        file_name, creating the file if it doesn't exist."""
+        if not os.path.isfile(file_name):
+            with open(file_name, 'wb') as f:
+                self.write_header(f, vals.dtype, (0,)+np.shape(vals))
+        with open(file_name, 'r+b') as f:
+            shape = self.read_header(f)
+            if shape[1:] != np.shape(vals):
+                raise ValueError('cannot add an array with shape %s to the archive %s with shape %s'%(
+                    np.shape(vals), file_name, shape))
+            f.seek(self.header_len + shape[0] * vals.nbytes)
+            f.write(vals.tobytes())
+            self.write_header(f, vals.dtype, (shape[0]+1,)+shape[1:])
+
+    def append(self, file_num, im_vals):
+        """Add the image array im_vals with Dexter file number file_num to 
+        the end of the archive. Return False if the image can't be stored
+        exactly with the archive's data type."""
+        im = np.asarray(im_vals).astype(self.dtype)
+        if not np.array_equal(im, im_vals):
+            return False
+        self.append_array(self.frames_file, im)
+        self.append_array(self.files_file, np.array(file_num, dtype=np.int64))
+        return True
+
+    def load(self, first=None, last=None):
+        """Return the file numbers and a memory-mapped stack of the images 
+        with file numbers first <= file # <= last. The images are only read 
+        from disk when they're used."""
+        frames = np.load(self.frames_file, mmap_mode='r')
+        files = np.load(self.files_file)
+        num = min(len(frames), len(files)) # in case the last append wasn't finished
+        files, frames = files[:num], frames[:num]
+        keep = np.ones(num, dtype=bool)
+        if first is not None:
+            keep &= files >= first
+        if last is not None:
+            keep &= files <= last
+        if keep.all():
+            return files, frames
+        idx = np.flatnonzero(keep)
+        if np.size(idx) and np.all(np.diff(idx) == 1): # stays memory-mapped
+            return files[idx[0]:idx[-1]+1], frames[idx[0]:idx[-1]+1]
+        return files[idx], frames[idx]
+
+class frame_stack:
+    """Get the ROI statistics for a stack of images at once, so that the
+    images can be re-analysed quickly with a different ROI.
+
+    frames is an array of images with shape (number of images, rows, 
+    columns), e.g. the memory-mapped stack from frame_archive.load().
+    The statistics that don't depend on the ROI (the sums over the full 
+    image and the position of the max pixel) are only calculated once.
+    After that, the statistics for an ROI only need the pixels in the ROI
+    to be read from each image, which is done by slicing the whole stack.
+    The images are taken chunk at a time to limit the memory used.
+    The statistics are the same as roi_stats.get_stats gives."""
+    def __init__(self, files, frames, chunk=1000):
+        self.files = np.asarray(files)  # Dexter file number of each image
+        self.frames = frames            # stack of images
+        self.chunk = chunk              # number of images to take at once
+        self.totals = None              # sum, sum of squares, x and y of max pixel
+
+    def full_stats(self):
+        """Return an array with the sum of the counts, the sum of the squared
+        counts, and the x and y position of the max pixel for each image."""
+        if self.totals is None:
+            n, rows, cols = np.shape(self.frames)
+            self.totals = np.zeros((4, n))
+            for i in range(0, n, self.chunk):
+                sub = np.asarray(self.frames[i:i+self.chunk], dtype=float).reshape(-1, rows*cols)
+                j = i + len(sub)
+                self.totals[0,i:j] = np.sum(sub, axis=1)
+                self.totals[1,i:j] = np.einsum('ij,ij->i', sub, sub)
+                self.totals[2:,i:j] = np.unravel_index(np.argmax(sub, axis=1), (rows, cols))
+        return self.totals
+
+    def get_stats(self, rois):
+        """Return an array with shape (number of ROIs, number of images, 6)
+        where for each ROI and image there's the integrated counts in the 
+        ROI, the count at the ROI centre, the mean and standard deviation of
+        the counts outside of the ROI, and the x and y position of the max 
+        pixel in the image."""
+        n, rows, cols = np.shape(self.frames)
+        total, total_sq, xmax, ymax = self.full_stats()
+        stats = np.zeros((len(rois), n, 6))
+        squares = np.zeros(n) # sum of squared counts in the ROI
+        for k, roi in enumerate(rois):
+            xc, yc, l = map(int, roi)
+            # use the same pixels that slicing the image would give
+            x0, x1, _ = slice(xc - l//2, xc - l//2 + l).indices(rows)
+            y0, y1, _ = slice(yc - l//2, yc - l//2 + l).indices(cols)
+            x1, y1 = max(x0, x1), max(y0, y1)
+            for i in range(0, n, self.chunk):
+                sub = np.asarray(self.frames[i:i+self.chunk, x0:x1, y0:y1], dtype=float)
+                sub = sub.reshape(len(sub), -1)
+                j = i + len(sub)
+                stats[k,i:j,0] = np.sum(sub, axis=1) # integrated counts
+                squares[i:j] = np.einsum('ij,ij->i', sub, sub)
+                stats[k,i:j,1] = self.frames[i:j, xc, yc] # centre
+            N = rows*cols - (x1 - x0)*(y1 - y0) # number of background pixels
+            mean = (total - stats[k,:,0]) / N
+            var = (total_sq - squares - N*mean**2) / (N - 1)
+            stats[k,:,2] = mean
+            stats[k,:,3] = np.sqrt(np.maximum(var, 0)) # rounding might make var < 0
+            stats[k,:,4], stats[k,:,5] = xmax, ymax
+        return stats
+
+def file_stats(args):
+    """Load the image file and return the file name, the ROI statistics 
+    from roi_stats.get_stats, and an error message, which is empty unless
+    the file couldn't be processed (then the statistics are None).
+    args is a tuple (file name, pic_size, rois, delim) so that this can
+    be used by a process pool."""
+    file_name, pic_size, rois, delim = args
+    try:
+        full_im = load_asc(file_name, pic_size, delim)
+        return file_name, roi_stats().get_stats(full_im, rois), ''
+    except Exception as e: # e.g. file not found or the image is the wrong size
+        return file_name, None, '%s: %s'%(type(e).__name__, e)
+
+def batch_stats(file_list, pic_size, rois, delim=' ', processes=None, 
+        progress=None, min_files=50):
+    """Load the image files and get the statistics for each of the rois,
+    using a pool of processes to work on several files in parallel. 
+    Return the Dexter file numbers and an array of statistics with shape
+    (number of ROIs, number of files, 6) for the files that were processed,
+    in order of file number, and a list of (file name, error message) for 
+    the files that failed.
+    Keyword arguments:
+    processes -- number of processes to use, default the number of CPUs.
+    progress  -- function called as progress(files done, total files).
+    min_files -- with fewer files than this, don't start the process pool 
+        since it takes longer to start than it saves."""
+    args = [(f, pic_size, [list(map(int, roi)) for roi in rois], delim) for f in file_list]
+    processes = processes or cpu_count()
+    if processes > 1 and len(args) >= min_files:
+        pool = Pool(processes)
+        results = pool.imap(file_stats, args, chunksize=max(1, len(args)//(4*processes)))
+    else:
+        pool = None
+        results = map(file_stats, args)
+    done, failures = [], []
+    try:
+        for i, (file_name, stats, error) in enumerate(results):
+            if error:
+                failures.append((file_name, error))
+            else:
+                done.append((file_number(file_name), i, stats))
+            if progress is not None:
+                progress(i+1, len(args))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    done.sort(key=lambda x: x[:2]) # by file number, then the order given
+    files = np.array([d[0] for d in done], dtype=int)
+    stats = np.array([d[2] for d in done]).reshape(len(done), len(rois), 6)
+    return files, stats.transpose(1, 0, 2), failures
+
+# the columns of the results stored for each image, in the order they're saved
+results_dtype = np.dtype([('files', int), ('counts', float), ('atom', float),
+        ('mid_count', float), ('xc_list', float), ('yc_list', float),
+        ('mean_count', float), ('std_count', float)])
 
 ####    ####    ####    ####
         
@@ -40,22 +728,22 @@ class image_handler:
     """Analyse individual image files and create a histogram.
     
     Load an ROI image centred on the atom, integrate the counts,
-    then compare to the threshold. For speed, make an array of 
-    counts with length n. If the number of images analysed exceeds 
-    (n-10) of this length then append another n elements to the array."""
+    then compare to the threshold. For speed, the results from each 
+    image are stored in a structured array with initial length n. 
+    When it's full, the array is doubled in length, so that adding 
+    an image takes constant time on average. The columns of the 
+    array are accessed through views such as self.counts, which are
+    reset whenever the array is replaced."""
     def __init__(self, atom_index=0, atom_symbol='Cs '):
         self.i = atom_index             # indicates the index of this handler in the list
         self.X = atom_symbol            # the name of the atom that this handler deals with
         self.delim = ' '                # delimieter to use when opening files
-        self.n = 10000                  # length of array for storing counts
-        self.counts = np.zeros(self.n)  # integrated counts over the ROI
-        self.mid_count = np.zeros(self.n)# count at the centre of the ROI
-        self.mean_count = np.zeros(self.n) # list of mean counts in image - estimates background 
-        self.std_count  = np.zeros(self.n) # list of standard deviation of counts in image
-        self.xc_list = np.zeros(self.n) # horizontal positions of max pixel
-        self.yc_list = np.zeros(self.n) # vertical positions of max pixel
-        self.atom = np.zeros(self.n)    # deduce presence of an atom by comparison with threshold
-        self.files = np.array([None]*(self.n)) # labels of files. 
+        self.n = 10000                  # initial length of array for storing counts
+        self.live_hist = live_histogram() # histogram that's updated with each image
+        self.mixture = fc.mixture_em()  # unbinned fit of the peaks that's updated with each image
+        self.index = count_index()      # sorted counts to find the number below a threshold
+        self.class_stats = class_stats() # running statistics of the counts below/above threshold
+        self.reset_arrays()             # make the array that stores the results from each image
         self.peak_indexes = [0,0]       # indexes of peaks in histogram
         self.peak_heights = [0,0]       # heights of peaks in histogram
         self.peak_widths  = [0,0]       # widths of peaks in histogram
@@ -67,9 +755,13 @@ class image_handler:
         self.roi_size =  1              # ROI length in pixels. default 1 takes top left pixel
         self.pic_size = 512             # number of pixels in an image
         self.thresh = 1                 # initial threshold for atom detection
+        self.thresh_method = 'fidelity' # how to set the threshold: 'fidelity' or 'roc'
+        self.fpr_max = None             # for 'roc', max false positive rate, or None to max TPR - FPR
+        self.fpr_met = True             # whether the last ROC threshold had a false positive rate <= fpr_max
         self.im_num = 0                 # number of images processed
         self.im_vals = np.array([])     # the data from the last image is accessible to an image_handler instance
         self.bin_array = []             # if bins for the histogram are supplied, plotting can be faster
+        self.roi_engine = roi_stats()   # calculates the ROI statistics from an image
         
     def set_pic_size(self, im_name):
         """Set the pic size by looking at the number of columns in a file"""
@@ -79,79 +771,141 @@ class image_handler:
 
     def reset_arrays(self):
         """Reset all of the histogram array data to zero"""
-        self.files = np.array([None]*(self.n)) # labels of files. 
-        self.counts = np.zeros(self.n)  # integrated counts over ROI
-        self.mid_count = np.zeros(self.n)  # count at the centre of the ROI
-        self.mean_count = np.zeros(self.n) # list of mean counts in image - estimates background 
-        self.std_count = np.zeros(self.n)  # list of standard deviation of counts in image
-        self.xc_list = np.zeros(self.n) # horizontal positions of max pixel
-        self.yc_list = np.zeros(self.n) # vertical positions of max pixel
-        self.atom = np.zeros(self.n)    # deduce presence of an atom by comparison with threshold
+        self.data = np.zeros(self.n, dtype=results_dtype) # results from each image
+        self.set_views()
         self.im_num = 0                 # number of images processed
-        
+        self.live_hist.reset()
+        self.mixture.reset()
+        self.index.reset()
+        self.class_stats.reset()
+
+    def set_views(self):
+        """Make the columns of the results array available as attributes"""
+        self.files = self.data['files']           # Dexter file numbers
+        self.counts = self.data['counts']         # integrated counts over the ROI
+        self.atom = self.data['atom']             # deduce presence of an atom by comparison with threshold
+        self.mid_count = self.data['mid_count']   # count at the centre of the ROI
+        self.xc_list = self.data['xc_list']       # horizontal positions of max pixel
+        self.yc_list = self.data['yc_list']       # vertical positions of max pixel
+        self.mean_count = self.data['mean_count'] # list of mean counts in image - estimates background 
+        self.std_count = self.data['std_count']   # list of standard deviation of counts in image
+
+    def grow(self, size):
+        """Make sure that the results array can hold size images by 
+        doubling its length until it's large enough."""
+        if size > np.size(self.data):
+            new_len = max(np.size(self.data), 1)
+            while new_len < size:
+                new_len *= 2
+            new_data = np.zeros(new_len, dtype=results_dtype)
+            new_data[:self.im_num] = self.data[:self.im_num]
+            self.data = new_data
+            self.set_views()
         
     def load_full_im(self, im_name):
         """return an array with the values of the image"""
-        return np.loadtxt(im_name, delimiter=self.delim,
-                              usecols=range(1,self.pic_size+1))
+        return load_asc(im_name, self.pic_size, self.delim)
         
-    def process(self, im_name):
-        """Get the data from an image """
-        try:
-            self.add_count(im_name)
-        except IndexError: # this is a bad exception - the error might be from a bad ROI rather than reaching the end of the arrays
-            # filled the array of size n so add more elements
-            if self.im_num % (self.n - 10) == 0 and self.im_num > self.n / 2:
-                self.counts = np.append(self.counts, np.zeros(self.n))
-                self.mid_count = np.append(self.mid_count, np.zeros(self.n))
-                self.mean_count = np.append(self.mean_count, np.zeros(self.n)) 
-                self.std_count = np.append(self.std_count, np.zeros(self.n))
-                self.xc_list = np.append(self.xc_list, np.zeros(self.n))
-                self.yc_list = np.append(self.yc_list, np.zeros(self.n))
-                self.atom = np.append(self.atom, np.zeros(self.n))
-                self.files = np.append(self.files, np.array([None]*self.n))
-            self.add_count(im_name)
-
-    def add_count(self, im_name):
+    def process(self, im_name, full_im=None, stats=None, file_num=None):
+        """Get the data from an image. If the array of the image full_im
+        has already been loaded, use it instead of reading the file again.
+        The ROI statistics can also be supplied if they have already been
+        calculated (see roi_stats)."""
+        self.grow(self.im_num + 1)
+        self.add_count(im_name, full_im, stats, file_num)
+
+    def get_roi(self):
+        """Return the ROI as a list [xc, yc, roi_size]"""
+        return [self.xc, self.yc, self.roi_size]
+
+    def add_count(self, im_name, full_im=None, stats=None, file_num=None):
         """Fill in the next index of the counts by summing over the ROI region and then 
         getting a counts/pixel. 
-        Fill in the next index of the file, xc, yc, mean, std arrays."""
-        full_im = self.load_full_im(im_name) # make an array of the image
-        not_roi = full_im.copy()
-        # get the ROI
-        if self.roi_size % 2: # odd ROI length (+1 to upper bound)
-            # ROI
-            self.im_vals = full_im[self.xc-self.roi_size//2:self.xc+self.roi_size//2+1,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2+1]
-            # background outside the ROI
-            not_roi[self.xc-self.roi_size//2:self.xc+self.roi_size//2+1,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2+1] = np.zeros(np.shape(self.im_vals))
-        else:                 # even ROI length
-            # ROI
-            self.im_vals = full_im[self.xc-self.roi_size//2:self.xc+self.roi_size//2,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2]
-            # background outside the ROI
-            not_roi[self.xc-self.roi_size//2:self.xc+self.roi_size//2,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2] = np.zeros(np.shape(self.im_vals))
-
-        # background statistics: mean count and standard deviation across image
-        N = np.size(full_im) - np.size(self.im_vals)
-        self.mean_count[self.im_num] = np.sum(not_roi) / N
-        self.std_count[self.im_num] = np.sqrt(np.sum((not_roi[not_roi>0]-self.mean_count[self.im_num])**2) / (N - 1))
+        Fill in the next index of the file, xc, yc, mean, std arrays.
+        If full_im isn't supplied then load the array from the file im_name.
+        If stats isn't supplied then calculate them from full_im: 
+        [ROI counts, ROI centre count, mean, std, xc max, yc max]
+        If file_num isn't supplied then take it from the end of im_name."""
+        if full_im is None:
+            full_im = self.load_full_im(im_name) # make an array of the image
+        if stats is None:
+            stats = self.roi_engine.get_stats(full_im, [self.get_roi()])[0]
+        # the ROI of the image
+        x0, y0 = self.xc - self.roi_size//2, self.yc - self.roi_size//2
+        self.im_vals = full_im[x0:x0+self.roi_size, y0:y0+self.roi_size]
         # sum of counts in the ROI of the image gives the signal
-        self.counts[self.im_num] = np.sum(self.im_vals) # / np.size(self.im_vals) # mean        
-        # naming convention: [Species]_[date]_[Dexter file #]
-        self.files[self.im_num] = im_name.split("_")[-1].split(".")[0]
-        # find the count at the centre of the ROI
-        self.mid_count[self.im_num] = full_im[self.xc, self.yc]
-        self.xc_list[self.im_num], self.yc_list[self.im_num] = np.unravel_index(np.argmax(full_im), full_im.shape)
+        # background statistics: mean count and standard deviation outside of the ROI
+        (self.counts[self.im_num], self.mid_count[self.im_num], 
+            self.mean_count[self.im_num], self.std_count[self.im_num],
+            self.xc_list[self.im_num], self.yc_list[self.im_num]) = stats
+        if file_num is None: 
+            file_num = file_number(im_name)
+        self.files[self.im_num] = file_num
+        self.new_counts(self.im_num, self.im_num + 1)
         self.im_num += 1
             
+    def add_stats(self, files, stats):
+        """Add the results for several images at once, where files are the 
+        Dexter file numbers and stats has a row for each image with the ROI 
+        statistics from roi_stats.get_stats or frame_stack.get_stats."""
+        n = np.size(files)
+        self.grow(self.im_num + n)
+        i, j = self.im_num, self.im_num + n
+        self.files[i:j] = files
+        (self.counts[i:j], self.mid_count[i:j], self.mean_count[i:j], 
+            self.std_count[i:j], self.xc_list[i:j], self.yc_list[i:j]) = np.transpose(stats)
+        self.new_counts(i, j)
+        self.im_num = j
+
+    def new_counts(self, i, j):
+        """Add the counts from images i to j to the live histogram, the
+        unbinned fit, the sorted index, and the statistics of each class."""
+        c = self.counts[i:j]
+        self.live_hist.add(c)
+        self.mixture.add(c) # only once it's been fitted
+        self.classify() # in case the threshold has changed
+        self.index.add(c, i)
+        self.class_stats.add(c)
+        self.atom[i:j] = c >= self.thresh
+
+    def classify(self):
+        """Make sure that atom detected (1 if counts >= threshold, else 0) 
+        and the statistics of each class are up to date with the threshold.
+        New images are classified as they're added, and when the threshold
+        moves only the images with counts between the old and new threshold
+        change class, which are found from the sorted index."""
+        old = self.class_stats.thresh
+        if old != self.thresh:
+            self.class_stats.set(self.thresh, *self.index.partition(self.thresh))
+            if old is None: # not classified yet
+                self.atom[:self.im_num] = self.counts[:self.im_num] >= self.thresh
+            else:
+                idx = self.index.between(old, self.thresh)
+                self.atom[idx] = self.counts[idx] >= self.thresh
+
+    def file_range(self):
+        """Return the first and last Dexter file numbers of the images 
+        processed, ignoring images without a file number (-1). Return
+        (-1, -1) if none of the images have a file number."""
+        files = self.files[:self.im_num]
+        files = files[files >= 0]
+        if np.size(files):
+            return int(min(files)), int(max(files))
+        return -1, -1
+
+    def load_from_archive(self, name, first=None, last=None):
+        """Process the images in the binary archive (see frame_archive) 
+        with Dexter file numbers first <= file # <= last. The images are
+        memory-mapped so only the ones used are read from disk."""
+        stack = frame_stack(*frame_archive(name).load(first, last))
+        self.add_stats(stack.files, stack.get_stats([self.get_roi()])[0])
+        return np.size(stack.files)
+
     def get_fidelity(self, thresh=None):
         """Calculate the fidelity assuming a normal distribution for peak 1
         centred about p1 with std dev w1 and peak 2 centred around
         p2 with std dev w2. Optionally supply a threshold thresh, otherwise
-        use self.thresh"""
+        use self.thresh. thresh can also be an array of thresholds."""
         if thresh is None:
             thresh = self.thresh
 
@@ -168,49 +922,182 @@ class image_handler:
             return fidelity, err_fidelity
         else: return -1, -1 # calculation failed
 
-    def search_fidelity(self, p1, pw1, p2, n=10):
-        """Take n values for the threshold between positions p1 and 
-        p1 + 15*pw1 or p2, whichever is smaller. Calculate the threshold for 
-        each value. Choose the threshold that first gives a fidelity > 0.9999,
-        or if that isn't possible, the threshold that maximises the fidelity.
+    def search_fidelity(self, p1, pw1, p2, n=10, method='max', fid_lim=0.9999):
+        """Set the threshold between positions p1 and p1 + 15*pw1 or p2, 
+        whichever is smaller, using the fidelity calculated from the peak
+        parameters. There are two methods:
+        'max'   -- the fidelity is maximum where the two Gaussian peaks have
+            equal density, which is solved for directly. If this isn't in 
+            the range, take the max from n values of the threshold instead.
+        'first' -- take n values for the threshold in the range and calculate
+            the fidelity for all of them at once. Choose the threshold that 
+            first gives a fidelity > fid_lim, or if that isn't possible, 
+            the threshold that maximises the fidelity.
         Keyword arguments:
         p1  -- the lower limit for the threshold (the background peak mean).
         pw1 -- the width of the background peak, used to guess an upper limit.
         p2  -- the upper limit for the threshold if it's smaller than p1+15*pw1
                 (the signal peak mean).
         n   -- the number of thresholds to take between the peaks
+        method  -- 'max' or 'first', as described above.
+        fid_lim -- the fidelity to stop at for the 'first' method.
         """
         uplim = min([p1 + 15*pw1, p2]) # highest possible value for the threshold 
-        threshes = np.linspace(p1, uplim, n) # n points between peaks
-        fid, err_fid = 0, 0  # store the previous value of the fidelity
-        for thresh in threshes[1:]: # threshold should never be at the background peak p1
-            f, fe = self.get_fidelity(thresh) # calculate fidelity for given threshold
-            if f > fid:
-                fid, err_fid = f, fe
-                self.thresh = thresh # the threshold at which there is max fidelity
-                if fid > 0.9999:
-                    break
-        # set to max value, round to 4 d.p.
+        if method == 'max' and np.size(self.peak_counts) == 2:
+            thresh = gauss_crossing(self.peak_counts[0], self.peak_widths[0], 
+                                    self.peak_counts[1], self.peak_widths[1])
+            if thresh is not None and p1 < thresh <= uplim:
+                self.thresh = thresh
+                self.fidelity, self.err_fidelity = np.around(self.get_fidelity(), 4)
+                return
+        # threshold should never be at the background peak p1
+        threshes = np.linspace(p1, uplim, n)[1:] # n points between peaks
+        fids, err_fids = self.get_fidelity(threshes) # calculate all fidelities at once
+        fids, err_fids = fids * np.ones(np.size(threshes)), err_fids * np.ones(np.size(threshes))
+        if method == 'first' and np.any(fids > fid_lim):
+            i = np.flatnonzero(fids > fid_lim)[0] # first point above the limit
+        else:
+            i = np.argmax(fids)
+        fid, err_fid = 0, 0
+        if np.size(fids) and fids[i] > 0:
+            fid, err_fid = fids[i], err_fids[i]
+            self.thresh = threshes[i] # the threshold at which there is max fidelity
+        # round to 4 d.p.
         self.fidelity, self.err_fidelity = np.around([fid, err_fid] , 4)
             
+    def find_thresh(self, p1, pw1, p2, n=10):
+        """Set the threshold between the background peak at p1 with width
+        pw1 and the signal peak at p2 using thresh_method: 'fidelity' 
+        maximises the fidelity (see search_fidelity), 'roc' uses the
+        receiver operating characteristic (see roc_thresh). n is the number
+        of thresholds to try if the fidelity can't be maximised directly."""
+        if self.thresh_method == 'roc':
+            self.roc_thresh(p1, pw1, p2)
+        else:
+            self.search_fidelity(p1, pw1, p2, n=n)
+
+    def roc(self, threshes=None, n=500, clip=True):
+        """Return the receiver operating characteristic for each threshold 
+        in threshes (by default n thresholds between the min and max count):
+        the false positive rate (fraction of background images above 
+        threshold) from the fitted background peak, the true positive rate 
+        (fraction of images with an atom above threshold) from the fitted
+        signal peak, and the true positive rate from the data. For the data,
+        the fraction of all images above each threshold comes from the 
+        sorted counts, then the false positives expected from the background
+        peak are taken away. The peaks are weighted by their area in the 
+        histogram. If clip is True, keep tpr_data between 0 and 1 (it can go
+        outside if the peaks don't fit the data). Returns threshes, fpr, 
+        tpr, tpr_data."""
+        if threshes is None:
+            c = self.counts[:self.im_num]
+            threshes = np.linspace(np.min(c), np.max(c), n)
+        threshes = np.asarray(threshes, dtype=float)
+        fpr = norm.sf(threshes, self.peak_counts[0], self.peak_widths[0])
+        tpr = norm.sf(threshes, self.peak_counts[1], self.peak_widths[1])
+        area = np.abs(np.array(self.peak_heights[:2], dtype=float) * self.peak_widths[:2])
+        w_bg = area[0] / np.sum(area) if np.sum(area) > 0 else 0.5 # fraction of background images
+        above = 1 - self.index.below(threshes) / max(self.im_num, 1) # fraction of all images above threshold
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tpr_data = (above - w_bg*fpr) / (1 - w_bg)
+        if clip:
+            tpr_data = np.clip(tpr_data, 0, 1)
+        return threshes, fpr, tpr, tpr_data
+
+    def roc_thresh(self, p1, pw1, p2, n=500):
+        """Set the threshold between positions p1 and p1 + 15*pw1 or p2, 
+        whichever is smaller, using the receiver operating characteristic 
+        for n thresholds at once. If fpr_max is set, take the lowest 
+        threshold with a false positive rate <= fpr_max, which has the 
+        highest true positive rate. If none of the thresholds meet fpr_max
+        then take the highest threshold, which has the lowest false 
+        positive rate, and set fpr_met to False. Otherwise, maximise the true positive 
+        rate from the data minus the false positive rate (Youden's index).
+        Between the peaks there can be a range of thresholds that have no 
+        counts, so take the middle of the thresholds where the index is 
+        within one image of its max. The fidelity is calculated from the 
+        peaks."""
+        uplim = min([p1 + 15*pw1, p2]) # highest possible value for the threshold 
+        threshes, fpr, tpr, tpr_data = self.roc(np.linspace(p1, uplim, n)[1:], clip=False)
+        if not np.size(threshes):
+            return
+        if self.fpr_max is not None:
+            met = np.flatnonzero(fpr <= self.fpr_max)
+            if np.size(met):
+                i = met[0]
+            else: # the false positive rate decreases as the threshold increases
+                i = np.size(threshes) - 1
+                if self.fpr_met: # only warn when it changes
+                    print("WARNING: no threshold up to %.4g has a false positive rate <= %.3g, "%(
+                        uplim, self.fpr_max) + "using the lowest false positive rate %.3g"%fpr[i])
+            self.fpr_met = bool(np.size(met))
+        else:
+            J = tpr_data - fpr # Youden's index
+            if not np.any(np.isfinite(J)):
+                return
+            n_atom = max(self.im_num - self.index.below(threshes[np.nanargmax(J)]), 1) # images above threshold
+            best = np.flatnonzero(J >= np.nanmax(J) - 1./n_atom)
+            i = best[np.size(best)//2]
+        self.thresh = threshes[i]
+        self.fidelity, self.err_fidelity = np.around(self.get_fidelity(), 4)
+
     def hist_and_thresh(self):
         """Make a histogram of the photon counts and determine a threshold for 
         single atom presence."""
         bins, occ, _ = self.histogram()
         self.thresh = np.mean(bins) # in case peak calculation fails
         if np.size(self.peak_indexes) == 2: # est_param will only find one peak if the number of bins is small
-            # set the threshold where the fidelity is max
-            self.search_fidelity(self.peak_counts[0], self.peak_widths[0] ,self.peak_counts[1])
+            # set the threshold where the fidelity is max, or from the ROC
+            self.find_thresh(self.peak_counts[0], self.peak_widths[0] ,self.peak_counts[1])
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh 
+        self.classify()
         return bins, occ, self.thresh
 
+    def mixture_and_thresh(self, set_thresh=True, refit=True):
+        """Make a histogram of the photon counts, then fit the background and
+        signal peaks to the counts themselves (see fitCurve.mixture_em) so 
+        that the peaks don't depend on the bins. If set_thresh is True then
+        set the threshold where the fidelity is max. Once fitted, the peaks
+        are updated with each new image until the arrays are reset, so if
+        refit is False then those peaks are used and the counts aren't 
+        fitted again."""
+        bins, occ, _ = self.histogram()
+        if refit or self.mixture.ps is None:
+            ps = self.mixture.fit(self.counts[:self.im_num], self.thresh)
+        else: # updated from the running sums in new_counts
+            ps = self.mixture.ps
+        # the peak heights are the expected occupancy of the histogram bins
+        self.peak_indexes = np.clip(np.searchsorted(bins, ps[:,1]) - 1, 0, np.size(occ) - 1)
+        self.peak_heights = self.im_num * ps[:,0] * (bins[1] - bins[0]) / ps[:,2] / np.sqrt(2*np.pi)
+        self.peak_counts = ps[:,1]
+        self.peak_widths = ps[:,2]
+        if set_thresh:
+            self.find_thresh(ps[0,1], ps[0,2], ps[1,1], n=100)
+        else:
+            self.fidelity, self.err_fidelity = np.around(self.get_fidelity(), 4)
+        # atom is present if the counts are above threshold
+        self.classify()
+        return bins, occ, self.thresh
+
+    def update_and_thresh(self):
+        """Make a histogram of the photon counts and set the threshold. If 
+        there has been an unbinned fit since the arrays were reset then use
+        its peaks, which are updated with each new image, otherwise use the
+        peaks of the histogram (see hist_and_thresh)."""
+        if self.mixture.ps is not None:
+            return self.mixture_and_thresh(refit=False)
+        return self.hist_and_thresh()
+
     def histogram(self):
         """Make a histogram of the photon counts but don't update the threshold"""
         if np.size(self.bin_array) > 0: 
-            occ, bins = np.histogram(self.counts[:self.im_num], self.bin_array) # fixed bins. 
+            bins = self.bin_array # fixed bins
         else:
-            occ, bins = np.histogram(self.counts[:self.im_num]) # no bins provided, do automatic binning
+            bins = 10 # no bins provided, do automatic binning
+        hist = self.live_hist.histogram(bins) # only rebins the distinct counts
+        if hist is None: # counts weren't integers, so bin all of them again
+            hist = np.histogram(self.counts[:self.im_num], bins)
+        occ, bins = hist
         # get the indexes of peak positions, heights, and widths
         self.peak_indexes, self.peak_heights, self.peak_widths = est_param(occ)
         self.peak_counts = bins[self.peak_indexes] + 0.5*(bins[1] - bins[0])
@@ -220,7 +1107,7 @@ class image_handler:
             self.peak_widths = [(bins[1] - bins[0]) * self.peak_widths[0]/2., # /np.sqrt(2*np.log(2)), 
                                 (bins[1] - bins[0]) * self.peak_widths[1]/2.] # /np.sqrt(2*np.log(2))]
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh
+        self.classify()
         return bins, occ, self.thresh
         
     def peaks_and_thresh(self):
@@ -229,28 +1116,23 @@ class image_handler:
         returns:
         images processed, loading probability, error in loading probability, bg count, bg width, 
         signal count, signal width, separation, fidelity, error in fidelity, threshold"""
-        # split histograms at threshold then get mean and stdev:
-        ascend = np.sort(self.counts[:self.im_num])
-        bg = ascend[ascend < self.thresh]     # background
-        signal = ascend[ascend > self.thresh] # signal above threshold
-        bg_peak = np.mean(bg)
-        bg_stdv = np.std(bg, ddof=1)
-        at_peak = np.mean(signal)
-        at_stdv = np.std(signal, ddof=1)
+        # split histograms at threshold then get mean and stdev from the sorted index:
+        self.classify()
+        bg_peak, at_peak = self.class_stats.means() # background, signal above threshold
+        bg_stdv, at_stdv = self.class_stats.std()
         sep = at_peak - bg_peak
         self.thresh = bg_peak + 5*bg_stdv # update threshold
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh 
-        atom_count = np.size(np.where(self.atom > 0)[0])  # images with counts above threshold
-        empty_count = np.size(np.where(self.atom[:self.im_num] == 0)[0])
+        self.classify()
+        empty_count, atom_count = self.class_stats.n # images with counts below, above threshold
         load_prob = np.around(atom_count / self.im_num, 4)
         conf = binom_conf_interval(atom_count, atom_count + empty_count, interval='jeffreys')
-        uplperr = conf[1] - loading_prob # 1 sigma confidence above mean
-        lolperr = loading_prob - conf[0] # 1 sigma confidence below mean
+        uplperr = conf[1] - load_prob # 1 sigma confidence above mean
+        lolperr = load_prob - conf[0] # 1 sigma confidence below mean
         load_err = np.mean([uplperr, lolperr])
-        self.fidelity, self. err_fidelity = np.around(self.get_fidelity(), 4)
-        return np.array(self.im_num, load_prob, load_err, bg_peak, bg_stdv, at_peak,
-                at_stdv, sep, self.fidelity, self.err_fidelity, self.thresh)
+        self.fidelity, self.err_fidelity = np.around(self.get_fidelity(), 4)
+        return np.array([self.im_num, load_prob, load_err, bg_peak, bg_stdv, at_peak,
+                at_stdv, sep, self.fidelity, self.err_fidelity, self.thresh])
 
     
     def set_roi(self, im_name='', dimensions=[]):
@@ -275,24 +1157,22 @@ class image_handler:
         """Load back in the counts data from a stored csv file, leavning space
         in the arrays to add new data as well"""
         data = np.genfromtxt(file_name, delimiter=',')
-        with open(file_name, 'r') as f:
-            header = f.readline()
         if np.size(data): # check the file wasn't empty
-            i = 0
-            self.files = np.concatenate((self.files[:self.im_num], data[:,i], np.array([None]*self.n)))
-            self.counts = np.concatenate((self.counts[:self.im_num], data[:,i+1], np.zeros(self.n)))
-            self.atom = np.concatenate((self.atom[:self.im_num], data[:,i+2], np.zeros(self.n)))
-            if 'Max Count' in header or 'Mid Count' in header:
-                self.mid_count = np.concatenate((self.mid_count[:self.im_num], data[:,i+3], np.zeros(self.n)))
-                i += 4
+            data = np.atleast_2d(data) # in case there's only one row
+            n = np.size(data[:,0])
+            self.grow(self.im_num + n)
+            new = self.data[self.im_num:self.im_num + n] # view of where to put the data
+            new['files'] = np.where(np.isnan(data[:,0]), -1, data[:,0]) # not a file number
+            new['counts'], new['atom'] = data[:,1], data[:,2]
+            if np.size(data[0]) > 7: # files with max/mid/centre count have 8 columns
+                new['mid_count'] = data[:,3]
+                i = 4
             else: # retain compatability with older csv files that don't contain max/mid count
-                self.mid_count = np.concatenate((self.mid_count[:self.im_num], np.zeros(self.n + np.size(data[:,i]))))
-                i += 3
-            self.xc_list = np.concatenate((self.xc_list[:self.im_num], data[:,i], np.zeros(self.n)))
-            self.yc_list = np.concatenate((self.yc_list[:self.im_num], data[:,i+1], np.zeros(self.n)))
-            self.mean_count = np.concatenate((self.mean_count[:self.im_num], data[:,i+2], np.zeros(self.n)))
-            self.std_count = np.concatenate((self.std_count[:self.im_num], data[:,i+3], np.zeros(self.n)))
-            self.im_num += np.size(data[:,0]) # now we have filled this many extra columns.
+                i = 3
+            new['xc_list'], new['yc_list'] = data[:,i], data[:,i+1]
+            new['mean_count'], new['std_count'] = data[:,i+2], data[:,i+3]
+            self.new_counts(self.im_num, self.im_num + n)
+            self.im_num += n # now we have filled this many extra columns.
         
     def save_state(self, save_file_name, hist_header=None, hist_stats=None):
         """Save the processed data to csv. 
@@ -307,19 +1187,17 @@ class image_handler:
         hist_stats     -- a list of histogram statistics associated with this histogram
         """
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh 
+        self.classify()
         # histogram data
-        out_arr = np.array((self.files[:self.im_num], self.counts[:self.im_num], 
-            self.atom[:self.im_num], self.mid_count[:self.im_num], self.xc_list[:self.im_num], 
-            self.yc_list[:self.im_num], self.mean_count[:self.im_num],
-            self.std_count[:self.im_num])).T
+        out_arr = np.array([self.data[key][:self.im_num] for key in 
+                                            self.data.dtype.names]).T
         header = ''
         # if there is histogram data, add this in as well
         if np.size(hist_header) > 1 and np.size(hist_stats) > 1:
             header += ','.join(hist_header)
             header += '\n' + ','.join(list(map(str, hist_stats))) + '\n'
         header += 'File, Counts, Atom Detected (threshold=%s), ROI Centre Count, X-pos (max pix), Y-pos (max pix), Mean Count, s.d.'
-        np.savetxt(save_file_name, out_arr, fmt='%s', delimiter=',',
+        np.savetxt(save_file_name, out_arr, fmt=['%d']+['%s']*7, delimiter=',',
                 header=header%int(self.thresh))
 
 ####    ####    ####    ####
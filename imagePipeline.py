@@ -0,0 +1,168 @@
+"""Single Atom Image Analysis
+Stefan Spence 22/05/19
+
+ - take the paths of new image files from the directory watcher, along with
+   the contents of the file if the directory watcher has already read it
+ - load the images and get the ROI statistics in a worker thread
+ - optionally add the image to a binary archive
+ - record the time spent waiting in the queue and on each stage
+ - emit the path and a sequence number as a signal once the image is ready
+   to add to the histogram
+
+Loading an ASCII image is the slowest part of processing, so doing it in
+a separate thread stops the GUI from freezing while it waits for files.
+"""
+import time
+import threading
+from collections import OrderedDict
+from queue import Queue, Full
+try:
+    from PyQt4.QtCore import QThread, pyqtSignal
+except ModuleNotFoundError:
+    from PyQt5.QtCore import QThread, pyqtSignal
+import imageHandler as ih
+from stageTimer import stage_timer
+
+####    ####    ####    ####
+
+class image_pipeline(QThread):
+    """Load and analyse new images in a worker thread.
+
+    submit() puts file paths into a queue, and it can be called from the
+    directory watcher's thread. If the directory watcher sends the contents
+    of the file as well, then the image is decoded from those bytes and the
+    file isn't read again. The worker takes the files in order, loads
+    the image, and calculates the statistics for the ROI of each image
+    handler. The results are kept until take() is called, and the
+    event_path signal is emitted with the file path and a sequence number
+    so that the GUI can add them to the histograms. The results are
+    indexed by the sequence number rather than the file path, since the
+    same path can be used for more than one image (e.g. in passive mode,
+    or if Dexter reuses a file name). The queue holds at most maxsize files. When it's full, new
+    files are dropped so that the directory watcher isn't delayed. Dropped
+    files are still saved, so they can be loaded again later. If lossless
+    is True (e.g. during a multirun, where every file has to be counted)
+    then the directory watcher waits for space in the queue instead. The status
+    signal sends the queue depth, the number of files dropped, and the
+    number of files that took longer than late_t seconds to reach the GUI.
+    If archive is set to an imageHandler.frame_archive then each image is 
+    also added to it. The durations of the queue, parse, roi stats, and 
+    archive stages are recorded in timer (see stageTimer).
+    Keyword arguments:
+    image_handlers -- list of imageHandler.image_handler instances that
+        give the ROIs, image size, and delimiter to use.
+    frames         -- imageHandler.frame_cache used to load the images,
+        which can be shared with the GUI so the image is only loaded once.
+    maxsize        -- maximum number of files waiting to be processed.
+    late_t         -- time in seconds after which a file counts as late.
+    """
+    event_path = pyqtSignal(str, int) # the file is ready to add to the histogram, sequence #
+    status = pyqtSignal(int, int, int) # queue depth, # dropped, # late
+
+    def __init__(self, image_handlers, frames=None, maxsize=10, late_t=1):
+        super().__init__()
+        self.image_handler = image_handlers
+        self.frames = frames if frames is not None else ih.frame_cache()
+        self.roi_engine = ih.roi_stats() # separate buffers from the GUI thread's
+        self.queue = Queue(maxsize)  # file paths and the time they were submitted
+        self.maxsize = maxsize       # also limits the number of results kept
+        self.late_t = late_t         # files taking longer than this are late
+        self.analyse = True          # if False, only emit the file path
+        self.lossless = False        # if True, wait for space instead of dropping files
+        self.archive = None          # frame_archive to store the images in
+        self.results = OrderedDict() # results of processing, indexed by sequence #
+        self.seq = 0                 # sequence number of the last file taken from the queue
+        self.lock = threading.Lock() # results are accessed from both threads
+        self.dropped = 0             # number of files dropped from a full queue
+        self.dropped_files = []      # paths of the files that were dropped
+        self.late = 0                # number of files that reached the GUI late
+        self.proc_t = 0              # time taken to process the last image
+        self.timer = stage_timer()   # records the duration of each stage
+
+    def submit(self, event_path, data=None):
+        """Add the file to the queue to be processed, or drop it if the
+        queue is full. data is the contents of the file as bytes, or None
+        if the file hasn't been read yet. This doesn't wait unless lossless
+        is set, so it can be called directly from the directory watcher's 
+        thread."""
+        try:
+            self.queue.put((event_path, time.time(), data), block=self.lossless)
+        except Full:
+            self.dropped += 1
+            self.dropped_files.append(event_path)
+            print("WARNING: image processing queue is full, dropped " + event_path)
+            self.status.emit(self.queue.qsize(), self.dropped, self.late)
+
+    def take(self, seq, rois, pic_size):
+        """Return the image array and the ROI statistics for the file with
+        sequence number seq, as emitted by the event_path signal, or None 
+        if the file wasn't processed with the same ROIs and image size
+        (e.g. if the user changed them while it was in the queue)."""
+        if seq is None: # not emitted by the pipeline
+            return None
+        with self.lock:
+            result = self.results.pop(seq, None)
+        if result is None:
+            return None
+        t0, res_rois, res_size, full_im, stats = result
+        if time.time() - t0 > self.late_t:
+            self.late += 1
+        if res_rois != rois or res_size != pic_size:
+            return None
+        return full_im, stats
+
+    def process(self, event_path, t0, seq, data=None):
+        """Load the image and calculate the statistics for each ROI, then
+        store the results under the sequence number seq until they're taken
+        by the GUI. Then add the image to the archive."""
+        pic_size = self.image_handler[0].pic_size
+        rois = [im_han.get_roi() for im_han in self.image_handler]
+        t1 = time.time()
+        full_im = self.frames.load(event_path, pic_size, self.image_handler[0].delim, data)
+        t2 = time.time()
+        stats = self.roi_engine.get_stats(full_im, rois)
+        self.timer.add('parse', t2 - t1)
+        self.timer.add('roi stats', time.time() - t2)
+        with self.lock:
+            self.results[seq] = (t0, rois, pic_size, full_im, stats)
+            while len(self.results) > self.maxsize: # results that weren't taken
+                self.results.popitem(last=False)
+        self.store(event_path, full_im)
+
+    def store(self, event_path, full_im):
+        """Add the image to the archive, if there is one"""
+        archive = self.archive
+        if archive is not None:
+            t0 = time.time()
+            stored = archive.append(ih.file_number(event_path), full_im)
+            self.timer.add('archive', time.time() - t0)
+            if not stored:
+                print("WARNING: could not store the counts in " + event_path + 
+                    " as " + str(archive.dtype) + " in the archive " + archive.frames_file)
+
+    def run(self):
+        """Process files from the queue in order until stop() is called"""
+        while True:
+            event_path, t0, data = self.queue.get()
+            if event_path is None: # sent by stop()
+                break
+            t1 = time.time()
+            self.timer.add('queue', t1 - t0)
+            self.seq += 1
+            try:
+                if self.analyse:
+                    self.process(event_path, t0, self.seq, data)
+                elif self.archive is not None: # archive without analysing
+                    self.store(event_path, self.frames.load(event_path, 
+                        self.image_handler[0].pic_size, self.image_handler[0].delim, data))
+            except Exception as e: # the GUI will try to load it again
+                print("WARNING: failed to process " + event_path + "\n" + str(e))
+            self.proc_t = time.time() - t1
+            self.event_path.emit(event_path, self.seq)
+            self.status.emit(self.queue.qsize(), self.dropped, self.late)
+
+    def stop(self):
+        """Finish processing the files in the queue, then stop the thread"""
+        if self.isRunning():
+            self.queue.put((None, 0, None))
+            self.wait()
@@ -4,10 +4,12 @@ Stefan Spence 26/02/19
  - watch the image_read_path directory for new images
  - save the new image with label into a dated subdirectory under image_storage_path
  - delete the original file so that a new file with the same name can be created
+ - load images and get the ROI statistics in a worker thread
  - set an ROI on the image and take an integrated count from the pixels
  - determine atom presence by comparison with a threshold count
  - plot a histogram of signal counts, which defines the threshold
  - save file references to easily re-analyse data
+ - redraw the plots at a limited rate so that processing keeps up with the camera
 
 Assume that there are two peaks in the histogram 
 Assume that image files are ASCII
@@ -23,13 +25,13 @@ from astropy.stats import binom_conf_interval
 import pyqtgraph as pg    # not as flexible as matplotlib but works a lot better with qt
 # some python packages use PyQt4, some use PyQt5...
 try:
-    from PyQt4.QtCore import QThread, pyqtSignal, QEvent, QRegExp
+    from PyQt4.QtCore import QThread, pyqtSignal, QEvent, QRegExp, QTimer, Qt
     from PyQt4.QtGui import (QApplication, QPushButton, QWidget, QLabel, QAction,
             QGridLayout, QMainWindow, QMessageBox, QLineEdit, QIcon, QFileDialog,
             QDoubleValidator, QIntValidator, QComboBox, QMenu, QActionGroup, 
             QTabWidget, QVBoxLayout, QFont, QInputDialog, QRegExpValidator) 
 except ModuleNotFoundError:
-    from PyQt5.QtCore import QThread, pyqtSignal, QEvent, QRegExp
+    from PyQt5.QtCore import QThread, pyqtSignal, QEvent, QRegExp, QTimer, Qt
     from PyQt5.QtGui import (QGridLayout, QMessageBox, QLineEdit, QIcon, 
             QFileDialog, QDoubleValidator, QIntValidator, QComboBox, QMenu, 
             QActionGroup, QVBoxLayout, QFont, QRegExpValidator)
@@ -40,6 +42,8 @@ os.chdir(os.path.dirname(os.path.realpath(__file__)))
 import imageHandler as ih # process images to build up a histogram
 import histoHandler as hh # collect data from histograms together
 import directoryWatcher as dw # use watchdog to get file creation events
+import imagePipeline as ip # load and analyse new images in a worker thread
+import stageTimer as st # record the duration of each stage of processing
 import fitCurve as fc   # custom class to get best fit parameters using curve_fit
 ####    ####    ####    ####
 
@@ -58,6 +62,7 @@ class main_window(QMainWindow):
      - The histoHandler module manages variables associated with the 
         collection of files in several histograms
      - The directoryWatcher module manages file moving, saving, and naming.
+     - The imagePipeline module loads new images in a worker thread.
      - The fitCurve module stores common functions for curve fitting.
     This GUI was produced with help from http://zetcode.com/gui/pyqt5/.
     Keyword arguments:
@@ -79,11 +84,32 @@ class main_window(QMainWindow):
         self.c = [(255,127,14), (31,119,180)] # colours to plot in 
         self.image_handler = [ih.image_handler(i, self.atomX[i]) for i in range(len(self.atomX))] # class to process images
         self.histo_handler = [hh.histo_handler(i, self.atomX[i]) for i in range(len(self.atomX))] # class to process histograms
+        self.frames = ih.frame_cache() # load each image once and share it between image handlers
+        self.roi_engine = ih.roi_stats() # get the statistics for all of the ROIs at once
+        # load and analyse new images in a worker thread, then send them to the GUI
+        self.pipeline = ip.image_pipeline(self.image_handler, self.frames)
+        self.timer = st.stage_timer() # durations of each stage, shared with the pipeline and dir watcher
+        self.pipeline.timer = self.timer
+        self.gauss_fit = fc.multi_gauss(2) # fit the background and signal peaks of all histograms together
+        self.bg_fit = fc.multi_gauss(1)    # fit just the background peak of all histograms together
         self.hist_num = 0 # ID number for the next histogram 
+        self.redraw_interval = 100 # minimum time in ms between redrawing the plots
+        self.redraw_hists = None # histogram functions waiting to be redrawn
+        self.redraw_im = None    # file path of the image waiting to be displayed
+        self.redraw_t = 0        # time of the last redraw
+        self.redraw_timer = QTimer(self) # redraws once the interval has passed
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.timeout.connect(self.redraw)
+        self.stack = None # frame_stack of archived images to re-analyse when the ROI changes
+        self.reanalyse_timer = QTimer(self) # wait until the user stops editing the ROI
+        self.reanalyse_timer.setSingleShot(True)
+        self.reanalyse_timer.timeout.connect(self.reanalyse)
         pg.setConfigOption('background', 'w') # set graph background default white
         pg.setConfigOption('foreground', 'k') # set graph foreground default black
         self.date = time.strftime("%d %b %B %Y", time.localtime()).split(" ") # day short_month long_month year
         self.init_UI(config_file)  # make the widgets
+        self.pipeline.status.connect(self.update_queue_label)
+        self.pipeline.start()
         self.init_DW(pop_up)  # ask the user if they want to start the dir watcher
         self.init_log() # write header to the log file that collects histograms
         self.t0 = time.time()  # time of initiation
@@ -143,6 +169,12 @@ class main_window(QMainWindow):
         load_im = QAction('Load Image', self) # display a loaded image
         load_im.triggered.connect(self.load_image)
         file_menu.addAction(load_im)
+
+        # store each new image in a binary archive as well as the .asc file
+        self.archive_toggle = QAction('Save binary archive', file_menu, 
+                checkable=True, checked=False)
+        self.archive_toggle.triggered.connect(self.set_archive)
+        file_menu.addAction(self.archive_toggle)
         
         # histogram menu saves/loads/resets histogram and gives binning options
         hist_menu =  menubar.addMenu('Histogram')
@@ -165,6 +197,9 @@ class main_window(QMainWindow):
         load_csv = QAction('From csv', self) # from csv of hist data
         load_csv.triggered.connect(self.load_from_csv)
         load_menu.addAction(load_csv)
+        load_archive = QAction('From binary archive', self) # from frame_archive
+        load_archive.triggered.connect(self.load_from_archive)
+        load_menu.addAction(load_archive)
         
         hist_menu.addMenu(load_menu)
 
@@ -295,6 +330,10 @@ class main_window(QMainWindow):
         # label to show last file analysed
         self.recent_label = QLabel('', self)
         settings_grid.addWidget(self.recent_label, i+9,0, 1,4)
+
+        # label to show the number of files waiting to be processed
+        self.queue_label = QLabel('', self)
+        settings_grid.addWidget(self.queue_label, i+10,0, 1,4)
         
         #### tab for multi-run settings ####
         multirun_tab = QWidget()
@@ -384,6 +423,7 @@ class main_window(QMainWindow):
 
         # main subplot of histogram
         self.hist_canvas = [pg.PlotWidget() for i in range(len(self.atomX))]
+        self.hist_items = [None for i in range(len(self.atomX))] # histogram and threshold line plotted on each canvas
         for i in range(len(self.hist_canvas)):
             self.hist_canvas[i].getAxis('bottom').tickFont = font
             self.hist_canvas[i].getAxis('left').tickFont = font # not doing anything...
@@ -395,6 +435,19 @@ class main_window(QMainWindow):
         self.thresh_toggle.triggered.connect(self.set_thresh)
         hist_menu.addAction(self.thresh_toggle)
 
+        # choose how the threshold is set from the peaks
+        thresh_menu = QMenu('Threshold method', self)
+        thresh_options = QActionGroup(thresh_menu)
+        self.thresh_actions = []
+        for action_label in ['Max fidelity', 'ROC']:
+            self.thresh_actions.append(QAction(action_label, thresh_menu, checkable=True,
+                            checked=action_label=='Max fidelity')) # default is max fidelity
+            thresh_menu.addAction(self.thresh_actions[-1])
+            thresh_options.addAction(self.thresh_actions[-1])
+        thresh_options.setExclusive(True) # only one option checked at a time
+        thresh_options.triggered.connect(self.set_thresh_method)
+        hist_menu.addMenu(thresh_menu)
+
         # adjustable parameters: min/max counts, number of bins
         self.hist_edits = {}
         self.hist_label_text = ['Min. Counts: ', 'Max. Counts: ', '# Bins: ', 'Threshold: ']
@@ -448,6 +501,11 @@ class main_window(QMainWindow):
         self.fit_bg_button.clicked[bool].connect(self.fit_bg_gaussian)
         stat_grid.addWidget(self.fit_bg_button, i+2,2, 1,1)
 
+        # fit the peaks to the counts without binning them
+        fit_mixture = QPushButton('Unbinned fit', self)
+        fit_mixture.clicked[bool].connect(self.fit_mixture)
+        stat_grid.addWidget(fit_mixture, i+3,2, 1,1)
+
         # quickly add the current histogram statistics to the plot
         add_to_plot = QPushButton('Add to plot', self)
         add_to_plot.clicked[bool].connect(self.add_stats_to_plot)
@@ -538,6 +596,62 @@ class main_window(QMainWindow):
         save_varplot.clicked[bool].connect(self.save_varplot)
         plot_grid.addWidget(save_varplot, 5,0, 1,1)
 
+        #### tab for the time taken by each stage of processing ####
+        self.timing_tab = QWidget()
+        timing_grid = QGridLayout()
+        self.timing_tab.setLayout(timing_grid)
+        self.tabs.addTab(self.timing_tab, 'Timing')
+        # table of the statistics for each stage
+        self.timing_label = QLabel('', self)
+        self.timing_label.setFont(QFont('Courier')) # monospace to line up the columns
+        timing_grid.addWidget(self.timing_label, 0,0, 1,3)
+        # clear the recorded times
+        reset_timing = QPushButton('Reset timings', self)
+        reset_timing.clicked[bool].connect(self.reset_timing)
+        timing_grid.addWidget(reset_timing, 1,0, 1,1)
+        # save the statistics or the recorded times
+        save_timing = QPushButton('Save timing statistics', self)
+        save_timing.clicked[bool].connect(self.save_timing)
+        timing_grid.addWidget(save_timing, 1,1, 1,1)
+        save_raw_timing = QPushButton('Save recorded times', self)
+        save_raw_timing.clicked[bool].connect(lambda x: self.save_timing(raw=True))
+        timing_grid.addWidget(save_raw_timing, 1,2, 1,1)
+        # only update the table while it's visible
+        self.timing_timer = QTimer(self)
+        self.timing_timer.timeout.connect(self.update_timing)
+        self.timing_timer.start(1000)
+
+        #### tab for the receiver operating characteristic ####
+        self.roc_tab = QWidget()
+        roc_grid = QGridLayout()
+        self.roc_tab.setLayout(roc_grid)
+        self.tabs.addTab(self.roc_tab, 'ROC')
+        # true positive rate against false positive rate for each histogram
+        self.roc_canvas = pg.PlotWidget()
+        self.roc_canvas.setLabel('bottom', 'False positive rate')
+        self.roc_canvas.setLabel('left', 'True positive rate')
+        self.roc_canvas.addLegend()
+        roc_grid.addWidget(self.roc_canvas, 0,0, 1,4)
+        self.roc_items = [[self.roc_canvas.plot([], [], pen=pg.mkPen(self.c[i], width=2), 
+                                name=X+'fit'), # from the fitted peaks
+                        self.roc_canvas.plot([], [], pen=pg.mkPen(self.c[i], style=Qt.DashLine),
+                                name=X+'data'), # from the counts and background fit
+                        self.roc_canvas.plot([], [], pen=None, symbol='o', symbolBrush=self.c[i])] # threshold
+                        for i, X in enumerate(self.atomX)]
+        # the ROC method can set the threshold with a max false positive rate
+        fpr_label = QLabel('Max false positive rate (blank for max TPR - FPR): ', self)
+        roc_grid.addWidget(fpr_label, 1,0, 1,1)
+        self.fpr_edit = QLineEdit(self)
+        self.fpr_edit.setValidator(double_validator) # only floats
+        self.fpr_edit.editingFinished.connect(self.set_thresh_method)
+        roc_grid.addWidget(self.fpr_edit, 1,1, 1,1)
+        self.roc_label = QLabel('', self) # threshold, FPR, TPR for each histogram
+        roc_grid.addWidget(self.roc_label, 2,0, 1,4)
+        # only update the plot while it's visible
+        self.roc_timer = QTimer(self)
+        self.roc_timer.timeout.connect(self.update_roc)
+        self.roc_timer.start(1000)
+
         #### choose main window position and dimensions: (xpos,ypos,width,height)
         self.setGeometry(100, 100, 850, 700)
         self.setWindowTitle('Single Atom Image Analyser')
@@ -607,6 +721,9 @@ class main_window(QMainWindow):
             self.print_times("ms")  # prints performance of dir_watcher
             self.dir_watcher.observer.stop() # ensure that the old thread stops
             self.dir_watcher = None
+            try: # disconnect all slots
+                self.pipeline.event_path.disconnect()
+            except Exception: pass
             self.dw_status_label.setText("Stopped")
             self.dw_init_button.setText('Initiate directory watcher') # turns on
             self.recent_label.setText('')
@@ -616,7 +733,12 @@ class main_window(QMainWindow):
                     config_file=self.config_edit.text(),
                     active=self.dw_mode.isChecked()) # instantiate dir watcher
             self.remove_im_files() # prompt to remove image files
-            self.dir_watcher.event_handler.event_path.connect(self.update_plot) # default
+            # put new files in the queue from the watchdog thread so the GUI isn't involved
+            # in active mode the file contents are sent as well so it isn't read again
+            self.dir_watcher.event_handler.event_data.connect(self.pipeline.submit, 
+                                                    type=Qt.DirectConnection)
+            self.dir_watcher.event_handler.timer = self.timer # record the watcher's stages as well
+            self.pipeline.event_path.connect(self.update_plot) # default
             self.dir_watcher.event_handler.sync_dexter() # get the current Dexter file number
             self.dw_status_label.setText("Running")
             # get current date
@@ -644,6 +766,7 @@ class main_window(QMainWindow):
             # set current file paths
             for key, value in self.dir_watcher.dirs_dict.items():
                 self.path_label[key].setText(value)
+        self.set_archive(self.archive_toggle.isChecked()) # archive in the new storage path
 
     #### #### user input functions #### #### 
 
@@ -678,6 +801,8 @@ class main_window(QMainWindow):
             text = self.atomX[roi_idx] + self.roi_label_text[i]
             self.roi_labels[text].setText(text + str(new_dim[i]))
             self.roi_edits[text].setText(str(new_dim[i]))
+        if self.stack is not None:
+            self.reanalyse_timer.start(300) # re-analyse archived images with the new ROI
             
     def pic_size_text_edit(self, text):
         """Update the specified size of an image in pixels when the user 
@@ -767,6 +892,8 @@ class main_window(QMainWindow):
         # note: setting the origin as top left because image is inverted
         self.rois[roi_idx].setPos(new_dim[0] - new_dim[2]//2, new_dim[1] - new_dim[2]//2) # xc-l//2, yc-l//2
         self.rois[roi_idx].setSize(new_dim[2], new_dim[2]) # l, l
+        if self.stack is not None:
+            self.reanalyse_timer.start(300) # re-analyse archived images with the new ROI
         
         
     def bins_text_edit(self, text):
@@ -852,29 +979,27 @@ class main_window(QMainWindow):
             hh.temp_vals[key] = value
             self.stat_labels[self.atomX[idx]+key].setText(str(value))
 
-    def update_stats(self, toggle=True):
+    def update_stats(self, toggle=True, rois=None):
         """Update the statistics from the current histogram in order to save them
         image_handler uses a peak finding algorithm to get the peak positions and widths
         from these a threshold can be set. If the user thresh_toggle is checked then the
-        threshold will not be updated.
+        threshold will not be updated. rois is a list of the indexes of the image 
+        handlers to update, or None for all of them.
         The histo_handler stores temporary values that we might not yet want to add to
         the plot."""
-        atom_list = [] 
         for i in range(len(self.image_handler)):
+            if rois is not None and i not in rois:
+                continue # keep the statistics from the fit
             if self.image_handler[i].im_num > 0: # only update if a histogram exists
                 if self.thresh_toggle.isChecked(): # using manual threshold
                     self.plot_current_hist([self.image_handler[i].histogram]) # update hist and peak stats, keep thresh
                 else:
                     self.plot_current_hist([self.image_handler[i].hist_and_thresh]) # update hist and get peak stats
 
-                atom_array = self.image_handler[i].atom[:self.image_handler[i].im_num]    # images with counts above threshold
-                atom_list.append(atom_array)
-                above_idxs = np.where(atom_array > 0)[0] # index of images with counts above threshold
-                atom_count = np.size(above_idxs)  # number of images with counts above threshold
-                above = self.image_handler[i].counts[above_idxs] # counts above threshold
-                below_idxs = np.where(atom_array == 0)[0] # index of images with counts below threshold
-                empty_count = np.size(below_idxs) # number of images with counts below threshold
-                below = self.image_handler[i].counts[below_idxs] # counts below threshold
+                # running statistics of the counts below and above threshold
+                empty_count, atom_count = self.image_handler[i].class_stats.n # number of images below, above threshold
+                below_mean, above_mean = self.image_handler[i].class_stats.means()
+                below_std, above_std = self.image_handler[i].class_stats.std()
                 # use the binomial distribution to get 1 sigma confidence intervals:
                 conf = binom_conf_interval(atom_count, atom_count + empty_count, interval='jeffreys')
                 loading_prob = atom_count/self.image_handler[i].im_num # fraction of images above threshold
@@ -882,9 +1007,8 @@ class main_window(QMainWindow):
                 lolperr = loading_prob - conf[0] # 1 sigma confidence below mean
                 # store the calculated histogram statistics as temp, don't add to plot
                 self.histo_handler[i].temp_vals['Hist ID'] = int(self.hist_num)
-                file_list = [x for x in self.image_handler[i].files if x]
-                self.histo_handler[i].temp_vals['Start file #'] = min(map(int, file_list))
-                self.histo_handler[i].temp_vals['End file #'] = max(map(int, file_list))
+                (self.histo_handler[i].temp_vals['Start file #'], 
+                    self.histo_handler[i].temp_vals['End file #']) = self.image_handler[i].file_range()
                 self.histo_handler[i].temp_vals['ROI xc ; yc ; size'] = ' ; '.join([self.roi_edits[self.atomX[i]+label].text()
                         for label in self.roi_label_text])
                 self.histo_handler[i].temp_vals['User variable'] = float(self.var_edit.text())
@@ -904,8 +1028,8 @@ class main_window(QMainWindow):
                     bgw = self.image_handler[i].peak_widths[0] # fitted background peak width
                     self.histo_handler[i].temp_vals['Background peak width'] = int(bgw)
                     self.histo_handler[i].temp_vals['Error in Background peak count'] = np.around(self.image_handler[i].peak_widths[0] / empty_count**0.5, 2)
-                    self.histo_handler[i].temp_vals['Background mean'] = np.around(np.mean(below), 1)
-                    self.histo_handler[i].temp_vals['Background standard deviation'] = np.around(np.std(below, ddof=1), 1)
+                    self.histo_handler[i].temp_vals['Background mean'] = np.around(below_mean, 1)
+                    self.histo_handler[i].temp_vals['Background standard deviation'] = np.around(below_std, 1)
                     self.histo_handler[i].temp_vals['Signal peak count'] = int(self.image_handler[i].peak_counts[1])
                     # assume bias offset is self.bias, readout noise standard deviation Nr
                     if self.Nr**2+self.image_handler[i].peak_counts[1]-self.bias > 0:
@@ -915,8 +1039,8 @@ class main_window(QMainWindow):
                     siw = self.image_handler[i].peak_widths[1] # fitted signal peak width
                     self.histo_handler[i].temp_vals['Signal peak width'] = int(siw)
                     self.histo_handler[i].temp_vals['Error in Signal peak count'] = np.around(self.image_handler[i].peak_widths[1] / atom_count**0.5, 2)
-                    self.histo_handler[i].temp_vals['Signal mean'] = np.around(np.mean(above), 1)
-                    self.histo_handler[i].temp_vals['Signal standard deviation'] = np.around(np.std(above, ddof=1), 1)
+                    self.histo_handler[i].temp_vals['Signal mean'] = np.around(above_mean, 1)
+                    self.histo_handler[i].temp_vals['Signal standard deviation'] = np.around(above_std, 1)
                     sep = self.image_handler[i].peak_counts[1] - self.image_handler[i].peak_counts[0] # separation of fitted peaks
                     self.histo_handler[i].temp_vals['Separation'] = int(sep)
                     seperr = np.sqrt(self.image_handler[i].peak_widths[0]**2 / empty_count
@@ -939,6 +1063,7 @@ class main_window(QMainWindow):
             
         # calculate correlations:  - assuming only two atoms!
         if self.histo_handler[i].temp_vals['Background peak count']:
+            atom_list = [x.atom[:x.im_num] for x in self.image_handler] # images with counts above threshold
             no_atom, only_1, only_2, both = self.get_correlation(atom_list[0], atom_list[1], out_type='str')
             self.histo_handler[0].temp_vals['No atom'] = no_atom # neither atom present
             self.histo_handler[1].temp_vals['No atom'] = no_atom # neither atom present
@@ -957,22 +1082,28 @@ class main_window(QMainWindow):
         """Update the histogram and fit two Gaussians, splitting the data at the threshold
         then use the fits to calculate histogram statistics, and set the threshold where the 
         fidelity is maximum. If the store_stats Boolean is True, append the calculated values
-        to the histo_handler's statistics dictionary."""
-        atom_list = []
+        to the histo_handler's statistics dictionary. The ROIs where the fit failed are left
+        unchanged. Return a list that is True for each ROI where the fit succeeded."""
+        results = {} # fits and statistics for the ROIs where the fit succeeded
+        hists = [im_han.histogram() for im_han in self.image_handler] # bins, occupancy, threshold
+        xs = [bins[:-1] + (bins[1] - bins[0]) * 0.5 for bins, occ, thresh in hists] # bin centres
+        try:
+            t0 = time.time()
+            # fit the sum of two Gaussians to every histogram at once
+            # parameters are: amplitude, centre, standard deviation for each peak
+            ps, perrs, success = self.gauss_fit.fit(xs, [occ for bins, occ, thresh in hists],
+                                    split=[thresh for bins, occ, thresh in hists])
+            self.timer.add('fit', time.time() - t0)
+        except: return [False]*len(self.image_handler) # fit failed, do nothing
         for idx, im_han in enumerate(self.image_handler):
-            bins, occ, thresh = im_han.histogram()  # get histogram
-            bin_mid = (bins[1] - bins[0]) * 0.5 # from edge of bin to middle
+            if not success[idx]: continue # only skip the ROIs where the fit failed
+            bins, occ, thresh = hists[idx]
             diff = abs(bins - thresh)   # minimum is at the threshold
             thresh_i = np.argmin(diff)  # index of the threshold
-            # split the histogram at the threshold value
-            best_fits = [fc.fit(bins[:thresh_i]+bin_mid, occ[:thresh_i]),
-                            fc.fit(bins[thresh_i:-1]+bin_mid, occ[thresh_i:])]
-            for bf in best_fits:
-                try:
-                    bf.estGaussParam()         # get estimate of parameters
-                    # parameters are: amplitude, centre, standard deviation
-                    bf.getBestFit(bf.gauss)    # get best fit parameters
-                except: return 0               # fit failed, do nothing
+            # split the histogram at the threshold value to plot each peak
+            best_fits = [fc.fit(xs[idx][:thresh_i], occ[:thresh_i], param=ps[idx][:3]),
+                            fc.fit(xs[idx][thresh_i:], occ[thresh_i:], param=ps[idx][3:])]
+            best_fits[0].perrs, best_fits[1].perrs = perrs[idx][:3], perrs[idx][3:]
             # update image handler's values for peak parameters
             im_han.peak_heights = np.array((best_fits[0].ps[0], best_fits[1].ps[0]))
             im_han.peak_counts = np.array((best_fits[0].ps[1], best_fits[1].ps[1]))
@@ -980,7 +1111,7 @@ class main_window(QMainWindow):
 
             # update threshold to where fidelity is maximum
             if not self.thresh_toggle.isChecked(): # update thresh if not set by user
-                im_han.search_fidelity(best_fits[0].ps[1], best_fits[0].ps[2], 
+                im_han.find_thresh(best_fits[0].ps[1], best_fits[0].ps[2], 
                                                             best_fits[1].ps[1], n=100)
             else:
                 im_han.fidelity, im_han.err_fidelity = np.around(
@@ -988,33 +1119,33 @@ class main_window(QMainWindow):
 
             self.plot_current_hist([im_han.histogram]) # clear then update histogram plot
             for bf in best_fits:
-                xs = np.linspace(min(bf.x), max(bf.x), 100) # interpolate
-                self.hist_canvas[idx].plot(xs, bf.gauss(xs, *bf.ps), pen='b') # plot best fit
+                if np.size(bf.x):
+                    x = np.linspace(min(bf.x), max(bf.x), 100) # interpolate
+                    self.hist_canvas[idx].plot(x, bf.gauss(x, *bf.ps), pen='b') # plot best fit
 
             # update atom statistics
-            im_han.atom[:im_han.im_num] = im_han.counts[:im_han.im_num] // im_han.thresh   # update atom presence
-            atom_array = im_han.atom[:im_han.im_num]
-            atom_list.append(atom_array)
-            above_idxs = np.where(atom_array > 0)[0] # index of images with counts above threshold
-            atom_count = np.size(above_idxs)  # number of images with counts above threshold
-            above = im_han.counts[above_idxs] # counts above threshold
-            below_idxs = np.where(atom_array == 0)[0] # index of images with counts below threshold
-            empty_count = np.size(below_idxs) # number of images with counts below threshold
-            below = im_han.counts[below_idxs] # counts below threshold
+            im_han.classify()   # update atom presence
+            # running statistics of the counts below and above threshold
+            empty_count, atom_count = im_han.class_stats.n # number of images below, above threshold
+            below_mean, above_mean = im_han.class_stats.means()
+            below_std, above_std = im_han.class_stats.std()
             loading_prob = atom_count/im_han.im_num # loading probability
             # use the binomial distribution to get 1 sigma confidence intervals:
             conf = binom_conf_interval(atom_count, atom_count + empty_count, interval='jeffreys') 
             uplperr = conf[1] - loading_prob # 1 sigma confidence above mean
             lolperr = loading_prob - conf[0] # 1 sigma confidence below mean
-            # store the calculated histogram statistics as temp, don't add to plot
+            results[idx] = (best_fits, empty_count, atom_count, below_mean, above_mean,
+                below_std, above_std, loading_prob, uplperr, lolperr)
+        # store the calculated histogram statistics as temp, don't add to plot
         if store_stats:
-            for idx, im_han in enumerate(self.image_handler):
+            atom_list = [im_han.atom[:im_han.im_num] for im_han in self.image_handler]
+            for idx, (best_fits, empty_count, atom_count, below_mean, above_mean, below_std, 
+                    above_std, loading_prob, uplperr, lolperr) in results.items():
                 self.histo_handler[idx].temp_vals['Hist ID'] = int(self.hist_num)
                 self.histo_handler[idx].temp_vals['User variable'] = float(self.var_edit.text())
-                file_list = [x for x in self.image_handler[idx].files if x]
-                self.histo_handler[idx].temp_vals['Start file #'] = min(map(int, file_list))
-                self.histo_handler[idx].temp_vals['End file #'] = max(map(int, file_list))
-                self.histo_handler[idx].temp_vals['ROI xc ; yc ; size'] = ' ; '.join([self.roi_edits[self.atomX[i]+label].text()
+                (self.histo_handler[idx].temp_vals['Start file #'], 
+                    self.histo_handler[idx].temp_vals['End file #']) = self.image_handler[idx].file_range()
+                self.histo_handler[idx].temp_vals['ROI xc ; yc ; size'] = ' ; '.join([self.roi_edits[self.atomX[idx]+label].text()
                                         for label in self.roi_label_text])
                 self.histo_handler[idx].temp_vals['Number of images processed'] = self.image_handler[idx].im_num
                 self.histo_handler[idx].temp_vals['Counts above : below threshold'] = str(atom_count) + ' : ' + str(empty_count)
@@ -1031,8 +1162,8 @@ class main_window(QMainWindow):
                 bgw = best_fits[0].ps[2] # fitted background peak width
                 self.histo_handler[idx].temp_vals['Background peak width'] = int(bgw)
                 self.histo_handler[idx].temp_vals['Error in Background peak count'] = np.around(best_fits[0].ps[2] / empty_count**0.5, 2)
-                self.histo_handler[idx].temp_vals['Background mean'] = np.around(np.mean(below), 1)
-                self.histo_handler[idx].temp_vals['Background standard deviation'] = np.around(np.std(below, ddof=1), 1)
+                self.histo_handler[idx].temp_vals['Background mean'] = np.around(below_mean, 1)
+                self.histo_handler[idx].temp_vals['Background standard deviation'] = np.around(below_std, 1)
                 self.histo_handler[idx].temp_vals['Signal peak count'] = int(best_fits[1].ps[1])
                 # assume bias offset is self.bias, readout noise standard deviation Nr
                 if self.Nr**2+best_fits[1].ps[1]-self.bias > 0:
@@ -1042,8 +1173,8 @@ class main_window(QMainWindow):
                 siw = best_fits[1].ps[2] # fitted signal peak width
                 self.histo_handler[idx].temp_vals['Signal peak width'] = int(siw)
                 self.histo_handler[idx].temp_vals['Error in Signal peak count'] = np.around(best_fits[1].ps[2] / atom_count**0.5, 2)
-                self.histo_handler[idx].temp_vals['Signal mean'] = np.around(np.mean(above), 1)
-                self.histo_handler[idx].temp_vals['Signal standard deviation'] = np.around(np.std(above, ddof=1), 1)
+                self.histo_handler[idx].temp_vals['Signal mean'] = np.around(above_mean, 1)
+                self.histo_handler[idx].temp_vals['Signal standard deviation'] = np.around(above_std, 1)
                 sep = best_fits[1].ps[1] - best_fits[0].ps[1] # separation of fitted peak centres
                 self.histo_handler[idx].temp_vals['Separation'] = int(sep)
                 seperr = np.sqrt(best_fits[0].ps[2]**2 / empty_count + best_fits[1].ps[2]**2 / atom_count) # error in separation
@@ -1067,23 +1198,27 @@ class main_window(QMainWindow):
                 # display the new statistics in the labels
                 for key, val in self.histo_handler[idx].temp_vals.items():
                     self.stat_labels[self.atomX[idx]+key].setText(str(val))
-        return 1 # fit successful
+        return [bool(x) for x in success]
         
     def fit_bg_gaussian(self, store_stats=False):
         """Assume that there is only one peak in the histogram as there is no single
-        atom signal. Fit a Gaussian to this peak."""
+        atom signal. Fit a Gaussian to this peak. The ROIs where the fit failed are
+        left unchanged. Return a list that is True for each ROI where the fit succeeded."""
+        hists = [im_han.histogram() for im_han in self.image_handler] # bins, occupancy, threshold
+        xs = [bins[:-1] + (bins[1] - bins[0]) * 0.5 for bins, occ, _ in hists] # bin centres
+        try:
+            t0 = time.time()
+            # fit a Gaussian to the peak of every histogram at once
+            # parameters are: amplitude, centre, standard deviation
+            ps, perrs, success = self.bg_fit.fit(xs, [occ for bins, occ, _ in hists])
+            self.timer.add('fit', time.time() - t0)
+        except: return [False]*len(self.image_handler) # fit failed, do nothing
         for i in range(len(self.image_handler)):
+            if not success[i]: continue # only skip the ROIs where the fit failed
             n = self.image_handler[i].im_num # number of images processed
             c = self.image_handler[i].counts[:n] # integrated counts
-            bins, occ, _ = self.image_handler[i].histogram()  # get histogram
-            bin_mid = (bins[1] - bins[0]) * 0.5 # from edge of bin to middle
-            # make a Gaussian fit to the peak
-            best_fit = fc.fit(bins[:-1]+bin_mid, occ)
-            try:
-                best_fit.estGaussParam()
-                # parameters are: amplitude, centre, standard deviation
-                best_fit.getBestFit(best_fit.gauss)    # get best fit parameters
-            except: return 0               # fit failed, do nothing
+            best_fit = fc.fit(xs[i], hists[i][1], param=ps[i])
+            best_fit.perrs = perrs[i]
             # calculate mean and std dev from the data
             mu, sig = np.mean(c), np.std(c, ddof=1)
             # best_fit.ps = [best_fit.ps[0], mu, sig] # use the peak from the fit
@@ -1093,13 +1228,12 @@ class main_window(QMainWindow):
             self.image_handler[i].peak_counts = np.array((best_fit.ps[1], 0))
             self.image_handler[i].peak_widths = np.array((best_fit.ps[2], 0))
             self.plot_current_hist([self.image_handler[i].histogram]) # clear then update histogram plot
-            xs = np.linspace(min(best_fit.x), max(best_fit.x), 100) # interpolate
-            self.hist_canvas.plot(xs, best_fit.gauss(xs, *best_fit.ps), pen='b') # plot best fit
+            x = np.linspace(min(best_fit.x), max(best_fit.x), 100) # interpolate
+            self.hist_canvas[i].plot(x, best_fit.gauss(x, *best_fit.ps), pen='b') # plot best fit
             # store the calculated histogram statistics as temp, don't add to plot
             self.histo_handler[i].temp_vals['Hist ID'] = int(self.hist_num)
-            file_list = [x for x in self.image_handler[i].files if x]
-            self.histo_handler[i].temp_vals['Start file #'] = min(map(int, file_list))
-            self.histo_handler[i].temp_vals['End file #'] = max(map(int, file_list))
+            (self.histo_handler[i].temp_vals['Start file #'], 
+                self.histo_handler[i].temp_vals['End file #']) = self.image_handler[i].file_range()
             self.histo_handler[i].temp_vals['ROI xc ; yc ; size'] = ' ; '.join([self.roi_edits[self.atomX[i]+label].text()
                         for label in self.roi_label_text])
             self.histo_handler[i].temp_vals['User variable'] = float(self.var_edit.text())
@@ -1135,12 +1269,50 @@ class main_window(QMainWindow):
             # display the new statistics in the labels
             for key, val in self.histo_handler[i].temp_vals.items():
                 self.stat_labels[self.atomX[i]+key].setText(str(val))
+        return [bool(x) for x in success]
+
+    def fit_mixture(self, toggle=True):
+        """Fit the background and signal peaks to the counts themselves by
+        maximum likelihood, so that the fit doesn't depend on the histogram
+        bins. Set the threshold where the fidelity is maximum unless it has
+        been set by the user. The fits are then updated with each new image
+        until the histogram is cleared."""
+        for idx, im_han in enumerate(self.image_handler):
+            if im_han.im_num < 2: # need counts to fit
+                continue
+            self.plot_current_hist([im_han.histogram]) # clear then update histogram plot
+            try:
+                t0 = time.time()
+                bins, occ, thresh = im_han.mixture_and_thresh(not self.thresh_toggle.isChecked())
+                self.timer.add('fit', time.time() - t0)
+            except Exception as e: 
+                print('WARNING: unbinned fit failed for '+self.atomX[idx]+'\n'+str(e))
+                continue
+            self.hist_items[idx][1].setData([thresh]*2, [0, max(occ)]) # threshold line
+            xs = np.linspace(bins[0], bins[-1], 200) # interpolate
+            for j in range(2):
+                self.hist_canvas[idx].plot(xs, fc.fit().gauss(xs, im_han.peak_heights[j],
+                    im_han.peak_counts[j], im_han.peak_widths[j]), pen='b') # plot best fit
+            # display the new peaks and threshold in the labels
+            temp_vals = self.histo_handler[idx].temp_vals
+            temp_vals['Background peak count'] = int(im_han.peak_counts[0])
+            temp_vals['Background peak width'] = int(im_han.peak_widths[0])
+            temp_vals['Signal peak count'] = int(im_han.peak_counts[1])
+            temp_vals['Signal peak width'] = int(im_han.peak_widths[1])
+            temp_vals['Threshold'] = int(thresh)
+            temp_vals['Fidelity'] = im_han.fidelity
+            temp_vals['Error in Fidelity'] = im_han.err_fidelity
+            for key in ['Background peak count', 'Background peak width', 'Signal peak count',
+                    'Signal peak width', 'Threshold', 'Fidelity', 'Error in Fidelity']:
+                self.stat_labels[self.atomX[idx]+key].setText(str(temp_vals[key]))
 
     def update_fit(self, toggle=True):
         """Fit Gaussians to the peaks and use it to get a better estimate of the 
         peak centres and widths. The peaks are not quite Poissonian because of the
         bias from dark counts. Use the fits to get histogram statistics, then set 
-        the threshold to maximise fidelity. Iterate until the threshold converges."""
+        the threshold to maximise fidelity. Iterate until the threshold converges.
+        Return a list that is True for each ROI where the fit succeeded."""
+        success = [False]*len(self.image_handler)
         # only update if a histogram exists
         if self.image_handler[0].im_num > 0 and self.image_handler[1].im_num > 0: 
             # store the previous values
@@ -1152,52 +1324,102 @@ class main_window(QMainWindow):
                 success = self.fit_gaussians()
                 diff = abs(oldthresh - np.array([x.thresh for x in self.image_handler])) / oldthresh
 
-            if success: # fit_gaussians returns 0 if the fit fails
-                self.fit_gaussians(store_stats=True) # add new stats to histo_handler
+            if any(success): # only the ROIs where the fit succeeded are updated
+                success = self.fit_gaussians(store_stats=True) # add new stats to histo_handler
         return success
             
     
+    def set_thresh_method(self, action=None):
+        """Set how the image handlers choose the threshold from the peaks:
+        'Max fidelity' or 'ROC' from the threshold method menu. For ROC,
+        use the max false positive rate from the line edit in the ROC tab
+        if it's given, otherwise maximise the true positive rate minus the
+        false positive rate."""
+        method = 'roc' if self.thresh_actions[1].isChecked() else 'fidelity'
+        try:
+            fpr_max = float(self.fpr_edit.text())
+        except ValueError: # blank
+            fpr_max = None
+        for im_han in self.image_handler:
+            im_han.thresh_method = method
+            im_han.fpr_max = fpr_max
+
+    def update_roc(self):
+        """Plot the receiver operating characteristic of each histogram in 
+        the ROC tab, if it's visible. The curves are calculated from the 
+        current peaks, so they're cheap enough to update while running."""
+        if self.tabs.currentWidget() is not self.roc_tab:
+            return
+        text = []
+        for i, im_han in enumerate(self.image_handler):
+            if im_han.im_num > 0 and np.size(im_han.peak_counts) == 2 and all(
+                    np.array(im_han.peak_widths) > 0):
+                threshes, fpr, tpr, tpr_data = im_han.roc()
+                self.roc_items[i][0].setData(fpr, tpr)
+                self.roc_items[i][1].setData(fpr, tpr_data)
+                _, fpr, tpr, tpr_data = im_han.roc([im_han.thresh])
+                self.roc_items[i][2].setData(fpr, tpr)
+                text.append(self.atomX[i] + 'threshold %s:  FPR %.3g,  TPR %.4g (fit), %.4g (data)'%(
+                    int(im_han.thresh), fpr[0], tpr[0], tpr_data[0]))
+                if (im_han.thresh_method == 'roc' and im_han.fpr_max is not None 
+                        and not im_han.fpr_met):
+                    text[-1] += ',  max FPR %.3g not met'%im_han.fpr_max
+            else: # no peaks to calculate from
+                for item in self.roc_items[i]:
+                    item.setData([], [])
+        self.roc_label.setText('\n'.join(text))
+
     def set_thresh(self, toggle):
         """If the toggle is true, the user supplies the threshold value and it is
         kept constant using the image_handler.histogram() function. Otherwise,
-        update the threshold with image_handler.hist_and_thresh()"""
+        update the threshold with image_handler.update_and_thresh()"""
         if toggle:
             try: # disconnect all slots because it might be connected several times
-                self.dir_watcher.event_handler.event_path.disconnect()
+                self.pipeline.event_path.disconnect()
             except Exception: pass # if already disconnected
             if self.dir_watcher:
-                self.dir_watcher.event_handler.event_path.connect(self.update_plot_only)
+                self.pipeline.event_path.connect(self.update_plot_only)
 
             self.bins_text_edit('reset') # update histogram
         else:
             try: # disconnect all slots (including imshow...)
-                self.dir_watcher.event_handler.event_path.disconnect()
+                self.pipeline.event_path.disconnect()
             except Exception: pass # if already disconnected
             if self.dir_watcher:
-                self.dir_watcher.event_handler.event_path.connect(self.update_plot)
+                self.pipeline.event_path.connect(self.update_plot)
         
+    def set_archive(self, toggle):
+        """If the toggle is True, add each new image to a binary archive in 
+        the directory watcher's image storage path, named by the date."""
+        if toggle and self.dir_watcher:
+            self.pipeline.archive = ih.frame_archive(os.path.join(
+                self.dir_watcher.image_storage_path, ''.join(
+                    [self.dir_watcher.date[0], self.dir_watcher.date[1], self.dir_watcher.date[3]])))
+        else:
+            self.pipeline.archive = None
+
     def set_im_show(self, toggle):
         """If the toggle is True, always update the widget with the last image.
         Note that disconnecting all slots means that this toggle might have to
         be reset when other buttons are pressed."""
         if self.dir_watcher:
             if toggle:
-                self.dir_watcher.event_handler.event_path.connect(self.update_im)
+                self.pipeline.event_path.connect(self.queue_im)
             else:
                 try: # note: it could have been connected several times... need while True: ... break
-                    self.dir_watcher.event_handler.event_path.disconnect(self.update_im)
+                    self.pipeline.event_path.disconnect(self.queue_im)
                 except Exception: pass # if it's already been disconnected 
 
     def swap_signals(self):
         """Disconnect the image_handler process signal from the dir_watcher event
         and (re)connect the update plot"""
         try: # disconnect all slots
-            self.dir_watcher.event_handler.event_path.disconnect() 
+            self.pipeline.event_path.disconnect() 
         except Exception: pass
         if self.dir_watcher and self.thresh_toggle.isChecked():
-            self.dir_watcher.event_handler.event_path.connect(self.update_plot_only)
+            self.pipeline.event_path.connect(self.update_plot_only)
         elif self.dir_watcher and not self.thresh_toggle.isChecked():
-            self.dir_watcher.event_handler.event_path.connect(self.update_plot)
+            self.pipeline.event_path.connect(self.update_plot)
 
     def multirun_go(self, toggle):
         """Initiate the multi-run: omit N files, save a histogram of M files, and
@@ -1208,12 +1430,13 @@ class main_window(QMainWindow):
             self.check_reset()
             self.plot_current_hist([x.histogram for x in self.image_handler])
             try: # disconnect all slots
-                self.dir_watcher.event_handler.event_path.disconnect() 
+                self.pipeline.event_path.disconnect() 
             except Exception: pass # already disconnected
             if self.dir_watcher:
                 if self.multirun_save_dir.text() == '':
                     self.choose_multirun_dir()
-                self.dir_watcher.event_handler.event_path.connect(self.multirun_step)
+                self.pipeline.event_path.connect(self.multirun_step)
+                self.pipeline.lossless = True # don't drop files during the multirun
                 self.mr['# omit'] = int(self.omit_edit.text()) # number of files to omit
                 self.mr['# hist'] = int(self.multirun_hist_size.text()) # number of files in histogram                
                 self.mr['o'], self.mr['h'], self.mr['v'] = 0, 0, 0 # counters for different stages of multirun
@@ -1227,6 +1450,7 @@ class main_window(QMainWindow):
             else: # If dir_watcher isn't running, can't start multirun.
                 self.multirun_switch.setChecked(False)
         else: # cancel the multi-run
+            self.pipeline.lossless = False # files can be dropped in live mode
             self.set_bins() # reconnect the dir_watcher
             self.multirun_switch.setText('Start') # reset button text
             self.multirun_progress.setText(       # update progress label
@@ -1243,10 +1467,11 @@ class main_window(QMainWindow):
             self.multirun_switch.setChecked(True)
             self.multirun_switch.setText('Abort')
             try: # disconnect all slots
-                self.dir_watcher.event_handler.event_path.disconnect() 
+                self.pipeline.event_path.disconnect() 
             except Exception: pass # already disconnected
             if self.dir_watcher:
-                self.dir_watcher.event_handler.event_path.connect(self.multirun_step)
+                self.pipeline.event_path.connect(self.multirun_step)
+                self.pipeline.lossless = True # don't drop files during the multirun
     
     def set_bins(self, action=None):
         """Check which of the bin action menu bar options is checked.
@@ -1259,6 +1484,7 @@ class main_window(QMainWindow):
         from the image handler entirely. Files are copied but not processed for
         the histogram."""
         if not self.multirun_switch.isChecked(): # don't interrupt multirun
+            self.pipeline.analyse = not self.bin_actions[3].isChecked() # No Update
             if self.bin_actions[1].isChecked(): # manual
                 self.swap_signals()  # disconnect image handler, reconnect plot
                 self.bins_text_edit('reset')            
@@ -1273,16 +1499,15 @@ class main_window(QMainWindow):
                 self.bins_text_edit('reset') # to update threshold
             elif self.bin_actions[2].isChecked() or self.bin_actions[3].isChecked(): # No Display or No Update
                 try: # disconnect all slots
-                    self.dir_watcher.event_handler.event_path.disconnect()
+                    self.pipeline.event_path.disconnect()
                 except Exception: pass # if it's already been disconnected 
                 # just process the image and set the text of the most recent file
                 if self.dir_watcher: # check that the dir watcher exists to prevent crash
                     # set the text of the most recent file
-                    self.dir_watcher.event_handler.event_path.connect(self.recent_label.setText) # might need a better label
+                    self.pipeline.event_path.connect(self.recent_label.setText) # might need a better label
                     # just process the image
                     if self.bin_actions[2].isChecked():
-                        for im_han in self.image_handler:
-                            self.dir_watcher.event_handler.event_path.connect(im_han.process)                    
+                        self.pipeline.event_path.connect(self.process_im)
             
     #### #### canvas functions #### #### 
         
@@ -1290,59 +1515,136 @@ class main_window(QMainWindow):
         """Reset the plots to show the current data stored in the image handler.
         hist_functions (must be a list) is used to make the histogram and allows 
         the toggling of different functions that may or may not update the 
-        threshold value."""
+        threshold value. The histogram and threshold line are updated in place
+        unless the canvas has been cleared, in which case they're re-plotted.
+        Return the time taken to make the histograms, not including drawing."""
+        hist_t = 0
         # update the histogram and threshold estimate
         for hf in hist_functions:
+            t0 = time.time()
             bins, occ, thresh = hf()
-            idx = np.where([x.histogram == hf or x.hist_and_thresh == hf
+            hist_t += time.time() - t0
+            self.timer.add('histogram', time.time() - t0)
+            idx = np.where([hf in (x.histogram, x.hist_and_thresh, x.update_and_thresh)
                     for x in self.image_handler])[0][0]
             
-            self.hist_canvas[idx].clear()
-            self.hist_canvas[idx].plot(bins, occ, stepMode=True, pen='k',
-                                    fillLevel=0, brush = (220,220,220,220)) # histogram
-            self.hist_canvas[idx].plot([thresh]*2, [0, max(occ)], pen='r') # threshold line
-
+            items = self.hist_items[idx]
+            plotted = self.hist_canvas[idx].listDataItems()
+            if items is None or any(x not in plotted for x in items):
+                self.hist_canvas[idx].clear()
+                self.hist_items[idx] = [
+                    self.hist_canvas[idx].plot(bins, occ, stepMode=True, pen='k',
+                                    fillLevel=0, brush = (220,220,220,220)), # histogram
+                    self.hist_canvas[idx].plot([thresh]*2, [0, max(occ)], pen='r')] # threshold line
+            else:
+                for x in plotted: # remove other lines, e.g. best fits
+                    if x not in items:
+                        self.hist_canvas[idx].removeItem(x)
+                items[0].setData(bins, occ)
+                items[1].setData([thresh]*2, [0, max(occ)])
+        return hist_t
+
+    def schedule_redraw(self, hist_functions=None):
+        """Mark the histograms made by hist_functions as needing to be redrawn.
+        The plots are redrawn with the latest data once redraw_interval ms 
+        have passed since the last redraw, so that several events arriving 
+        in quick succession only cause one redraw."""
+        if hist_functions is not None:
+            self.redraw_hists = hist_functions
+        if not self.redraw_timer.isActive():
+            wait = self.redraw_interval - (time.time() - self.redraw_t)*1e3
+            self.redraw_timer.start(max(int(wait), 0))
+
+    def cancel_redraw(self):
+        """Discard the histograms waiting to be redrawn, e.g. after a reset."""
+        self.redraw_hists = None
+
+    def redraw(self):
+        """Redraw the histograms and image that have been marked as needing
+        to be redrawn since the last redraw."""
+        t0 = time.time()
+        hist_t = 0 # time taken to make the histograms
+        if self.redraw_hists is not None:
+            hist_t = self.plot_current_hist(self.redraw_hists)
+            self.redraw_hists = None
+        if self.redraw_im is not None:
+            self.update_im(self.redraw_im)
+            self.redraw_im = None
+        self.redraw_t = time.time()
+        self.plot_time = self.redraw_t - t0
+        self.timer.add('draw', self.plot_time - hist_t)
+
+    def queue_im(self, event_path, seq=None):
+        """Receive the event path emitted from the system event handler signal
+        and display the image the next time that the plots are redrawn"""
+        self.redraw_im = event_path
+        self.schedule_redraw()
     
     def update_im(self, event_path):
         """Receive the event path emitted from the system event handler signal
         display the image from the file in the image canvas"""
-        im_vals = self.image_handler[0].load_full_im(event_path)
+        im_vals = self.frames.load(event_path, self.image_handler[0].pic_size,
+                                    self.image_handler[0].delim)
         self.im_canvas.setImage(im_vals)
         self.im_hist.setLevels(np.min(im_vals), np.max(im_vals))
+
+    def process_im(self, event_path, seq=None):
+        """Load the image from the event path once, calculate the statistics 
+        for every image handler's ROI together, then pass them to each of the 
+        image handlers to store. If the image has already been processed by 
+        the pipeline's worker thread then use those results instead, taken
+        by the sequence number seq that the pipeline emitted with the path."""
+        t0 = time.time()
+        rois = [im_han.get_roi() for im_han in self.image_handler]
+        result = self.pipeline.take(seq, rois, self.image_handler[0].pic_size)
+        if result is not None:
+            full_im, stats = result
+        else: # not processed by the pipeline or the ROIs have changed since
+            full_im = self.frames.load(event_path, self.image_handler[0].pic_size,
+                                    self.image_handler[0].delim)
+            t1 = time.time()
+            stats = self.roi_engine.get_stats(full_im, rois)
+            self.timer.add('parse', t1 - t0)
+            self.timer.add('roi stats', time.time() - t1)
+            t0 = time.time()
+        self.stack = None # the histogram no longer only contains archived images
+        for im_han, roi_stats in zip(self.image_handler, stats):
+            im_han.process(event_path, full_im, roi_stats)
+        self.timer.add('add counts', time.time() - t0)
         
-    def update_plot(self, event_path):
+    def update_queue_label(self, depth, dropped, late):
+        """Display the number of files waiting in the pipeline's queue and
+        the number of files that were dropped or processed late."""
+        self.queue_label.setText('Files in queue: %s / %s,  dropped: %s,  late (> %ss): %s'%(
+            depth, self.pipeline.maxsize, dropped, self.pipeline.late_t, late))
+        
+    def update_plot(self, event_path, seq=None):
         """Receive the event path emitted from the system event handler signal
         process the file in the event path with the image handler and update
         the figure"""
         # add the count
         t1 = time.time()
-        for im_han in self.image_handler:
-            im_han.process(event_path)
-        t2 = time.time()
-        self.int_time = t2 - t1
+        self.process_im(event_path, seq)
+        self.int_time = time.time() - t1
         
         # display the name of the most recent file
         self.recent_label.setText('Just processed: '+os.path.basename(event_path))
-        self.plot_current_hist([x.hist_and_thresh for x in self.image_handler]) # update the displayed plot
-        self.plot_time = time.time() - t2
+        self.schedule_redraw([x.update_and_thresh for x in self.image_handler]) # update the displayed plot
 
-    def update_plot_only(self, event_path):
+    def update_plot_only(self, event_path, seq=None):
         """Receive the event path emitted from the system event handler signal
         process the file in the event path with the image handler and update
         the figure but without changing the threshold value"""
         # add the count
         t1 = time.time()
-        for im_han in self.image_handler:
-            im_han.process(event_path)
-        t2 = time.time()
-        self.int_time = t2 - t1
+        self.process_im(event_path, seq)
+        self.int_time = time.time() - t1
         
         # display the name of the most recent file
         self.recent_label.setText('Just processed: '+os.path.basename(event_path))
-        self.plot_current_hist([x.histogram for x in self.image_handler]) # update the displayed plot
-        self.plot_time = time.time() - t2
+        self.schedule_redraw([x.histogram for x in self.image_handler]) # update the displayed plot
 
-    def multirun_step(self, event_path):
+    def multirun_step(self, event_path, seq=None):
         """Receive event paths emitted from the system event handler signal
         for the first '# omit' events, only save the files
         then for '# hist' events, add files to a histogram,
@@ -1356,14 +1658,11 @@ class main_window(QMainWindow):
             elif self.mr['h'] < self.mr['# hist']: # add to histogram
                 # add the count to the histogram
                 t1 = time.time()
-                for im_han in self.image_handler:
-                    im_han.process(event_path)
-                t2 = time.time()
-                self.int_time = t2 - t1
+                self.process_im(event_path, seq)
+                self.int_time = time.time() - t1
                 # display the name of the most recent file
                 self.recent_label.setText('Just processed: '+os.path.basename(event_path))
-                self.plot_current_hist([x.hist_and_thresh for x in self.image_handler]) # update the displayed plot
-                self.plot_time = time.time() - t2
+                self.schedule_redraw([x.update_and_thresh for x in self.image_handler]) # update the displayed plot
                 self.mr['h'] += 1 # increment counter
 
             if self.mr['o'] == self.mr['# omit'] and self.mr['h'] == self.mr['# hist']:
@@ -1371,8 +1670,8 @@ class main_window(QMainWindow):
                 self.var_edit.setText(str(self.mr['var list'][self.mr['v']])) # set user variable
                 self.bins_text_edit(text='reset') # set histogram bins 
                 success = self.update_fit()       # get best fit
-                if not success:                   # if fit fails, use peak search
-                    self.update_stats()
+                if not all(success):              # if fit fails, use peak search
+                    self.update_stats(rois=[i for i, s in enumerate(success) if not s])
                     print(
                         '\nWarning: multi-run fit failed at ' +
                         self.mr['prefix'] + '_' + str(self.mr['v']) + '.csv')
@@ -1383,6 +1682,7 @@ class main_window(QMainWindow):
                     confirm=False)# save histogram
                 for im_han in self.image_handler:
                     im_han.reset_arrays() # clear histogram
+                self.cancel_redraw() # keep displaying the saved histogram
                 self.mr['v'] += 1 # increment counter
             
         if self.mr['v'] == np.size(self.mr['var list']):
@@ -1394,6 +1694,7 @@ class main_window(QMainWindow):
             # reconnect previous signals to dir_watcher
             self.multirun_switch.setChecked(False) # reset multi-run button
             self.multirun_switch.setText('Start')  # reset multi-run button text
+            self.pipeline.lossless = False # files can be dropped in live mode
             self.set_bins() # reconnects dir_watcher with given histogram binning settings
             self.mr['o'], self.mr['h'], self.mr['v'] = 0, 0, 0 # reset counters
             self.mr['measure'] += 1 # completed a measure successfully
@@ -1622,16 +1923,19 @@ class main_window(QMainWindow):
             current=0, editable=False)
         idxs = self.get_choice_idx(choice)
         if ok:
+            self.stack = None # new data will be loaded
             if 'Save' in choice: # prompt user for file name then save
                 if self.save_hist_data(atoms=idxs):
                     # only reset the histograms if the save was successful
                     for i in idxs:
                         self.image_handler[i].reset_arrays() # get rid of old data
                         self.hist_canvas[i].clear() # remove old histogram from display
+                    self.cancel_redraw()
             else:
                 for i in idxs:
                     self.image_handler[i].reset_arrays() # get rid of old data
                     self.hist_canvas[i].clear() # remove old histogram from display
+                self.cancel_redraw()
         return choice, ok, idxs
 
     def load_empty_hist(self):
@@ -1648,10 +1952,12 @@ class main_window(QMainWindow):
             for idx in range(len(self.image_handler)):
                 self.image_handler[idx].reset_arrays() # get rid of old data
                 self.hist_canvas[idx].clear() # remove old histogram from display
+            self.cancel_redraw()
         elif reply == QMessageBox.No:
             for idx in range(len(self.image_handler)):
                 self.image_handler[idx].reset_arrays() # get rid of old data
                 self.hist_canvas[idx].clear() # remove old histogram from display
+            self.cancel_redraw()
 
 
     def load_from_files(self, trigger=None):
@@ -1668,20 +1974,34 @@ class main_window(QMainWindow):
                 elif 'PyQt5' in sys.modules:
                     file_list, _ = QFileDialog.getOpenFileNames(self, 
                         'Select Files', default_path, 'Images(*.asc);;all (*)')
-                for file_name in file_list:
-                    for im_han in self.image_handler:
-                        try:
-                            im_han.process(file_name)
-                            self.recent_label.setText(
-                                'Just processed: '+os.path.basename(file_name)) # only updates at end of loop
-                        except:
-                            print("\n WARNING: failed to load "+file_name)
+                self.process_batch(file_list)
                 self.update_stats()
-                if self.recent_label.text == 'Processing files...':
-                    self.recent_label.setText('Finished Processing')
             except OSError:
                 pass # user cancelled - file not found
 
+    def process_batch(self, file_list):
+        """Load the image files and get the statistics for each ROI using
+        several processes in parallel, then add the results to the image
+        handlers in order of file number. Return a list of (file name, 
+        error message) for the files that couldn't be processed."""
+        self.stack = None # the histogram no longer only contains archived images
+        t0 = time.time()
+        files, stats, failures = ih.batch_stats(file_list, 
+            self.image_handler[0].pic_size, [im_han.get_roi() for im_han in self.image_handler],
+            self.image_handler[0].delim, progress=self.show_progress)
+        for im_han, roi_stats in zip(self.image_handler, stats):
+            im_han.add_stats(files, roi_stats)
+        for file_name, error in failures:
+            print("\n WARNING: failed to load " + file_name + "\n" + error)
+        self.recent_label.setText('Processed %s files in %.3g s, %s failed'%(
+            np.size(files), time.time() - t0, len(failures)))
+        return failures
+
+    def show_progress(self, done, total):
+        """Display the number of files processed so far"""
+        self.recent_label.setText('Processing files: %s of %s'%(done, total))
+        self.recent_label.repaint() # update now without processing other events
+
     def load_from_file_nums(self, trigger=None):
         """Prompt the user to enter a range of image file numbers.
         Use these to select the image files from the current image storage path.
@@ -1706,17 +2026,8 @@ class main_window(QMainWindow):
                         os.path.join(image_storage_path, 
                             '_' + date + '_' + dfn + '.asc') for dfn in list(map(str, 
                             range(int(minmax[0]), int(minmax[1]))))] 
-            for file_name in file_list:
-                try:
-                    for im_han in self.image_handler:
-                        im_han.process(file_name)
-                    self.recent_label.setText(
-                        'Just processed: '+os.path.basename(file_name)) # only updates at end of loop
-                except:
-                    print("\n WARNING: failed to load "+file_name) # probably file size was wrong
+            self.process_batch(file_list)
             self.update_stats()
-            if self.recent_label.text == 'Processing files...':
-                self.recent_label.setText('Finished Processing')
 
     def load_from_csv(self, trigger=None):
         """Prompt the user to select a csv file to load histogram data from.
@@ -1737,6 +2048,58 @@ class main_window(QMainWindow):
             except OSError:
                 pass # user cancelled - file not found
 
+    def load_from_archive(self, trigger=None):
+        """Prompt the user to select a binary archive of images and enter a
+        range of file numbers, then process those images and update the 
+        histogram"""
+        default_path = self.get_default_path(option='im')
+        _, ok, _ = self.check_reset() # ask the user to select which atom
+        if ok:
+            try:
+                if 'PyQt4' in sys.modules:
+                    file_name = QFileDialog.getOpenFileName(self, 'Select Archive', 
+                        default_path, 'Archives(*_frames.npy);;all (*)')
+                elif 'PyQt5' in sys.modules:
+                    file_name, _ = QFileDialog.getOpenFileName(self, 'Select Archive', 
+                        default_path, 'Archives(*_frames.npy);;all (*)')
+                if not file_name:
+                    return 0 # user cancelled
+                text, ok = QInputDialog.getText( # user inputs the range
+                    self, 'Choose file numbers to load','Range of file numbers (leave empty for all): ')
+                if ok:
+                    minmax = [int(x) for x in text.split('-') if x.strip()] + [None, None]
+                    if '-' not in text: # only entered one file number
+                        minmax[1] = minmax[0]
+                    stack = ih.frame_stack(*ih.frame_archive(
+                        file_name.replace('_frames.npy', '')).load(minmax[0], minmax[1]))
+                    # if the histograms only contain these images then they can be
+                    # re-analysed when the ROI changes
+                    if all(im_han.im_num == 0 for im_han in self.image_handler):
+                        self.stack = stack
+                    stats = stack.get_stats([im_han.get_roi() for im_han in self.image_handler])
+                    for im_han, roi_stats in zip(self.image_handler, stats):
+                        im_han.add_stats(stack.files, roi_stats)
+                    self.recent_label.setText('Processed %s images from '%np.size(stack.files)
+                        + os.path.basename(file_name))
+                    self.update_stats()
+            except (OSError, ValueError) as e:
+                print("\n WARNING: failed to load archive: " + str(e))
+
+    def reanalyse(self):
+        """Recalculate the results for all of the images in the archive that
+        was loaded with the current ROIs, then update the histograms. The 
+        statistics are taken for the whole stack of images at once."""
+        if self.stack is not None:
+            t0 = time.time()
+            stats = self.stack.get_stats([im_han.get_roi() for im_han in self.image_handler])
+            for im_han, roi_stats in zip(self.image_handler, stats):
+                im_han.reset_arrays()
+                im_han.add_stats(self.stack.files, roi_stats)
+            self.int_time = time.time() - t0
+            self.recent_label.setText('Re-analysed %s images in %.3g s'%(
+                np.size(self.stack.files), self.int_time))
+            self.update_stats()
+
     def load_image(self, trigger=None):
         """Prompt the user to select an image file to display"""
         default_path = self.get_default_path(option='im')
@@ -1770,28 +2133,46 @@ class main_window(QMainWindow):
 
     #### #### testing functions #### #### 
         
+    def update_timing(self):
+        """Display the statistics of the times for each stage of processing
+        in the timing tab, if it's visible."""
+        if self.tabs.currentWidget() is self.timing_tab:
+            self.timing_label.setText(self.timer.summary('ms'))
+
+    def reset_timing(self, toggle=True):
+        """Clear the times recorded for each stage of processing"""
+        self.timer.reset()
+        self.update_timing()
+
+    def save_timing(self, toggle=True, raw=False, save_file_name=''):
+        """Prompt the user for a file to save the statistics of the times for
+        each stage of processing to. If raw is True, save all of the times 
+        that have been recorded instead."""
+        default_path = self.get_default_path(option='log')
+        try:
+            if not save_file_name and 'PyQt4' in sys.modules:
+                save_file_name = QFileDialog.getSaveFileName(
+                    self, 'Save File', default_path, 'csv(*.csv);;all (*)')
+            elif not save_file_name and 'PyQt5' in sys.modules:
+                save_file_name, _ = QFileDialog.getSaveFileName(
+                    self, 'Save File', default_path, 'csv(*.csv);;all (*)')
+            if save_file_name:
+                self.timer.save(save_file_name, raw=raw)
+        except OSError:
+            pass # user cancelled - file not found
+
     def print_times(self, unit="s"):
-        """Display the times measured for functions"""
-        scale = 1
-        if unit == "ms" or unit == "milliseconds":
-            scale *= 1e3
-        elif unit == "us" or unit == "microseconds":
-            scale *= 1e6
-        else:
+        """Display the statistics of the times measured for each stage of
+        processing, in units of 's', 'ms', or 'us'."""
+        unit = {"milliseconds":"ms", "microseconds":"us"}.get(unit, unit)
+        if unit not in ["s", "ms", "us"]:
             unit = "s"
         if self.dir_watcher: # this is None if dir_watcher isn't initiated
-            print("\nFile processing event duration: %.4g "%(
-                self.dir_watcher.event_handler.event_t*scale)+unit)
+            print("\nTime taken by each stage of processing (last %s images):"%self.timer.size)
+            print(self.timer.summary(unit))
             print("Most recent idle time between events: %.4g "%(
-                self.dir_watcher.event_handler.idle_t*scale)+unit)
-            print("Image processing duration: %.4g "%(
-                self.int_time*scale)+unit)
-            print("Image plotting duration: %.4g "%(
-                self.plot_time*scale)+unit)
-            print("File writing duration: %.4g "%(
-                self.dir_watcher.event_handler.write_t*scale)+unit)
-            print("File copying duration: %.4g "%(
-                self.dir_watcher.event_handler.copy_t*scale)+unit)
+                self.dir_watcher.event_handler.idle_t*{"s":1, "ms":1e3, "us":1e6}[unit])+unit)
+            print(self.dir_watcher.event_handler.dexter.summary())
         else: 
             print("Initiate the directory watcher before testing timings")
 
@@ -1806,10 +2187,12 @@ class main_window(QMainWindow):
             self.save_hist_data()         # save current state
             if self.dir_watcher:          # make sure that the directory watcher stops
                 self.dir_watcher.observer.stop()   
+            self.pipeline.stop()          # stop the worker thread
             event.accept()
         elif reply == QMessageBox.Discard:
             if self.dir_watcher: # make sure that the directory watcher stops
                 self.dir_watcher.observer.stop()
+            self.pipeline.stop() # stop the worker thread
             event.accept()
         else:
             event.ignore()        
@@ -0,0 +1,279 @@
+"""Single Atom Image Analysis
+Stefan Spence 24/05/19
+
+ - simulate the camera and Dexter: write .asc images into the image read
+   path at a fixed rate and update the Dexter sync file before each one
+ - run the active or passive directory watcher and the image pipeline on
+   the new files, and record when each image is noticed and analysed
+ - measure the distribution of latencies and find the maximum rate that
+   can be sustained without the queue growing or images being dropped
+
+The images are either synthetic (see benchmark.fake_im) or recorded .asc
+files that are written again in a loop. Everything is done in a temporary
+directory, so it can be run locally:
+    python replayHarness.py --rate 20 --num 200
+    python replayHarness.py --sweep --frames "C:/images/*.asc"
+Use --help to see all of the options.
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import numpy as np
+try:
+    from PyQt4.QtCore import QCoreApplication, Qt
+except ModuleNotFoundError:
+    from PyQt5.QtCore import QCoreApplication, Qt
+import imageHandler as ih # process images to build up a histogram
+import directoryWatcher as dw # use watchdog to get file creation events
+import imagePipeline as ip # load and analyse new images in a worker thread
+import stageTimer as st # record the duration of each stage of processing
+import benchmark as bm # make synthetic .asc images
+
+####    ####    ####    ####
+
+def synthetic_frames(num=20, pic_size=512, bg=700, signal=2000, load_prob=0.5, seed=0):
+    """Return a list of the contents of num .asc images as bytes. Each image
+    has Poissonian background counts and, with probability load_prob, an
+    atom at the centre of the image."""
+    rng = np.random.RandomState(seed)
+    tmp = os.path.join(tempfile.mkdtemp(), 'frame.asc')
+    frames = []
+    for i in range(num):
+        bm.make_asc(tmp, bm.fake_im(pic_size, bg=bg,
+            signal=signal*(rng.rand() < load_prob), seed=rng.randint(2**31)))
+        frames.append(dw.read_bytes(tmp))
+    shutil.rmtree(os.path.dirname(tmp))
+    return frames
+
+def recorded_frames(pattern):
+    """Return a list of the contents of the .asc files matching the glob
+    pattern as bytes, and the image size taken from the first file."""
+    file_list = sorted(glob.glob(pattern))
+    if not file_list:
+        raise FileNotFoundError('no image files match ' + pattern)
+    frames = [dw.read_bytes(f) for f in file_list]
+    first_row = frames[0].split(b'\n')[0].split()
+    return frames, len(first_row) - 1 # the first column is the row number
+
+def percentiles(t, q=(50, 90, 99, 100)):
+    """Return the percentiles q of the times t in ms, or NaN if t is empty"""
+    t = np.asarray(t)[np.isfinite(t)]
+    if not np.size(t):
+        return [np.nan]*len(q)
+    return list(np.percentile(t, q) * 1e3)
+
+class replay_harness:
+    """Write images into a directory watcher's image read path at a fixed
+    rate and time how long each one takes to be analysed.
+
+    A temporary directory is made with an image read path, image storage
+    path, and Dexter sync file, and a config file pointing to them. For
+    each image the sync file is updated with the next file number, then
+    the image is written to a new file in the image read path. The time
+    that writing the file starts, the time that the directory watcher
+    emits the event, and the time that the image_pipeline has finished
+    analysing it are recorded. Signals are connected directly so that the times are
+    recorded in the threads where they happen. The directory watcher
+    handles files in the order they were created, so the n-th event
+    belongs to the n-th image written. The durations of each stage are
+    recorded in timer, which is reset at the start of each run.
+    Keyword arguments:
+    frames   -- list of the contents of .asc images as bytes, which are
+        written in order and repeated as many times as needed.
+    pic_size -- number of pixels along each side of the images.
+    active   -- True to use the active directory watcher, which moves
+        the images into the storage path, False for the passive one.
+    rois     -- list of ROIs [xc, yc, size] to analyse. Default is a 5x5
+        ROI in the centre of the image.
+    maxsize  -- maximum number of images waiting in the pipeline's queue.
+    """
+    def __init__(self, frames, pic_size=512, active=True, rois=None, maxsize=10):
+        self.frames = frames
+        self.active = active
+        self.rois = rois if rois is not None else [[pic_size//2, pic_size//2, 5]]
+        self.image_handler = [ih.image_handler(i) for i in range(len(self.rois))]
+        for im_han, roi in zip(self.image_handler, self.rois):
+            im_han.pic_size = pic_size
+            im_han.set_roi(dimensions=roi)
+        self.maxsize = maxsize
+        self.lock = threading.Lock() # times are recorded from several threads
+        self.timer = st.stage_timer() # shared by the directory watcher and pipeline
+        self.runs = 0 # file names are unique across runs so that they're new files
+
+    def setup(self):
+        """Make the temporary directories and config file, then start the
+        image pipeline and the directory watcher."""
+        self.dir = tempfile.mkdtemp()
+        self.read_path = os.path.join(self.dir, 'read')
+        self.sync_file = os.path.join(self.dir, 'currentfile.txt')
+        os.makedirs(self.read_path)
+        self.write_sync(-1)
+        config_file = os.path.join(self.dir, 'config.dat')
+        with open(config_file, 'w') as f:
+            f.write('\n'.join(['image storage path--'+os.path.join(self.dir, 'storage'),
+                'log file path--'+self.dir, 'dexter sync file--'+self.sync_file,
+                'image read path--'+self.read_path, 'results path--'+self.dir]))
+        self.pipeline = ip.image_pipeline(self.image_handler, ih.frame_cache(), self.maxsize)
+        self.pipeline.timer = self.timer
+        self.pipeline.event_path.connect(self.on_done, type=Qt.DirectConnection)
+        self.pipeline.start()
+        self.dir_watcher = dw.dir_watcher(config_file, self.active)
+        self.dir_watcher.event_handler.event_data.connect(self.on_event,
+                                                    type=Qt.DirectConnection)
+        self.dir_watcher.event_handler.timer = self.timer
+        self.dir_watcher.event_handler.sync_dexter()
+
+    def close(self):
+        """Stop the directory watcher and the pipeline, then delete the
+        temporary directory."""
+        self.dir_watcher.observer.stop()
+        self.dir_watcher.observer.join()
+        self.pipeline.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def write_sync(self, file_num):
+        """Write the Dexter file number to the sync file"""
+        with open(self.sync_file, 'w') as f:
+            f.write(str(file_num))
+
+    def on_event(self, event_path, data):
+        """Record the time that the directory watcher emitted the new file,
+        then submit it to the pipeline."""
+        t = time.time()
+        with self.lock:
+            i = len(self.event_paths)
+            self.event_paths[event_path] = i
+            if i < len(self.t_event):
+                self.t_event[i] = t
+        self.pipeline.submit(event_path, data)
+
+    def on_done(self, event_path):
+        """Record the time that the pipeline finished with the file"""
+        t = time.time()
+        with self.lock:
+            i = self.event_paths.get(event_path)
+            if i is not None and i < len(self.t_done):
+                self.t_done[i] = t
+
+    def run(self, rate, num=200, timeout=5):
+        """Write num images at rate images per second, then wait until they
+        have all been analysed, or for timeout seconds after the last image.
+        Return a dict of the results (see summary)."""
+        self.event_paths = {}              # index of each file in order of events
+        self.t_write = np.full(num, np.nan) # time the file started being written
+        self.t_event = np.full(num, np.nan) # time the directory watcher emitted it
+        self.t_done = np.full(num, np.nan)  # time the pipeline finished analysing it
+        dropped0 = self.pipeline.dropped
+        self.timer.reset()
+        period = 1. / rate
+        t0 = time.time()
+        for i in range(num):
+            delay = t0 + i*period - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.write_sync(i) # Dexter updates the file number before the image is saved
+            self.t_write[i] = time.time()
+            dw.write_bytes(os.path.join(self.read_path, 'replay%s_%s.asc'%(self.runs, i)),
+                    self.frames[i % len(self.frames)])
+        t1 = time.time()
+        self.runs += 1
+        while time.time() - t1 < timeout:
+            with self.lock:
+                done = np.count_nonzero(np.isfinite(self.t_done))
+            if done + self.pipeline.dropped - dropped0 >= num:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05) # let the last events finish before the next run
+        return self.summary(rate, num, self.pipeline.dropped - dropped0)
+
+    def summary(self, rate, num, dropped):
+        """Return a dict with the rate requested and achieved, the number of
+        images dropped from the pipeline's queue or never analysed, and the
+        50th, 90th, 99th, and 100th percentiles of the latencies in ms:
+        'watcher' from starting to write the file to the directory watcher's event,
+        'analysis' from the event to the pipeline finishing, and 'total'.
+        The run is sustained if no images were lost, the images could be
+        written at 90% of the rate requested, and the latency at
+        the end isn't longer than at the start by more than 2 periods,
+        which would mean that a backlog is building up."""
+        with self.lock:
+            t_write, t_event, t_done = self.t_write.copy(), self.t_event.copy(), self.t_done.copy()
+        total = t_done - t_write
+        missing = np.count_nonzero(np.isnan(t_done)) - dropped
+        achieved = (num - 1) / (t_write[-1] - t_write[0]) if num > 1 else rate
+        q = max(num//4, 1)
+        head, tail = np.nanmedian(total[:q]), np.nanmedian(total[-q:])
+        sustained = (dropped == 0 and missing == 0 and achieved > 0.9*rate
+                    and tail - head < 2./rate)
+        return {'mode':'active' if self.active else 'passive', 'rate':rate, 'num':num,
+            'achieved':achieved, 'dropped':dropped, 'missing':missing,
+            'watcher':percentiles(t_event - t_write), 'analysis':percentiles(t_done - t_event),
+            'total':percentiles(total), 'sustained':sustained}
+
+    def max_rate(self, start=5, factor=1.5, num=200, limit=1000):
+        """Increase the rate by factor, starting from start images per second,
+        until it can't be sustained or reaches limit. Return the results
+        from each rate that was tried."""
+        results, rate = [], start
+        while rate <= limit:
+            results.append(self.run(rate, num))
+            print_summary(results[-1])
+            if not results[-1]['sustained']:
+                break
+            rate *= factor
+        return results
+
+def print_summary(res):
+    """Print the results from replay_harness.run on one line"""
+    print(('%s mode, %.4g Hz (achieved %.4g Hz): %s images, %s dropped, %s missing, '
+        'latency ms (50%% / 90%% / 99%% / max): watcher %s, analysis %s, total %s%s')%(
+        res['mode'], res['rate'], res['achieved'], res['num'], res['dropped'],
+        res['missing'], *[' / '.join('%.3g'%x for x in res[key])
+        for key in ['watcher', 'analysis', 'total']], '' if res['sustained'] else ',  NOT SUSTAINED'))
+
+####    ####    ####    ####
+
+def run(argv=None):
+    """Replay images from the command line arguments and print the results"""
+    parser = argparse.ArgumentParser(description=
+        'Time how quickly images are analysed by writing them into a directory watcher at a fixed rate.')
+    parser.add_argument('--frames', help='glob pattern for recorded .asc images (default synthetic images)')
+    parser.add_argument('--pic-size', type=int, default=512,
+        help='size of the synthetic images in pixels (default 512)')
+    parser.add_argument('--mode', choices=['active', 'passive', 'both'], default='both',
+        help='which directory watcher to test (default both)')
+    parser.add_argument('--rate', type=float, default=10, help='images per second (default 10)')
+    parser.add_argument('--num', type=int, default=200, help='number of images to write at each rate (default 200)')
+    parser.add_argument('--sweep', action='store_true',
+        help='increase the rate from --rate until it can\'t be sustained')
+    parser.add_argument('--queue', type=int, default=10,
+        help="maximum number of images in the pipeline's queue (default 10)")
+    args = parser.parse_args(argv)
+    if args.frames:
+        frames, pic_size = recorded_frames(args.frames)
+    else:
+        frames, pic_size = synthetic_frames(pic_size=args.pic_size), args.pic_size
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+    for active in {'active':[True], 'passive':[False], 'both':[True, False]}[args.mode]:
+        rh = replay_harness(frames, pic_size, active, maxsize=args.queue)
+        rh.setup()
+        try:
+            if args.sweep:
+                results = rh.max_rate(args.rate, num=args.num)
+                sustained = [r['rate'] for r in results if r['sustained']]
+                print('Maximum sustained rate in %s mode: %s Hz\n'%(results[0]['mode'],
+                    '%.4g'%max(sustained) if sustained else 'below %.4g'%args.rate))
+            else:
+                print_summary(rh.run(args.rate, args.num))
+                print(rh.timer.summary('ms'))
+                print(rh.dir_watcher.event_handler.dexter.summary() + '\n')
+        finally:
+            rh.close()
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,121 @@
+"""Single Atom Image Analysis
+Stefan Spence 25/05/19
+
+ - record how long each stage of processing takes for every image
+ - keep the last few thousand durations for each stage in ring buffers
+ - summarise them as percentiles, or save them to a csv file
+
+The directory watcher, image pipeline, and GUI can share a stage_timer so
+that all of the stages for an image can be compared.
+"""
+import threading
+import numpy as np
+from collections import OrderedDict
+
+# the stages of processing an image, in order
+stages = ['detect', 'wait for write', 'dexter sync', 'copy', 'queue', 'parse',
+    'roi stats', 'archive', 'add counts', 'histogram', 'fit', 'draw']
+
+####    ####    ####    ####
+
+class stage_timer:
+    """Record the duration of each stage of processing in a ring buffer.
+
+    Each stage has a buffer holding the last size durations, so recording
+    a duration takes constant time and the memory used is fixed. Stages
+    are added the first time they're recorded, or can be listed when the
+    stage_timer is made to set the order they're displayed in. One
+    stage_timer can be shared between threads, and the same stage can be
+    recorded from more than one thread (e.g. 'parse' from the pipeline's
+    worker thread, or from the GUI thread if the pipeline didn't process
+    the image).
+    Keyword arguments:
+    stages -- list of the names of the stages, in order.
+    size   -- number of durations to keep for each stage.
+    """
+    def __init__(self, stages=stages, size=1000):
+        self.size = size
+        self.lock = threading.Lock() # for adding stages and recording durations
+        self.reset(stages)
+
+    def reset(self, stages=None):
+        """Clear the recorded durations. Keep the same stages unless a
+        new list of stages is given."""
+        with self.lock:
+            if stages is None:
+                stages = list(self.buffers.keys())
+            self.buffers = OrderedDict((s, np.full(self.size, np.nan)) for s in stages)
+            self.counts = OrderedDict((s, 0) for s in stages) # number of durations recorded
+
+    def add(self, stage, dt):
+        """Record that the stage took dt seconds"""
+        with self.lock:
+            buf = self.buffers.get(stage)
+            if buf is None: # a new stage
+                buf = self.buffers.setdefault(stage, np.full(self.size, np.nan))
+                self.counts.setdefault(stage, 0)
+            n = self.counts[stage]
+            buf[n % self.size] = dt
+            self.counts[stage] = n + 1
+
+    def last(self, stage):
+        """Return the most recent duration of the stage, or 0 if it hasn't
+        been recorded yet."""
+        with self.lock:
+            n = self.counts.get(stage, 0)
+            return self.buffers[stage][(n-1) % self.size] if n else 0
+
+    def get_times(self, stage):
+        """Return the durations of the stage in the buffer, oldest first"""
+        with self.lock:
+            n = self.counts.get(stage, 0)
+            if n <= self.size:
+                return self.buffers[stage][:n].copy()
+            return np.roll(self.buffers[stage], -(n % self.size))
+
+    def stats(self, q=(50, 95, 99)):
+        """Return an OrderedDict with a list for each stage that has been
+        recorded: [number recorded, mean, percentiles q of the durations,
+        max], where the times are in seconds and only the durations in the
+        buffer are used."""
+        with self.lock: # the stages can't change while copying them
+            names = list(self.buffers.keys())
+        out = OrderedDict()
+        for stage in names:
+            t = self.get_times(stage)
+            if np.size(t):
+                out[stage] = [self.counts[stage], np.mean(t)] + list(
+                    np.percentile(t, q)) + [np.max(t)]
+        return out
+
+    def summary(self, unit='ms', q=(50, 95, 99)):
+        """Return a table of the statistics for each stage as a string,
+        with the times in units of 's', 'ms', or 'us'."""
+        scale = {'s':1, 'ms':1e3, 'us':1e6}[unit]
+        lines = ['%-15s%8s' % ('Stage', 'Number') + ''.join('%10s'%x for x in
+            ['mean'] + ['%s%%'%p for p in q] + ['max']) + '  (%s)'%unit]
+        for stage, vals in self.stats(q).items():
+            lines.append('%-15s%8d' % (stage, vals[0]) + ''.join('%10.4g'%(x*scale)
+                for x in vals[1:]))
+        return '\n'.join(lines)
+
+    def save(self, file_name, raw=False, q=(50, 95, 99)):
+        """Save the statistics for each stage in ms to a csv file. If raw
+        is True then save the durations in ms from each buffer instead,
+        with a column for each stage, oldest first."""
+        if raw:
+            with self.lock:
+                names = list(self.buffers.keys())
+            times = [self.get_times(stage)*1e3 for stage in names]
+            out = np.full((max(map(np.size, times)), len(names)), np.nan)
+            for i, t in enumerate(times):
+                out[:np.size(t), i] = t
+            np.savetxt(file_name, out, delimiter=',', header=', '.join(names) + ' (ms)')
+        else:
+            stats = self.stats(q)
+            with open(file_name, 'w') as f:
+                f.write('# Stage, Number recorded, Mean, ' + ', '.join(
+                    '%s%%'%p for p in q) + ', Max (ms)\n')
+                for stage, vals in stats.items():
+                    f.write(stage + ', %d, '%vals[0] + ', '.join('%.6g'%(x*1e3)
+                        for x in vals[1:]) + '\n')
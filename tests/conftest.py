@@ -0,0 +1,9 @@
+"""Single Atom Image Analysis
+Stefan Spence 16/10/26
+
+Let the tests import the modules from the main directory.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
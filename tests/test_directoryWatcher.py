@@ -0,0 +1,29 @@
+"""Single Atom Image Analysis
+Stefan Spence 16/10/26
+
+Check the file times that the directory watcher uses for timing the
+'detect' stage. Run with: python -m pytest tests
+"""
+import os
+import time
+import pytest
+pytest.importorskip('watchdog')
+import directoryWatcher as dw
+
+####    ####    ####    ####
+
+def test_creation_time(tmp_path):
+    """The creation time is only given where the file system records it,
+    and it doesn't change when the file is written to again."""
+    file_name = str(tmp_path / 'im_0.asc')
+    t0 = time.time()
+    dw.write_bytes(file_name, b'0 1 2\n')
+    t_created = dw.creation_time(file_name)
+    st = os.stat(file_name)
+    if not hasattr(st, 'st_birthtime') and os.name != 'nt': # e.g. Linux
+        assert t_created is None
+        return
+    assert t0 - 1 <= t_created <= time.time()
+    time.sleep(0.05)
+    dw.write_bytes(file_name, b'1 1 2\n', mode='ab')
+    assert dw.creation_time(file_name) == t_created
@@ -0,0 +1,144 @@
+"""Single Atom Image Analysis
+Stefan Spence 16/10/26
+
+Check that the faster functions in imageHandler give the same results as
+the numpy and scipy functions they replace, or the previous versions kept 
+in benchmark.py. Run with: python -m pytest tests
+"""
+import os
+import io
+import numpy as np
+import pytest
+import imageHandler as ih
+import benchmark as bm
+
+####    ####    ####    ####
+
+# ASCII images, with the row number in the first column
+asc_files = {
+    'regular': b'1 10 11 12\n2 20 21 22\n3 30 31 32\n',
+    'no final newline': b'1 10 11 12\n2 20 21 22',
+    'windows newlines': b'1 10 11 12\r\n2 20 21 22\r\n',
+    'newlines at end': b'1 10 11 12\n2 20 21 22\n\n\n',
+    'single row': b'1 10 11 12\n',
+    'single row no newline': b'1 10 11 12',
+    'extra columns': b'1 10 11 12 13\n2 20 21 22 23\n',
+    'ragged': b'1 10 11 12\n2 20 21\n3 30 31 32 33\n',
+    'ragged same total': b'1 2 3\n2 3\n3 4 5 6\n',
+    'tabs': b'1\t10\t11\t12\n2\t20\t21\t22\n',
+    'double spaces': b'1  10 11 12\n2  20 21 22\n',
+    'trailing spaces': b'1 10 11 12 \n2 20 21 22 \n',
+    'leading space': b' 1 10 11 12\n2 20 21 22\n',
+    'blank line': b'1 10 11 12\n\n2 20 21 22\n',
+    'float': b'1 10 11 12\n2 20 21 22.5\n',
+    'float in last row': b'0 1 2\n1 3 4.5\n',
+    'carriage return in row': b'1 10\r11 12\n2 20 21 22\n',
+    'signs': b'1 -10 +11 12\n2 20 21 -22\n',
+    'comment': b'1 10 11 12\n# note\n2 20 21 22\n',
+}
+
+def loadtxt_or_error(data, pic_size, delim=' '):
+    """Return the array from np.loadtxt, or the type of error it raises"""
+    try:
+        return np.loadtxt(io.BytesIO(data), delimiter=delim, usecols=range(1, pic_size+1))
+    except Exception as e:
+        return type(e)
+
+@pytest.mark.parametrize('name', sorted(asc_files))
+@pytest.mark.parametrize('pic_size', [1, 2, 3])
+def test_load_asc_matches_loadtxt(name, pic_size):
+    data = asc_files[name]
+    expected = loadtxt_or_error(data, pic_size)
+    if isinstance(expected, type):
+        with pytest.raises(expected):
+            ih.load_asc('', pic_size, data=data)
+    else:
+        result = ih.load_asc('', pic_size, data=data)
+        assert result.shape == expected.shape
+        assert np.array_equal(result, expected)
+
+def test_load_asc_tab_delimiter():
+    data = asc_files['tabs']
+    assert np.array_equal(ih.load_asc('', 3, '\t', data=data), 
+                          np.loadtxt(io.BytesIO(data), delimiter='\t', usecols=range(1, 4)))
+
+def test_load_asc_image(tmp_path):
+    im = np.random.RandomState(0).poisson(700, (64, 64))
+    file_name = str(tmp_path / 'im.asc')
+    with open(file_name, 'w') as f:
+        for i, row in enumerate(im):
+            f.write(str(i+1) + ' ' + ' '.join(map(str, row)) + '\n')
+    expected = np.loadtxt(file_name, delimiter=' ', usecols=range(1, 65))
+    assert np.array_equal(ih.load_asc(file_name, 64), expected)
+    assert np.array_equal(expected, im)
+
+####    ####    ####    ####
+
+# histograms saved in data/histograms.npz: 'fake' from benchmark.fake_hists(60, seed=1),
+# 'handler' from image_handler.histogram() with automatic and fixed bins
+saved_hists = np.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                        'data', 'histograms.npz'))
+
+# edge cases for the peak search
+edge_hists = {
+    'empty': np.zeros(0),
+    'one bin': np.array([5.]),
+    'all zeros': np.zeros(10),
+    'flat': np.full(20, 7.),
+    'single peak': np.array([0, 1, 4, 9, 4, 1, 0, 0, 0, 0.]),
+    'single peak at edge': np.array([9, 6, 3, 1, 0, 0, 0.]),
+    'flat topped peaks': np.array([0, 3, 9, 9, 9, 3, 0, 2, 9, 9, 2, 0.]),
+    'saturated last bin': np.array([0, 2, 8, 3, 1, 0, 0, 1, 2, 40.]),
+    'saturated peak': np.minimum(np.array([0, 5, 20, 60, 90, 60, 20, 5, 0, 10, 30, 10, 0.]), 50),
+    'three equal peaks': np.array([0, 5, 0, 5, 0, 5, 0.]),
+    'many peaks': np.abs(np.sin(np.arange(200) * 0.7)) * np.arange(200),
+}
+
+def assert_same_peaks(h):
+    """Check that est_param gives exactly the same peaks as the find_peaks loop"""
+    old = bm.est_param_find_peaks(h)
+    new = ih.est_param(h)
+    for a, b in zip(old, new): # peak indexes, heights, widths
+        assert np.array_equal(a, b)
+
+@pytest.mark.parametrize('name', sorted(saved_hists.files))
+def test_est_param_saved_histograms(name):
+    assert_same_peaks(saved_hists[name])
+
+@pytest.mark.parametrize('name', sorted(edge_hists))
+def test_est_param_edge_cases(name):
+    assert_same_peaks(edge_hists[name])
+
+def add_counts(im_han, counts):
+    """Add images with the given counts to the image handler"""
+    stats = np.zeros((np.size(counts), 6))
+    stats[:,0] = counts
+    im_han.add_stats(np.arange(im_han.im_num, im_han.im_num + np.size(counts)), stats)
+
+def test_mixture_updated_with_each_image(monkeypatch):
+    """After an unbinned fit, the live threshold uses the peaks updated 
+    from the running sums instead of fitting all of the counts again"""
+    rng = np.random.RandomState(3)
+    counts = np.concatenate([rng.normal(1000, 20, 600), rng.normal(1300, 40, 400)])
+    rng.shuffle(counts)
+    im_han = ih.image_handler()
+    add_counts(im_han, counts[:200])
+    im_han.mixture_and_thresh()
+    fitted = im_han.mixture.ps.copy()
+    add_counts(im_han, counts[200:])
+    assert not np.array_equal(im_han.mixture.ps, fitted)
+    def no_refit(*args, **kwargs):
+        raise AssertionError('the counts were fitted again')
+    monkeypatch.setattr(im_han.mixture, 'fit', no_refit)
+    bins, occ, thresh = im_han.update_and_thresh()
+    assert np.array_equal(im_han.peak_counts, im_han.mixture.ps[:,1])
+    assert 1000 < thresh < 1300
+    monkeypatch.undo()
+    exact = ih.image_handler()
+    add_counts(exact, counts)
+    exact.mixture_and_thresh()
+    assert np.allclose(im_han.mixture.ps, exact.mixture.ps, rtol=0.05)
+    im_han.reset_arrays() # back to the histogram peaks
+    add_counts(im_han, counts)
+    monkeypatch.setattr(im_han.mixture, 'fit', no_refit)
+    im_han.update_and_thresh()
@@ -0,0 +1,69 @@
+"""Single Atom Image Analysis
+Stefan Spence 16/10/26
+
+Check that the image pipeline returns the results for the right image when
+the same file path is used for more than one image. Run with:
+python -m pytest tests
+"""
+import os
+import numpy as np
+import pytest
+QtCore = pytest.importorskip('PyQt5.QtCore')
+import imageHandler as ih
+import imagePipeline as ip
+
+####    ####    ####    ####
+
+def asc_image(value, pic_size=4):
+    """Return the bytes of an ASCII image where every pixel is value, with
+    the row number in the first column"""
+    return b''.join(b'%d '%i + b' '.join([b'%d'%value]*pic_size) + b'\n'
+        for i in range(pic_size))
+
+def make_pipeline(maxsize=10):
+    """Return an image pipeline with one image handler for a 4x4 image"""
+    im_han = ih.image_handler()
+    im_han.pic_size = 4
+    im_han.set_roi(dimensions=[1, 1, 2])
+    return ip.image_pipeline([im_han], maxsize=maxsize)
+
+def run_pipeline(pipeline, files, tmp_path):
+    """Submit (name, data) pairs to the pipeline and return the emitted
+    (name, sequence number) pairs once they've all been processed. The
+    files are only written once, so later images with the same name are
+    only in the data sent with the path, like a file that is replaced."""
+    for name, data in files:
+        if not (tmp_path / name).exists():
+            (tmp_path / name).write_bytes(data)
+    emitted = []
+    pipeline.event_path.connect(lambda path, seq: emitted.append(
+        (os.path.basename(path), seq)),
+        type=QtCore.Qt.DirectConnection)
+    pipeline.lossless = True
+    pipeline.start()
+    for name, data in files:
+        pipeline.submit(str(tmp_path / name), data)
+    pipeline.stop()
+    return emitted
+
+def test_duplicate_paths(tmp_path):
+    """Each emitted sequence number gives the stats for its own image"""
+    pipeline = make_pipeline()
+    rois = [im_han.get_roi() for im_han in pipeline.image_handler]
+    emitted = run_pipeline(pipeline, [('im_0.asc', asc_image(10)),
+        ('im_0.asc', asc_image(20)), ('im_1.asc', asc_image(30))], tmp_path)
+    assert [path for path, seq in emitted] == ['im_0.asc', 'im_0.asc', 'im_1.asc']
+    assert len(set(seq for path, seq in emitted)) == 3
+    for (path, seq), value in zip(emitted, [10, 20, 30]):
+        full_im, stats = pipeline.take(seq, rois, 4)
+        assert np.all(full_im == value)
+        assert pipeline.take(seq, rois, 4) is None # only taken once
+
+def test_take_unknown(tmp_path):
+    """Results that weren't emitted by the pipeline aren't returned"""
+    pipeline = make_pipeline()
+    rois = [im_han.get_roi() for im_han in pipeline.image_handler]
+    emitted = run_pipeline(pipeline, [('im_0.asc', asc_image(10))], tmp_path)
+    assert pipeline.take(None, rois, 4) is None
+    assert pipeline.take(emitted[0][1] + 1, rois, 4) is None
+    assert pipeline.take(emitted[0][1], rois, 4) is not None